@@ -0,0 +1,171 @@
+import logging
+import socket
+import struct
+
+import gevent
+from gevent.queue import Queue, Empty
+from six.moves import cPickle as pickle
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct("!I")
+# how many queued events are written to the socket with one call
+WRITE_BATCH_SIZE = 256
+
+# bus used by this process, only set when running multiple workers
+BUS = None
+
+
+def configure_bus(bus):
+    global BUS
+    BUS = bus
+
+
+def publish(event, **kwargs):
+    """
+    Sends event to other worker processes, does nothing when
+    server runs as single process
+    :param event:
+    :param kwargs:
+    :return:
+    """
+    if BUS is not None:
+        BUS.publish(event, kwargs)
+
+
+def encode_event(event, kwargs):
+    """
+    Workers are forks of the same process so pickle is safe here and keeps
+    datetimes and uuids intact
+    """
+    data = pickle.dumps((event, kwargs), pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+
+def decode_event(data):
+    return pickle.loads(data)
+
+
+def read_frames(sock):
+    """
+    Yields length prefixed frames read from socket until it gets closed
+    :param sock:
+    :return:
+    """
+    buf = b""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return
+        buf += chunk
+        offset = 0
+        while len(buf) - offset >= HEADER.size:
+            (size,) = HEADER.unpack_from(buf, offset)
+            end = offset + HEADER.size + size
+            if len(buf) < end:
+                break
+            yield buf[offset + HEADER.size : end]
+            offset = end
+        buf = buf[offset:]
+
+
+class SocketWriter(object):
+    """
+    Queues encoded frames and writes them to socket from a single greenlet,
+    frames queued in the meantime are sent with one `sendall()` call
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.outbox = Queue()
+        self.greenlet = None
+
+    def put(self, frame):
+        self.outbox.put(frame)
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.write_forever)
+
+    def write_forever(self):
+        while True:
+            frames = [self.outbox.get()]
+            try:
+                while len(frames) < WRITE_BATCH_SIZE:
+                    frames.append(self.outbox.get_nowait())
+            except Empty:
+                pass
+            try:
+                self.sock.sendall(b"".join(frames))
+            except socket.error:
+                log.warning("bus socket closed, dropping %s frames" % len(frames))
+                return
+
+
+class WorkerBus(object):
+    """
+    Worker side of the fan-out bus, events published here are relayed by
+    the master process to every other worker
+    """
+
+    def __init__(self, sock, handler):
+        """
+
+        :param sock: unix socket connected to the master process
+        :param handler: callable receiving `event, kwargs` of remote events
+        """
+        self.sock = sock
+        self.handler = handler
+        self.writer = SocketWriter(sock)
+        self.published = 0
+        self.received = 0
+
+    def start(self):
+        self.writer.start()
+        gevent.spawn(self.read_forever)
+
+    def publish(self, event, kwargs):
+        self.writer.put(encode_event(event, kwargs))
+        self.published += 1
+
+    def read_forever(self):
+        for frame in read_frames(self.sock):
+            self.received += 1
+            event, kwargs = decode_event(frame)
+            try:
+                self.handler(event, kwargs)
+            except Exception:
+                log.exception("failed to apply bus event %s" % event)
+        log.warning("bus connection to master closed")
+
+    def get_info(self):
+        return {"published": self.published, "received": self.received}
+
+
+class BusHub(object):
+    """
+    Master side of the fan-out bus, frames received from one worker are
+    forwarded as they are to all the others
+    """
+
+    def __init__(self, socks):
+        self.socks = list(socks)
+        self.writers = [SocketWriter(sock) for sock in self.socks]
+        self.forwarded = 0
+
+    def serve_forever(self):
+        """
+        Relays frames until every worker disconnects
+        :return:
+        """
+        for writer in self.writers:
+            writer.start()
+        readers = [gevent.spawn(self.relay, i) for i in range(len(self.socks))]
+        gevent.joinall(readers)
+
+    def relay(self, source):
+        for frame in read_frames(self.socks[source]):
+            data = HEADER.pack(len(frame)) + frame
+            for i, writer in enumerate(self.writers):
+                if i != source:
+                    writer.put(data)
+            self.forwarded += 1
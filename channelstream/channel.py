@@ -1,17 +1,66 @@
-import copy
 import logging
+import time
 import uuid
 from datetime import datetime
+from operator import itemgetter
 
 import six
+from gevent.lock import Semaphore
 
-from channelstream.server_state import get_state
-from channelstream.utils import process_catchup
+from channelstream import cluster, history_store
+from channelstream.frames import encode_frame
+from channelstream.envelope import Envelope
+from channelstream.ring_buffer import RingBuffer
+from channelstream.server_state import DEFAULT_TENANT, get_state, tenant_key
 from channelstream.validation import MSG_EDITABLE_KEYS
 
 log = logging.getLogger(__name__)
 
 
+def message_uuid(message):
+    return message.get("uuid")
+
+
+def frame_message_uuid(frame):
+    """
+    Only regular messages can be edited or deleted, so events referencing
+    them are not indexed
+    """
+    message = frame[1]
+    if message.get("type") == "message":
+        return message.get("uuid")
+    return None
+
+
+def initial_seq():
+    """
+    Sequence numbers start at creation time in microseconds, so they keep
+    growing when a channel or user is removed and created again and resume
+    tokens issued before that stay valid
+    """
+    return int(time.time() * 1e6)
+
+
+def history_record(envelope, in_history, seq=None, frame_time=None):
+    """
+    Record of stored message for history store
+    :param envelope:
+    :param in_history: message is part of channel history
+    :param seq: sequence number in channel frames
+    :param frame_time: time the frame was stored
+    :return:
+    """
+    return {
+        "op": "add",
+        "payload": envelope.payload,
+        "pm_users": envelope.pm_users,
+        "exclude_users": envelope.exclude_users,
+        "history": in_history,
+        "seq": seq,
+        "time": frame_time,
+    }
+
+
 class Channel(object):
     """ Represents one of our chat channels - has some config options """
 
@@ -22,20 +71,29 @@ class Channel(object):
         "broadcast_presence_with_user_lists",
         "notify_state",
         "store_frames",
+        "frames_size",
     ]
 
-    def __init__(self, name, long_name=None, channel_config=None):
+    def __init__(
+        self, name, long_name=None, channel_config=None, tenant_id=DEFAULT_TENANT
+    ):
         """
 
         :param name:
         :param long_name:
         :param channel_config:
+        :param tenant_id:
         """
         self.uuid = uuid.uuid4()
         self.name = name
+        self.tenant_id = tenant_id
+        # name of channel in history store shared by all tenants
+        self.store_key = tenant_key(tenant_id, name)
         self.long_name = long_name
         self.last_active = None
+        # username -> connections subscribed to channel
         self.connections = {}
+        self.total_connections = 0
         self.notify_presence = False
         self.broadcast_presence_with_user_lists = False
         # channel sends all user state key changes
@@ -44,10 +102,21 @@ class Channel(object):
         self.store_history = False
         self.store_frames = True
         self.history_size = 10
-        self.history = []
+        self._history = RingBuffer(self.history_size, key=message_uuid)
         # store frames for fetching when connection is established
         # those frames will store channel messages including presence ones
-        self.frames = []
+        self.frames_size = 100
+        self._frames = RingBuffer(
+            self.frames_size, key=frame_message_uuid, start_seq=initial_seq()
+        )
+        # persisted history is loaded on first access to history or frames
+        self.history_pending = history_store.STORE is not None
+        self.history_lock = Semaphore()
+        # records written to history store since its log was compacted
+        self.persisted_records = 0
+        # persisted records this channel did not load because of its config,
+        # they are written back when its log gets compacted
+        self.unloaded_records = []
         if channel_config:
             self.reconfigure_from_dict(channel_config)
         log.info("%s created" % self)
@@ -57,18 +126,36 @@ class Channel(object):
     def mark_activity(self):
         self.last_active = datetime.utcnow()
 
-    def get_catchup_frames(self, newer_than, username):
-        found = []
-        for t, f in self.frames:
-            # either old frame or user is excluded or PM not meant for user
-            if (
-                t < newer_than
-                or (f["exclude_users"] and username in f["exclude_users"])
-                or (f["pm_users"] and username not in f["pm_users"])
-            ):
-                continue
+    @property
+    def history(self):
+        if self.history_pending:
+            self.load_history()
+        return self._history
+
+    @property
+    def frames(self):
+        if self.history_pending:
+            self.load_history()
+        return self._frames
 
-            found.append(process_catchup(f))
+    def get_catchup_frames(self, newer_than, username, after_seq=None):
+        """
+        Returns frames client missed
+        :param newer_than: datetime of last activity of client
+        :param username:
+        :param after_seq: sequence number of last frame client received,
+                          when it's known `newer_than` is not used
+        :return:
+        """
+        found = []
+        if after_seq is not None:
+            start_seq = after_seq + 1
+        else:
+            # frames are ordered by time so older ones can be skipped
+            start_seq = self.frames.bisect(newer_than, key=itemgetter(0))
+        for seq, (t, envelope) in self.frames.entries(start_seq):
+            if envelope.is_visible_to(username):
+                found.append(envelope.catchup_view())
         return found
 
     def reconfigure_from_dict(self, config):
@@ -77,6 +164,9 @@ class Channel(object):
                 val = config.get(key)
                 if val is not None:
                     setattr(self, key, val)
+            # persisted history does not have to be loaded for this
+            self._history.resize(self.history_size)
+            self._frames.resize(self.frames_size)
 
     def add_connection(self, connection):
         username = connection.username
@@ -85,6 +175,11 @@ class Channel(object):
             self.send_notify_presence_info(username, "joined")
         if connection not in connections:
             connections.append(connection)
+            self.total_connections += 1
+            connection.joined_channel(self.name)
+            if len(connections) == 1 and len(self.connections) == 1:
+                # first local subscriber, other nodes start relaying to us
+                cluster.interest_added("channel", self.name, self.tenant_id)
             return True
         return False
 
@@ -94,6 +189,8 @@ class Channel(object):
         connections = self.connections.setdefault(username, [])
         if connection in connections:
             self.connections[username].remove(connection)
+            self.total_connections -= 1
+            connection.parted_channel(self.name)
             was_found = True
 
         self.after_parted(username)
@@ -109,6 +206,8 @@ class Channel(object):
         """
         if not self.connections[username]:
             del self.connections[username]
+            if not self.connections:
+                cluster.interest_removed("channel", self.name, self.tenant_id)
             if self.notify_presence:
                 self.send_notify_presence_info(username, "parted")
 
@@ -119,7 +218,7 @@ class Channel(object):
         :param action:
         :return:
         """
-        server_state = get_state()
+        server_state = get_state(self.tenant_id)
         connected_users = []
         if self.broadcast_presence_with_user_lists:
             for _username in self.connections.keys():
@@ -170,46 +269,198 @@ class Channel(object):
         self.add_message(payload)
         return payload
 
-    def add_frame(self, frame):
-        if self.store_frames:
-            self.frames.append((datetime.utcnow(), frame))
-            self.frames = self.frames[-100:]
+    def next_frame_seq(self):
+        """
+        Sequence number the next stored frame gets, payloads carry it from
+        the start so they are never modified once shared
+        :return: number or None when frames are not stored
+        """
+        if not self.store_frames:
+            return None
+        return self.frames.next_seq
 
-    def add_to_history(self, message):
-        if self.store_history and message["type"] == "message":
-            self.history.append(message)
-            self.history = self.history[self.history_size * -1 :]
+    def add_frame(self, envelope):
+        """
+        Stores frame for catchup
+        :param envelope: created with `next_frame_seq()`
+        :return: sequence number and time of the frame or (None, None)
+        """
+        if not self.store_frames:
+            return None, None
+        frame_time = datetime.utcnow()
+        seq, evicted = self.frames.append((frame_time, envelope))
+        return seq, frame_time
+
+    def add_to_history(self, envelope):
+        if self.store_history and envelope["type"] == "message":
+            self.history.append(envelope)
+            return True
+        return False
 
     def add_message(self, message, pm_users=None, exclude_users=None):
         """
         Sends the message to all connections subscribed to this channel
         """
-        pm_users = pm_users or []
-        exclude_users = exclude_users or []
         self.mark_activity()
-        if not message["no_history"]:
-            self.add_to_history(message)
-        self.add_frame(message)
-        message = copy.deepcopy(message)
-        # do not leak delivery info
-        del message["no_history"]
-        del message["pm_users"]
-        del message["exclude_users"]
+        # delivery info is kept outside of payload so it does not leak
+        envelope = Envelope.from_message(message, seq=self.next_frame_seq())
+        self.store_envelope(envelope)
+        route = Envelope(envelope.payload, pm_users, exclude_users)
+        return self.send_envelopes([route])
+
+    def add_messages(self, messages):
+        """
+        Sends a batch of messages to connections subscribed to this channel,
+        every connection receives a single frame holding all messages
+        meant for it in the order they were passed
+
+        :param messages:
+        :return: number of delivered messages
+        """
+        self.mark_activity()
+        envelopes = []
+        for message in messages:
+            envelope = Envelope.from_message(message, seq=self.next_frame_seq())
+            self.store_envelope(envelope)
+            envelopes.append(envelope)
+        return self.send_envelopes(envelopes)
+
+    def store_envelope(self, envelope):
+        in_history = False
+        if not envelope.no_history:
+            in_history = self.add_to_history(envelope)
+        seq, frame_time = self.add_frame(envelope)
+        if in_history or seq is not None:
+            self.persist(history_record(envelope, in_history, seq, frame_time))
+
+    def persist(self, record):
+        """
+        Passes record to history store, log of the channel is compacted
+        once it gets much longer than what the channel retains
+        :param record:
+        :return:
+        """
+        if history_store.STORE is None:
+            return
+        history_store.persist(self.store_key, record)
+        self.persisted_records += 1
+        if self.persisted_records > 2 * (self.history_size + self.frames_size) + 100:
+            records = self.history_records()
+            history_store.rewrite(self.store_key, records)
+            self.persisted_records = len(records) - len(self.unloaded_records)
+
+    def history_records(self):
+        """
+        Returns records recreating current history and frames of the channel
+        :return:
+        """
+        history = list(self.history)
+        positions = {id(envelope): i for i, envelope in enumerate(history)}
+        records = list(self.unloaded_records)
+        position = 0
+        for seq, (frame_time, envelope), deleted in self.frames.retained():
+            index = positions.get(id(envelope))
+            if index is not None:
+                # keep order of history entries that are not frames
+                for older in history[position:index]:
+                    records.append(history_record(older, True))
+                position = index + 1
+            records.append(history_record(envelope, index is not None, seq, frame_time))
+            # deleted frames keep their sequence numbers taken
+            if deleted and envelope.get("uuid"):
+                records.append({"op": "delete", "uuid": envelope.get("uuid")})
+        for older in history[position:]:
+            records.append(history_record(older, True))
+        return records
+
+    def load_history(self):
+        """
+        Restores history and frames from history store
+        :return:
+        """
+        with self.history_lock:
+            # other greenlet could load it while we waited
+            if not self.history_pending:
+                return
+            records = history_store.load(self.store_key)
+            self.history_pending = False
+            self.replay_history(records)
+
+    def replay_history(self, records):
+        frames = None
+        # uuids of messages that were not loaded
+        skipped = set()
+        for record in records:
+            if record["op"] == "add":
+                envelope = Envelope(
+                    record["payload"], record["pm_users"], record["exclude_users"]
+                )
+                in_history = record["history"] and self.store_history
+                in_frames = record["seq"] is not None and self.store_frames
+                skipped_history = record["history"] and not in_history
+                skipped_frame = record["seq"] is not None and not in_frames
+                if skipped_history or skipped_frame:
+                    # channel was created with config that does not keep
+                    # this, it must not get lost when the log is compacted
+                    self.unloaded_records.append(
+                        dict(
+                            record,
+                            history=skipped_history,
+                            seq=record["seq"] if skipped_frame else None,
+                        )
+                    )
+                    skipped.add(envelope.get("uuid"))
+                if in_history:
+                    self.history.append(envelope)
+                if in_frames:
+                    if frames is None:
+                        # sequence numbers continue where they ended
+                        frames = self._frames = RingBuffer(
+                            self.frames_size,
+                            key=frame_message_uuid,
+                            start_seq=record["seq"],
+                        )
+                    frames.append((record["time"], envelope))
+            elif record["op"] == "edit":
+                self.apply_edit(record["uuid"], record["changes"])
+            elif record["op"] == "delete":
+                self.apply_delete(record["uuid"])
+            if record["op"] != "add" and record["uuid"] in skipped:
+                self.unloaded_records.append(record)
+        self.persisted_records = len(records) - len(self.unloaded_records)
+
+    def send_envelopes(self, envelopes):
+        """
+        Encodes payloads only once for every distinct set of recipients
+        and shares resulting frame between connections
+
+        :param envelopes:
+        :return: number of delivered messages
+        """
         total_sent = 0
-        # message everyone subscribed except excluded
-        for user, conns in six.iteritems(self.connections):
-            if not exclude_users or user not in exclude_users:
-                for connection in conns:
-                    if not pm_users or connection.username in pm_users:
-                        connection.add_message(message)
-                        total_sent += 1
+        # positions of visible envelopes -> encoded frame
+        frames = {}
+        for username, conns in six.iteritems(self.connections):
+            if not conns:
+                continue
+            visible = tuple(
+                i for i, e in enumerate(envelopes) if e.is_visible_to(username)
+            )
+            if not visible:
+                continue
+            frame = frames.get(visible)
+            if frame is None:
+                frame = encode_frame([envelopes[i].payload for i in visible])
+                frames[visible] = frame
+            for connection in conns:
+                connection.add_message(frame=frame)
+            total_sent += len(visible) * len(conns)
         return total_sent
 
     def __repr__(self):
         return "<Channel: %s, connections:%s>" % (self.name, len(self.connections))
 
     def get_info(self, include_history=True, include_users=False):
-        server_state = get_state()
         settings = {k: getattr(self, k) for k in self.config_keys}
 
         chan_info = {
@@ -217,47 +468,52 @@ class Channel(object):
             "name": self.name,
             "long_name": self.long_name,
             "settings": settings,
-            "history": self.history if include_history else [],
+            "history": [e.payload for e in self.history] if include_history else [],
             "last_active": self.last_active,
-            "total_connections": sum(
-                [len(conns) for conns in self.connections.values()]
-            ),
-            "total_users": 0,
-            "users": [],
+            "total_connections": self.total_connections,
+            # users without connections are removed from the mapping
+            "total_users": len(self.connections),
+            "users": sorted(self.connections) if include_users else [],
         }
-
-        for username in self.connections.keys():
-            user_inst = server_state.users.get(username)
-            if include_users and user_inst.username not in chan_info["users"]:
-                chan_info["users"].append(user_inst.username)
-        chan_info["users"] = sorted(chan_info["users"])
-        chan_info["total_users"] = len(chan_info["users"])
         return chan_info
 
-    def alter_message(self, to_edit):
-        found = False
-        for msg in self.history:
-            if msg["uuid"] == to_edit["uuid"]:
-                found = True
-                msg.update(
-                    {k: v for k, v in six.iteritems(to_edit) if k in MSG_EDITABLE_KEYS}
-                )
-                break
+    def apply_edit(self, msg_uuid, changes):
+        """
+        Updates stored message
+        :param msg_uuid:
+        :param changes:
+        :return: True if message was found
+        """
+        seq, msg = self.history.lookup(msg_uuid)
         # if found history then reference in frames will be also updated,
         # otherwise search frames for channels that do not store history
-        if not found:
-            for f, msg in self.frames:
-                if msg["uuid"] == to_edit["uuid"] and msg["type"] == "message":
-                    msg.update(
-                        {
-                            k: v
-                            for k, v in six.iteritems(to_edit)
-                            if k in MSG_EDITABLE_KEYS
-                        }
-                    )
-                    break
-        altered = copy.deepcopy(to_edit)
-        altered["type"] = "message:edit"
+        if msg is None:
+            seq, frame = self.frames.lookup(msg_uuid)
+            msg = frame[1] if frame else None
+        if msg is None:
+            return False
+        msg.update(changes)
+        return True
+
+    def apply_delete(self, msg_uuid):
+        """
+        Removes stored message
+        :param msg_uuid:
+        :return: True if message was found
+        """
+        seq, msg = self.history.lookup(msg_uuid)
+        if msg is not None:
+            self.history.discard(seq)
+        frame_seq, frame = self.frames.lookup(msg_uuid)
+        if frame is not None:
+            self.frames.discard(frame_seq)
+        return msg is not None or frame is not None
+
+    def alter_message(self, to_edit):
+        changes = {k: v for k, v in six.iteritems(to_edit) if k in MSG_EDITABLE_KEYS}
+        if self.apply_edit(to_edit["uuid"], changes):
+            self.persist({"op": "edit", "uuid": to_edit["uuid"], "changes": changes})
+        altered = dict(to_edit, type="message:edit")
         self.add_message(
             altered,
             pm_users=altered["pm_users"],
@@ -265,19 +521,9 @@ class Channel(object):
         )
 
     def delete_message(self, to_delete):
-        for i, msg in enumerate(self.history):
-            if msg["uuid"] == to_delete["uuid"]:
-                self.history.pop(i)
-                break
-
-        for i, frame in enumerate(self.frames):
-            msg = frame[1]
-            if msg["uuid"] == to_delete["uuid"] and msg["type"] == "message":
-                self.frames.pop(i)
-                break
-
-        deleted = copy.deepcopy(to_delete)
-        deleted["type"] = "message:delete"
+        if self.apply_delete(to_delete["uuid"]):
+            self.persist({"op": "delete", "uuid": to_delete["uuid"]})
+        deleted = dict(to_delete, type="message:delete")
         self.add_message(
             deleted,
             pm_users=deleted["pm_users"],
@@ -5,7 +5,12 @@ monkey.patch_all()
 import copy
 import logging
 import argparse
+import os
+import signal
+import socket
+import uuid
 
+import gevent
 from six.moves import configparser
 
 from gevent.server import StreamServer
@@ -13,7 +18,16 @@ from pyramid.settings import asbool
 
 import channelstream.wsgi_app as pyramid_app
 import channelstream
-from channelstream.gc import gc_conns_forever, gc_users_forever
+from channelstream import (
+    bus,
+    cluster,
+    history_store,
+    outbound,
+    patched_json,
+    replication,
+    snapshot,
+    tenants,
+)
 from channelstream.policy_server import client_handle
 from channelstream.ws_app import ChatApplicationSocket
 
@@ -44,15 +58,37 @@ SHARED_DEFAULTS = {
     "gc_conns_after": 30,
     "gc_channels_after": 3600 * 72,
     "wake_connections_after": 5,
+    "long_poll_coalesce_window": 0.02,
+    "long_poll_max_wait": 0.25,
+    "long_poll_max_batch": 500,
+    "outbound_buffer_size": 1000,
+    "outbound_overflow_policy": "drop_oldest",
     "allow_posting_from": "127.0.0.1",
     "port": 8000,
+    "policy_port": 10843,
     "host": "0.0.0.0",
     "debug": False,
     "log_level": "INFO",
     "demo": False,
     "allow_cors": "",
+    "wire_json_backend": "auto",
+    "wire_json_compact": True,
+    "workers": 1,
+    "cluster_listen": "",
+    "cluster_peers": "",
+    "cluster_redis_url": "",
+    "history_store": "",
+    "history_flush_interval": 0.05,
+    "snapshot_path": "",
+    "snapshot_interval": 300,
+    "tenant_max_connections": 0,
+    "tenant_max_channels": 0,
+    "tenant_max_messages_per_second": 0,
+    "tenants": {},
 }
 
+TENANT_SECTION_PREFIX = "channelstream:tenant:"
+
 
 def cli_start():
     config = copy.deepcopy(SHARED_DEFAULTS)
@@ -84,6 +120,12 @@ def cli_start():
         dest="port",
         help="Port on which the server listens to",
     )
+    parser.add_argument(
+        "--policy_port",
+        type=int,
+        dest="policy_port",
+        help="Port of flash policy server, 0 disables it",
+    )
     parser.add_argument("-d", "--debug", dest="debug", help="Does nothing for now")
     parser.add_argument(
         "-l", "--log-level", dest="log_level", help="Does nothing for now"
@@ -93,7 +135,8 @@ def cli_start():
         "-x",
         "--allowed_post_ip",
         dest="allow_posting_from",
-        help="comma separated list of ip's " "that can post to server",
+        help="comma separated list of ip's or networks (10.0.0.0/8) "
+        "that can post to server",
     )
     parser.add_argument(
         "-c",
@@ -101,18 +144,145 @@ def cli_start():
         dest="allow_cors",
         help="comma separated list of domains's " "that can connect to server",
     )
+    parser.add_argument(
+        "-j",
+        "--wire_json_backend",
+        dest="wire_json_backend",
+        help="JSON encoder used for client payloads: "
+        "auto, orjson, rapidjson or json",
+    )
+    parser.add_argument(
+        "--wire_json_compact",
+        dest="wire_json_compact",
+        help="Should client payloads use compact JSON separators",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        dest="workers",
+        help="Number of worker processes sharing the listening socket",
+    )
+    parser.add_argument(
+        "--long_poll_coalesce_window",
+        type=float,
+        dest="long_poll_coalesce_window",
+        help="Seconds long poll response waits for more messages after "
+        "the queue gets empty",
+    )
+    parser.add_argument(
+        "--long_poll_max_wait",
+        type=float,
+        dest="long_poll_max_wait",
+        help="Maximum seconds long poll response is held after first message",
+    )
+    parser.add_argument(
+        "--long_poll_max_batch",
+        type=int,
+        dest="long_poll_max_batch",
+        help="Maximum number of frames sent in one long poll response",
+    )
+    parser.add_argument(
+        "--outbound_buffer_size",
+        type=int,
+        dest="outbound_buffer_size",
+        help="Maximum number of frames waiting to be sent to one connection",
+    )
+    parser.add_argument(
+        "--outbound_overflow_policy",
+        dest="outbound_overflow_policy",
+        help="What happens when connection buffer is full: "
+        "drop_oldest, drop_newest, coalesce or disconnect",
+    )
+    parser.add_argument(
+        "--cluster_listen",
+        dest="cluster_listen",
+        help="host:port on which cluster peers connect to this node",
+    )
+    parser.add_argument(
+        "--cluster_peers",
+        dest="cluster_peers",
+        help="comma separated list of host:port of other cluster nodes",
+    )
+    parser.add_argument(
+        "--cluster_redis_url",
+        dest="cluster_redis_url",
+        help="Redis url, nodes exchange messages via Redis pub/sub when set",
+    )
+    parser.add_argument(
+        "--history_store",
+        dest="history_store",
+        help="Where channel history is persisted: "
+        "file:<directory> or sqlite:<database path>",
+    )
+    parser.add_argument(
+        "--history_flush_interval",
+        type=float,
+        dest="history_flush_interval",
+        help="Seconds between batched writes of channel history",
+    )
+    parser.add_argument(
+        "--snapshot_path",
+        dest="snapshot_path",
+        help="File with snapshot of channel configuration and user state, "
+        "restored at startup",
+    )
+    parser.add_argument(
+        "--snapshot_interval",
+        type=float,
+        dest="snapshot_interval",
+        help="Seconds between snapshots, one is also written on shutdown",
+    )
+    parser.add_argument(
+        "--tenant_max_connections",
+        type=int,
+        dest="tenant_max_connections",
+        help="Connections one tenant can hold, 0 means no limit",
+    )
+    parser.add_argument(
+        "--tenant_max_channels",
+        type=int,
+        dest="tenant_max_channels",
+        help="Channels one tenant can create, 0 means no limit",
+    )
+    parser.add_argument(
+        "--tenant_max_messages_per_second",
+        type=float,
+        dest="tenant_max_messages_per_second",
+        help="Messages one tenant can publish per second to one worker "
+        "process, 0 means no limit",
+    )
     args = parser.parse_args()
 
     parameters = (
         "debug",
         "log_level",
         "port",
+        "policy_port",
         "host",
         "secret",
         "admin_user",
         "admin_secret",
         "allow_posting_from",
         "allow_cors",
+        "wire_json_backend",
+        "wire_json_compact",
+        "workers",
+        "long_poll_coalesce_window",
+        "long_poll_max_wait",
+        "long_poll_max_batch",
+        "outbound_buffer_size",
+        "outbound_overflow_policy",
+        "cluster_listen",
+        "cluster_peers",
+        "cluster_redis_url",
+        "history_store",
+        "history_flush_interval",
+        "snapshot_path",
+        "snapshot_interval",
+        "tenant_max_connections",
+        "tenant_max_channels",
+        "tenant_max_messages_per_second",
     )
 
     if args.ini:
@@ -124,17 +294,35 @@ def cli_start():
                 config[key] = settings[key]
             except KeyError:
                 pass
+        # [channelstream:tenant:<tenant id>] sections hold secret and quotas
+        for section in parser.sections():
+            if section.startswith(TENANT_SECTION_PREFIX):
+                tenant_id = section[len(TENANT_SECTION_PREFIX) :]
+                config["tenants"][tenant_id] = dict(parser.items(section))
     else:
         for key in parameters:
             conf_value = getattr(args, key)
-            if conf_value:
+            if conf_value is not None:
                 config[key] = conf_value
 
     # convert types
     config["debug"] = asbool(config["debug"])
     config["port"] = int(config["port"])
+    config["policy_port"] = int(config["policy_port"])
+    config["wire_json_compact"] = asbool(config["wire_json_compact"])
+    config["workers"] = max(1, int(config["workers"]))
+    config["long_poll_coalesce_window"] = float(config["long_poll_coalesce_window"])
+    config["long_poll_max_wait"] = float(config["long_poll_max_wait"])
+    config["long_poll_max_batch"] = max(1, int(config["long_poll_max_batch"]))
+    config["history_flush_interval"] = float(config["history_flush_interval"])
+    config["snapshot_interval"] = float(config["snapshot_interval"])
+    config["tenant_max_connections"] = int(config["tenant_max_connections"])
+    config["tenant_max_channels"] = int(config["tenant_max_channels"])
+    config["tenant_max_messages_per_second"] = float(
+        config["tenant_max_messages_per_second"]
+    )
 
-    for key in ["allow_posting_from", "allow_cors"]:
+    for key in ["allow_posting_from", "allow_cors", "cluster_peers"]:
         if not config[key]:
             continue
         try:
@@ -146,13 +334,21 @@ def cli_start():
     log_level = getattr(logging, config.get("log_level", "INFO").upper())
     logging.basicConfig(level=log_level)
     log.info("Starting channelstream {}".format(channelstream.__version__))
+    patched_json.configure_wire_encoding(
+        config["wire_json_backend"], compact=config["wire_json_compact"]
+    )
+    outbound.configure_outbound(
+        config["outbound_buffer_size"], config["outbound_overflow_policy"]
+    )
+    tenants.configure_tenants(config)
     url = "http://{}:{}".format(config["host"], config["port"])
 
-    log.info("Starting flash policy server on port 10843")
-    gc_conns_forever()
-    gc_users_forever()
-    server = StreamServer(("0.0.0.0", 10843), client_handle)
-    server.start()
+    if config["policy_port"]:
+        log.info(
+            "Starting flash policy server on port {}".format(config["policy_port"])
+        )
+        server = StreamServer(("0.0.0.0", config["policy_port"]), client_handle)
+        server.start()
     log.info("Serving on {}".format(url))
     log.info("Admin interface available on {}/admin".format(url))
     if config["secret"] == "secret":
@@ -160,9 +356,147 @@ def cli_start():
     if config["admin_secret"] == "admin_secret":
         log.warning("Using default admin secret! Remember to set that for production.")
 
+    # workers of one node share node id and listening socket for peers
+    config["cluster_node_id"] = uuid.uuid4().hex
+    cluster_listener = None
+    if config["cluster_listen"] and not config["cluster_redis_url"]:
+        cluster_listener = make_listener(
+            *cluster.parse_address(config["cluster_listen"])
+        )
+        log.info("Cluster peers connect on {}".format(config["cluster_listen"]))
+
+    if config["workers"] > 1:
+        start_workers(config, cluster_listener)
+    else:
+        serve(config, (config["host"], config["port"]), cluster_listener)
+
+
+def start_cluster(config, cluster_listener):
+    """
+    Connects this node to other channelstream nodes if configured
+    :param config:
+    :param cluster_listener: bound listening socket for TCP transport
+    :return:
+    """
+    node_id = config["cluster_node_id"]
+    if config["cluster_redis_url"]:
+        # every worker subscribes to Redis on its own
+        node = cluster.RedisClusterNode(
+            node_id, replication.apply_relayed_messages, config["cluster_redis_url"]
+        )
+    elif cluster_listener is not None:
+        peers = [cluster.parse_address(peer) for peer in config["cluster_peers"]]
+        node = cluster.TCPClusterNode(
+            node_id, replication.receive_relayed_messages, cluster_listener, peers
+        )
+    else:
+        return
+    cluster.configure_cluster(node)
+    node.start()
+
+
+def start_history_store(config, read_only=False):
+    """
+    Starts persisting channel history if configured
+    :param config:
+    :param read_only: process only loads history written by another worker
+    :return:
+    """
+    if not config["history_store"]:
+        return
+    store = history_store.make_store(
+        config["history_store"], flush_interval=config["history_flush_interval"]
+    )
+    store.read_only = read_only
+    history_store.configure_history_store(store)
+    store.start()
+
+
+def serve(config, listener, cluster_listener=None, worker_id=0):
+    """
+    Runs background tasks and serves the application
+    :param config:
+    :param listener: address tuple or already bound listening socket
+    :param cluster_listener: listening socket for cluster peers
+    :param worker_id: workers hold the same state so only first one
+                      writes history and snapshots
+    :return:
+    """
+    start_history_store(config, read_only=worker_id != 0)
+    # restored after history store is set up so channels can load history
+    if config["snapshot_path"]:
+        snapshot.restore_from_file(config["snapshot_path"])
+        if worker_id == 0 and config["snapshot_interval"] > 0:
+            gevent.spawn(
+                snapshot.snapshot_forever,
+                config["snapshot_path"],
+                config["snapshot_interval"],
+            )
+    start_cluster(config, cluster_listener)
+    # every tenant gets its own garbage collection and heartbeats
+    tenants.start_background_tasks()
     server = WSGIServer(
-        (config["host"], config["port"]),
+        listener,
         RoutingApplication(config),
         log=logging.getLogger("channelstream.WSGIServer"),
     )
+    gevent.signal(signal.SIGTERM, server.stop)
+    gevent.signal(signal.SIGINT, server.stop)
     server.serve_forever()
+    # records collected since last write
+    if history_store.STORE is not None:
+        history_store.STORE.close()
+    if config["snapshot_path"] and worker_id == 0:
+        snapshot.write_snapshot(config["snapshot_path"])
+
+
+def make_listener(host, port, backlog=1024):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+def start_workers(config, cluster_listener=None):
+    """
+    Pre-forks worker processes that accept connections from one shared
+    listening socket, the master process relays state changes between
+    workers over unix sockets until all of them exit
+    :param config:
+    :return:
+    """
+    listener = make_listener(config["host"], config["port"])
+    pids = []
+    master_socks = []
+    for worker_id in range(config["workers"]):
+        master_sock, worker_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            for sock in master_socks + [master_sock]:
+                sock.close()
+            worker_bus = bus.WorkerBus(worker_sock, replication.apply_event)
+            bus.configure_bus(worker_bus)
+            worker_bus.start()
+            log.info("Worker {} started with pid {}".format(worker_id, os.getpid()))
+            serve(config, listener, cluster_listener, worker_id)
+            os._exit(0)
+        worker_sock.close()
+        pids.append(pid)
+        master_socks.append(master_sock)
+    listener.close()
+    if cluster_listener is not None:
+        cluster_listener.close()
+
+    def stop_workers():
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    gevent.signal(signal.SIGTERM, stop_workers)
+    gevent.signal(signal.SIGINT, stop_workers)
+    bus.BusHub(master_socks).serve_forever()
+    for pid in pids:
+        os.waitpid(pid, 0)
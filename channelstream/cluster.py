@@ -0,0 +1,355 @@
+"""
+Relays messages between channelstream nodes.
+
+Messages are routed by key - `("channel", name)` for channel messages and
+`("user", username)` for private ones. Every node advertises keys it has
+local connections for and only receives traffic for those. Keys of tenants
+other than the default one carry tenant id in their kind, for example
+`("channel@acme", name)`, so tenants never receive each other's messages.
+"""
+import json
+import logging
+import socket
+import uuid
+
+import gevent
+import six
+from dateutil import parser as date_parser
+from gevent.server import StreamServer
+
+from channelstream.bus import HEADER, SocketWriter, read_frames
+from channelstream.patched_json import ComplexEncoder
+from channelstream.server_state import DEFAULT_TENANT
+
+log = logging.getLogger(__name__)
+
+# cluster node used by this process, only set when clustering is configured
+NODE = None
+
+_encoder = ComplexEncoder(separators=(",", ":"))
+
+
+def configure_cluster(node):
+    global NODE
+    NODE = node
+
+
+def routing_kind(kind, tenant_id):
+    if tenant_id == DEFAULT_TENANT:
+        return kind
+    return "{}@{}".format(kind, tenant_id)
+
+
+def split_routing_kind(kind):
+    """
+    Reverses `routing_kind()`
+    :param kind:
+    :return: kind and tenant id
+    """
+    kind, _, tenant_id = kind.partition("@")
+    return kind, tenant_id or DEFAULT_TENANT
+
+
+def relay(kind, name, event, messages, tenant_id=DEFAULT_TENANT):
+    """
+    Sends messages to other nodes interested in `(kind, name)`
+    :param kind: "channel" or "user"
+    :param name: channel name or username
+    :param event: "messages", "edit" or "delete"
+    :param messages:
+    :param tenant_id:
+    :return:
+    """
+    if NODE is not None:
+        NODE.publish(routing_kind(kind, tenant_id), name, event, messages)
+
+
+def interest_added(kind, name, tenant_id=DEFAULT_TENANT):
+    if NODE is not None:
+        NODE.interest_added(routing_kind(kind, tenant_id), name)
+
+
+def interest_removed(kind, name, tenant_id=DEFAULT_TENANT):
+    if NODE is not None:
+        NODE.interest_removed(routing_kind(kind, tenant_id), name)
+
+
+def encode_packet(packet):
+    data = _encoder.encode(packet).encode("utf8")
+    return HEADER.pack(len(data)) + data
+
+
+def decode_packet(data):
+    return json.loads(data.decode("utf8"))
+
+
+def restore_message(message):
+    """
+    Converts values that JSON turned into strings back to python types
+    :param message:
+    :return:
+    """
+    if message.get("uuid"):
+        message["uuid"] = uuid.UUID(message["uuid"])
+    for key in ("timestamp", "edited"):
+        if isinstance(message.get(key), six.string_types):
+            message[key] = date_parser.parse(message[key])
+    return message
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class ClusterNode(object):
+    """
+    Base class of cluster transports
+    """
+
+    def __init__(self, node_id, handler):
+        """
+
+        :param node_id: unique identifier of this node
+        :param handler: callable receiving `kind, name, event, messages`
+                        of messages relayed by other nodes
+        """
+        self.node_id = node_id
+        self.handler = handler
+        # keys this node has local connections for
+        self.interest = set()
+        self.relayed = 0
+        self.received = 0
+
+    def start(self):
+        raise NotImplementedError
+
+    def publish(self, kind, name, event, messages):
+        raise NotImplementedError
+
+    def interest_added(self, kind, name):
+        self.interest.add((kind, name))
+
+    def interest_removed(self, kind, name):
+        self.interest.discard((kind, name))
+
+    def deliver(self, packet):
+        self.received += 1
+        messages = [restore_message(m) for m in packet["messages"]]
+        try:
+            self.handler(packet["kind"], packet["name"], packet["event"], messages)
+        except Exception:
+            log.exception("failed to deliver relayed %s" % packet["event"])
+
+    def get_info(self):
+        return {
+            "node_id": self.node_id,
+            "interest": len(self.interest),
+            "relayed": self.relayed,
+            "received": self.received,
+        }
+
+
+class Peer(object):
+    """
+    Outgoing connection to another node, holds keys that node is interested in
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.interest = set()
+        self.writer = None
+
+
+class TCPClusterNode(ClusterNode):
+    """
+    Nodes are connected with plain TCP, every node connects to all of its
+    peers and uses that connection to send messages, peers reply on the same
+    connection with keys they are interested in
+    """
+
+    def __init__(self, node_id, handler, listener, peers, reconnect_interval=1):
+        """
+
+        :param node_id:
+        :param handler:
+        :param listener: address tuple or bound listening socket
+        :param peers: list of `(host, port)` of other nodes
+        :param reconnect_interval: seconds between connection attempts
+        """
+        super(TCPClusterNode, self).__init__(node_id, handler)
+        self.server = StreamServer(listener, self.handle_peer)
+        self.peers = [Peer(address) for address in peers]
+        self.reconnect_interval = reconnect_interval
+        # writers of incoming connections that receive our interest updates
+        self.subscribers = set()
+
+    def start(self):
+        self.server.start()
+        for peer in self.peers:
+            gevent.spawn(self.connect_forever, peer)
+
+    def publish(self, kind, name, event, messages):
+        key = (kind, name)
+        packet = None
+        for peer in self.peers:
+            if peer.writer is not None and key in peer.interest:
+                if packet is None:
+                    packet = encode_packet(
+                        {
+                            "node": self.node_id,
+                            "kind": kind,
+                            "name": name,
+                            "event": event,
+                            "messages": messages,
+                        }
+                    )
+                peer.writer.put(packet)
+                self.relayed += 1
+
+    def interest_added(self, kind, name):
+        if (kind, name) not in self.interest:
+            super(TCPClusterNode, self).interest_added(kind, name)
+            self.send_interest("add", [(kind, name)])
+
+    def interest_removed(self, kind, name):
+        if (kind, name) in self.interest:
+            super(TCPClusterNode, self).interest_removed(kind, name)
+            self.send_interest("remove", [(kind, name)])
+
+    def send_interest(self, action, keys, writers=None):
+        packet = encode_packet({"interest": action, "keys": list(keys)})
+        for writer in writers or list(self.subscribers):
+            writer.put(packet)
+
+    def handle_peer(self, sock, address):
+        """
+        Incoming connection - we send interest updates and receive messages
+        """
+        writer = SocketWriter(sock)
+        writer.start()
+        self.send_interest("reset", self.interest, writers=[writer])
+        self.subscribers.add(writer)
+        try:
+            for frame in read_frames(sock):
+                self.deliver(decode_packet(frame))
+        except socket.error as exc:
+            log.info("cluster peer {} disconnected: {}".format(address, exc))
+        finally:
+            self.subscribers.discard(writer)
+            writer.greenlet.kill()
+            sock.close()
+
+    def connect_forever(self, peer):
+        """
+        Outgoing connection - we send messages and receive interest updates
+        """
+        while True:
+            try:
+                sock = socket.create_connection(peer.address)
+            except socket.error:
+                gevent.sleep(self.reconnect_interval)
+                continue
+            log.info("connected to cluster peer {}".format(peer.address))
+            peer.writer = SocketWriter(sock)
+            peer.writer.start()
+            try:
+                for frame in read_frames(sock):
+                    self.update_peer_interest(peer, decode_packet(frame))
+            except socket.error as exc:
+                log.info("lost cluster peer {}: {}".format(peer.address, exc))
+            peer.writer.greenlet.kill()
+            peer.writer = None
+            peer.interest = set()
+            sock.close()
+            gevent.sleep(self.reconnect_interval)
+
+    def update_peer_interest(self, peer, packet):
+        keys = set(tuple(key) for key in packet["keys"])
+        if packet["interest"] == "reset":
+            peer.interest = keys
+        elif packet["interest"] == "add":
+            peer.interest.update(keys)
+        elif packet["interest"] == "remove":
+            peer.interest.difference_update(keys)
+
+    def get_info(self):
+        info = super(TCPClusterNode, self).get_info()
+        info["peers"] = [
+            {
+                "address": "{}:{}".format(*peer.address),
+                "connected": peer.writer is not None,
+                "interest": len(peer.interest),
+            }
+            for peer in self.peers
+        ]
+        return info
+
+
+class RedisClusterNode(ClusterNode):
+    """
+    Nodes exchange messages through Redis pub/sub, every routing key maps
+    to Redis channel, so Redis only sends a node traffic it subscribed to
+    """
+
+    def __init__(self, node_id, handler, url, prefix="channelstream"):
+        """
+
+        :param node_id:
+        :param handler:
+        :param url: redis connection url
+        :param prefix: prefix of Redis channel names
+        """
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("Redis cluster transport requires `redis` package")
+        super(RedisClusterNode, self).__init__(node_id, handler)
+        self.redis = redis.StrictRedis.from_url(url)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.prefix = prefix
+        # pubsub connection is only used from the listening greenlet
+        self.pending = []
+
+    def redis_channel(self, kind, name):
+        return "{}:{}:{}".format(self.prefix, kind, name)
+
+    def start(self):
+        gevent.spawn(self.listen_forever)
+
+    def publish(self, kind, name, event, messages):
+        data = _encoder.encode(
+            {
+                "node": self.node_id,
+                "kind": kind,
+                "name": name,
+                "event": event,
+                "messages": messages,
+            }
+        )
+        self.redis.publish(self.redis_channel(kind, name), data)
+        self.relayed += 1
+
+    def interest_added(self, kind, name):
+        super(RedisClusterNode, self).interest_added(kind, name)
+        self.pending.append(("subscribe", self.redis_channel(kind, name)))
+
+    def interest_removed(self, kind, name):
+        super(RedisClusterNode, self).interest_removed(kind, name)
+        self.pending.append(("unsubscribe", self.redis_channel(kind, name)))
+
+    def listen_forever(self):
+        while True:
+            pending, self.pending = self.pending, []
+            for action, channel in pending:
+                getattr(self.pubsub, action)(channel)
+            if not self.pubsub.subscribed:
+                gevent.sleep(0.1)
+                continue
+            message = self.pubsub.get_message(timeout=0.1)
+            if message is None or message["type"] != "message":
+                continue
+            packet = json.loads(message["data"].decode("utf8"))
+            # our own messages come back from Redis
+            if packet["node"] != self.node_id:
+                self.deliver(packet)
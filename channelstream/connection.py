@@ -1,11 +1,10 @@
 import logging
 from datetime import datetime, timedelta
 
-import gevent
-import six
-
-from channelstream import patched_json as json
-from channelstream.server_state import get_state
+from channelstream import bus
+from channelstream.frames import HEARTBEAT_FRAME, encode_frame
+from channelstream.outbound import LongPollBuffer, WebsocketWriter
+from channelstream.server_state import DEFAULT_TENANT, get_state
 
 log = logging.getLogger(__name__)
 
@@ -13,14 +12,25 @@ log = logging.getLogger(__name__)
 class Connection(object):
     """ Represents a client connection"""
 
-    def __init__(self, username, conn_id):
+    def __init__(self, username, conn_id, tenant_id=DEFAULT_TENANT):
         self.username = username  # hold user id/name of connection
+        self.tenant_id = tenant_id
         self.last_active = None
         self.socket = None
+        # sends frames to websocket from separate greenlet
+        self.writer = None
         self.queue = None
         self.id = conn_id
+        # owner object set when connection gets attached to user
+        self.user = None
+        # names of channels connection is subscribed to
+        self.channel_names = set()
+        # socket or queue of connection is served by another worker process
+        self.remote = False
+        # how many times outbound buffer of connection overflowed
+        self.overflows = 0
         self.mark_activity()
-        gevent.spawn_later(5, self.heartbeat)
+        get_state(tenant_id).connection_expiry.track(self)
 
     def __repr__(self):
         return "<Connection: id:%s, owner:%s>" % (self.id, self.username)
@@ -28,58 +38,162 @@ class Connection(object):
     def mark_activity(self):
         self.last_active = datetime.utcnow()
 
-    def add_message(self, message=None):
-        server_state = get_state()
-        """ Sends the message to the client connection """
+    def add_message(self, message=None, frame=None):
+        """
+        Sends the message to the client connection, `frame` is an already
+        encoded payload that can be shared by all recipients of a broadcast
+        """
+        if frame is None:
+            frame = encode_frame([message] if message else [])
         # handle websockets
         if self.socket and self.socket.terminated:
             self.mark_for_gc()
         elif self.socket and not self.socket.terminated:
-            try:
-                # payload needs to be converted to JSON now as it gets
-                # piped to client
-                self.socket.send(json.dumps([message] if message else []))
-                self.mark_activity()
-                server_state.users[self.username].mark_activity()
-            except Exception as exc:
-                log.info(exc)
-                self.mark_for_gc()
-        elif self.queue:
+            # writer greenlet does the sending, publisher does not wait for it
+            if self.writer is None:
+                self.writer = WebsocketWriter(self)
+            self.writer.put(frame)
+        elif self.queue is not None:
             # handle long polling
-            # payload will be converted to JSON in WSGI response
-            self.queue.put([message] if message else [])
+            # frames will be joined into single response in WSGI app
+            self.queue.put(frame)
+
+    def attached_locally(self):
+        """
+        Starts serving connection from this process after socket or queue
+        got attached to it
+        :return:
+        """
+        server_state = get_state(self.tenant_id)
+        if self.remote:
+            self.remote = False
+            server_state.connection_expiry.track(self)
+        server_state.heartbeats.add(self)
+        bus.publish("attach", conn_id=self.id, tenant_id=self.tenant_id)
+
+    def attached_elsewhere(self):
+        """
+        Another worker process serves the connection now, so the local replica
+        neither gets heartbeats nor is garbage collected on its own - frames
+        waiting in long polling buffer are handed over to that worker
+        :return:
+        """
+        server_state = get_state(self.tenant_id)
+        self.remote = True
+        if isinstance(self.queue, LongPollBuffer):
+            unacknowledged, frames = self.queue.hand_over()
+            if unacknowledged or frames:
+                bus.publish(
+                    "handover",
+                    conn_id=self.id,
+                    tenant_id=self.tenant_id,
+                    unacknowledged=unacknowledged,
+                    frames=frames,
+                )
+        self.queue = None
+        server_state.heartbeats.remove(self)
+        server_state.connection_expiry.discard(self)
+
+    def buffer_overflowed(self, buffer, dropped):
+        """
+        Records overflow of outbound buffer, closes connection
+        if the buffer policy says so
+        :param buffer:
+        :param dropped: number of discarded frames
+        :return:
+        """
+        self.overflows += 1
+        stats = get_state(self.tenant_id).outbound_stats
+        stats["overflows"] += 1
+        stats["dropped_frames"] += dropped
+        if buffer.closed:
+            stats["disconnected"] += 1
+            log.info("%s disconnected, outbound buffer is full" % self)
+            self.mark_for_gc()
+            if self.socket:
+                self.socket.close()
 
     def mark_for_gc(self):
         # set last active time for connection 1 hour in past for GC
         self.last_active -= timedelta(days=60)
+        server_state = get_state(self.tenant_id)
+        server_state.heartbeats.remove(self)
+        server_state.connection_expiry.track(self)
 
     def heartbeat(self):
-        if self.socket or self.queue:
-            try:
-                self.add_message()
-                gevent.spawn_later(5, self.heartbeat)
-            except Exception:
-                self.mark_for_gc()
-                if self.socket:
-                    self.socket.close()
-
-    def get_catchup_messages(self):
-        server_state = get_state()
+        """
+        Sends empty payload to the client
+        :return: False if connection should not receive heartbeats anymore
+        """
+        if self.socket and self.socket.terminated:
+            return False
+        if not self.socket and not self.queue:
+            return False
+        try:
+            self.add_message(frame=HEARTBEAT_FRAME)
+        except Exception:
+            self.mark_for_gc()
+            if self.socket:
+                self.socket.close()
+            return False
+        return True
+
+    def get_catchup_messages(self, resume=None):
+        """
+        Returns messages published since client was last active
+        :param resume: parsed resume token - sequence numbers of last
+                       messages client received, catchup starts right after
+                       them instead of relying on activity time
+        :return:
+        """
+        server_state = get_state(self.tenant_id)
+        resume = resume or {}
+        channel_seqs = resume.get("channels") or {}
         messages = []
         # return catchup messages for channels
         for channel in self.channels:
-            channel_inst = server_state.channels[channel]
+            channel_inst = server_state.channels.get(channel)
+            if not channel_inst:
+                continue
             messages.extend(
-                channel_inst.get_catchup_frames(self.last_active, self.username)
+                channel_inst.get_catchup_frames(
+                    self.last_active, self.username, channel_seqs.get(channel)
+                )
             )
         # and users
         messages.extend(
-            server_state.users[self.username].get_catchup_frames(self.last_active)
+            server_state.users[self.username].get_catchup_frames(
+                self.last_active, resume.get("user")
+            )
         )
         return messages
 
-    def deliver_catchup_messages(self):
-        [self.add_message(m) for m in self.get_catchup_messages()]
+    def deliver_catchup_messages(self, resume=None):
+        messages = self.get_catchup_messages(resume)
+        if messages:
+            self.add_message(frame=encode_frame(messages))
+
+    def joined_channel(self, channel_name):
+        """
+        Updates channel index of connection and its owner
+        :param channel_name:
+        :return:
+        """
+        if channel_name not in self.channel_names:
+            self.channel_names.add(channel_name)
+            if self.user is not None:
+                self.user.channel_joined(channel_name)
+
+    def parted_channel(self, channel_name):
+        """
+        Removes channel from index of connection and its owner
+        :param channel_name:
+        :return:
+        """
+        if channel_name in self.channel_names:
+            self.channel_names.remove(channel_name)
+            if self.user is not None:
+                self.user.channel_parted(channel_name)
 
     @property
     def channels(self):
@@ -87,13 +201,7 @@ class Connection(object):
         Return list of channels names connection belongs to
         :return:
         """
-        server_state = get_state()
-        found_channels = []
-        for channel in six.itervalues(server_state.channels):
-            user_conns = channel.connections.get(self.username) or []
-            if self in user_conns:
-                found_channels.append(channel.name)
-        return sorted(found_channels)
+        return sorted(self.channel_names)
 
     def __json__(self):
         return self.id
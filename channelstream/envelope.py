@@ -0,0 +1,85 @@
+import six
+
+DELIVERY_KEYS = ("no_history", "pm_users", "exclude_users")
+
+
+class Envelope(object):
+    """
+    Message passing through the server. `payload` is what clients receive,
+    it is shared between recipients and stored frames, so it is never
+    modified in place - edits replace it with an updated copy.
+    Delivery information is kept next to the payload so it never has to be
+    stripped before sending.
+    """
+
+    __slots__ = ("payload", "pm_users", "exclude_users", "no_history")
+
+    def __init__(self, payload, pm_users=None, exclude_users=None, no_history=False):
+        self.payload = payload
+        self.pm_users = pm_users or []
+        self.exclude_users = exclude_users or []
+        self.no_history = no_history
+
+    @classmethod
+    def from_message(cls, message, seq=None):
+        """
+        Splits message dictionary into payload and delivery information,
+        values are not copied
+        :param message:
+        :param seq: sequence number of stored frame, set in payload
+        :return:
+        """
+        payload = {k: v for k, v in six.iteritems(message) if k not in DELIVERY_KEYS}
+        if seq is not None:
+            payload["seq"] = seq
+        return cls(
+            payload,
+            pm_users=message.get("pm_users"),
+            exclude_users=message.get("exclude_users"),
+            no_history=message.get("no_history", False),
+        )
+
+    def __repr__(self):
+        return "<Envelope: %s %s>" % (
+            self.payload.get("type"),
+            self.payload.get("uuid"),
+        )
+
+    def __getitem__(self, key):
+        return self.payload[key]
+
+    def __contains__(self, key):
+        return key in self.payload
+
+    def get(self, key, default=None):
+        return self.payload.get(key, default)
+
+    def update(self, changes):
+        """
+        Replaces payload with a copy that includes `changes`
+        :param changes:
+        :return:
+        """
+        payload = dict(self.payload)
+        payload.update(changes)
+        self.payload = payload
+
+    def is_visible_to(self, username):
+        # user is excluded or PM not meant for user
+        if self.exclude_users and username in self.exclude_users:
+            return False
+        if self.pm_users and username not in self.pm_users:
+            return False
+        return True
+
+    def catchup_view(self):
+        """
+        Payload marked as delivered during catchup
+        :return:
+        """
+        payload = dict(self.payload)
+        payload["catchup"] = True
+        return payload
+
+    def __json__(self, request=None):
+        return self.payload
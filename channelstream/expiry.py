@@ -0,0 +1,93 @@
+import heapq
+from datetime import datetime
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class ExpiryIndex(object):
+    """
+    Groups connections into time buckets keyed by their last known activity,
+    so garbage collection only needs to look at buckets older than the
+    threshold instead of every connection on the server
+    """
+
+    def __init__(self, resolution=1):
+        """
+
+        :param resolution: width of a single bucket in seconds
+        """
+        self.resolution = resolution
+        # bucket key -> set of connections
+        self.buckets = {}
+        # heap of bucket keys, oldest first
+        self.keys = []
+        # connection -> bucket key
+        self.slots = {}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def bucket_key(self, when):
+        return int((when - EPOCH).total_seconds() // self.resolution)
+
+    def track(self, connection):
+        """
+        Places connection in bucket matching its `last_active` time
+        :param connection:
+        :return:
+        """
+        key = self.bucket_key(connection.last_active)
+        old_key = self.slots.get(connection)
+        if old_key == key:
+            return
+        if old_key is not None:
+            self._remove_from_bucket(connection, old_key)
+        if key not in self.buckets:
+            self.buckets[key] = set()
+            heapq.heappush(self.keys, key)
+        self.buckets[key].add(connection)
+        self.slots[connection] = key
+
+    def discard(self, connection):
+        key = self.slots.pop(connection, None)
+        if key is not None:
+            self._remove_from_bucket(connection, key)
+
+    def _remove_from_bucket(self, connection, key):
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket.discard(connection)
+            # empty bucket keys are dropped lazily from the heap
+            if not bucket:
+                del self.buckets[key]
+
+    def pop_expired(self, threshold, limit):
+        """
+        Returns connections inactive since before `threshold`, looking at no
+        more than `limit` connections. Connections that were active since
+        they were indexed are moved to bucket matching their activity.
+
+        :param threshold:
+        :param limit:
+        :return: list of expired connections and number of checked ones
+        """
+        threshold_key = self.bucket_key(threshold)
+        expired = []
+        checked = 0
+        while self.keys and checked < limit:
+            key = self.keys[0]
+            if key >= threshold_key:
+                break
+            bucket = self.buckets.get(key)
+            if not bucket:
+                heapq.heappop(self.keys)
+                self.buckets.pop(key, None)
+                continue
+            connection = bucket.pop()
+            del self.slots[connection]
+            checked += 1
+            if connection.last_active < threshold:
+                expired.append(connection)
+            else:
+                self.track(connection)
+        return expired, checked
@@ -0,0 +1,25 @@
+from channelstream import patched_json as json
+
+HEARTBEAT_FRAME = b"[]"
+
+
+def encode_frame(messages):
+    """
+    Encodes list of messages into JSON payload that gets piped to clients,
+    resulting bytes are immutable and can be shared between connections
+    :param messages:
+    :return:
+    """
+    return json.wire_dumps(messages)
+
+
+def join_frames(frames):
+    """
+    Merges multiple encoded frames into single JSON list without
+    decoding them again
+    :param frames:
+    :return:
+    """
+    # strip the enclosing brackets, empty heartbeat frames carry no messages
+    parts = [f[1:-1].strip() for f in frames]
+    return b"[" + b",".join([p for p in parts if p]) + b"]"
@@ -1,66 +1,157 @@
 import logging
+import time
 from datetime import datetime, timedelta
 
 import gevent
 import six
 
+from channelstream import bus, metrics
+from channelstream.locks import connection_keys, user_key
+from channelstream.outbound import OutboundBuffer
 from channelstream.server_state import get_state
 
 log = logging.getLogger(__name__)
 
+# how many connections are examined before yielding to other greenlets
+GC_SLICE_SIZE = 500
 
-def gc_conns():
-    server_state = get_state()
-    with server_state.lock:
-        start_time = datetime.utcnow()
-        threshold = start_time - timedelta(seconds=15)
-        collected_conns = []
-        # collect every ref in chanels
-        # remove connections from channels
-        for channel in six.itervalues(server_state.channels):
-            for username, conns in list(channel.connections.items()):
-                for conn in conns:
-                    if conn.last_active < threshold:
-                        channel.connections[username].remove(conn)
-                        collected_conns.append(conn)
-                channel.after_parted(username)
-        # remove old conns from users and connection dictionaries
-        for conn in collected_conns:
-            if conn.username in server_state.users:
-                if conn in server_state.users[conn.username].connections:
-                    server_state.users[conn.username].connections.remove(conn)
-            if conn.id in server_state.connections:
-                del server_state.connections[conn.id]
-            # make sure connection is closed after we garbage
-            # collected it from our list
-            if conn.socket:
-                try:
-                    conn.socket.close()
-                except Exception:
-                    raise
-        log.debug("gc_conns() time %s" % (datetime.utcnow() - start_time))
-
-
-def gc_users():
-    server_state = get_state()
-    with server_state.lock:
-        start_time = datetime.utcnow()
-        threshold = datetime.utcnow() - timedelta(days=1)
-        for user in list(six.itervalues(server_state.users)):
-            if user.last_active < threshold:
-                server_state.users.pop(user.username)
-        log.debug("gc_users() time %s" % (datetime.utcnow() - start_time))
-
-
-def gc_users_forever():
+
+def collect_connection(conn):
+    """
+    Removes connection from its channels, owner and server registries
+    :param conn:
+    :return:
+    """
+    server_state = get_state(conn.tenant_id)
+    for channel_name in list(conn.channel_names):
+        channel = server_state.channels.get(channel_name)
+        if channel:
+            channel.remove_connection(conn)
+        else:
+            conn.parted_channel(channel_name)
+    if conn.user is not None:
+        conn.user.remove_connection(conn)
+    elif conn.username in server_state.users:
+        server_state.users[conn.username].remove_connection(conn)
+    if server_state.connections.get(conn.id) is conn:
+        del server_state.connections[conn.id]
+    server_state.heartbeats.remove(conn)
+    server_state.connection_expiry.discard(conn)
+    if conn.writer is not None:
+        conn.writer.stop()
+        # frames nobody is going to send must not count as queued
+        conn.writer.buffer.drain()
+    if isinstance(conn.queue, OutboundBuffer):
+        conn.queue.drain()
+    # make sure connection is closed after we garbage
+    # collected it from our list
+    if conn.socket:
+        try:
+            conn.socket.close()
+        except Exception:
+            raise
+
+
+def collect_connection_locked(conn):
+    """
+    Collects connection holding locks of its user and channels
+    :param conn:
+    :return:
+    """
+    server_state = get_state(conn.tenant_id)
+    while True:
+        lock_keys = connection_keys(conn)
+        with server_state.locks.hold(lock_keys):
+            # subscriptions could change while we waited for the locks
+            if connection_keys(conn) == lock_keys:
+                collect_connection(conn)
+                return
+
+
+def gc_conns(slice_size=GC_SLICE_SIZE, server_state=None):
+    """
+    Collects connections inactive for more than 15 seconds, only
+    connections from expired buckets of the expiry index are examined and
+    the work is split into slices that yield to other greenlets in between,
+    every connection is collected holding only locks of its user and channels
+    """
+    server_state = server_state or get_state()
+    start_time = time.time()
+    threshold = datetime.utcnow() - timedelta(seconds=15)
+    collected = 0
+    checked = 0
+    slices = 0
+    while True:
+        expired, examined = server_state.connection_expiry.pop_expired(
+            threshold, slice_size
+        )
+        for conn in expired:
+            collect_connection_locked(conn)
+            bus.publish("collect", conn_id=conn.id, tenant_id=conn.tenant_id)
+        collected += len(expired)
+        checked += examined
+        slices += 1
+        if examined < slice_size:
+            break
+        gevent.sleep(0)
+    duration = time.time() - start_time
+    metrics.GC_CONNECTIONS.observe(duration)
+    server_state.gc_stats.update(
+        {
+            "conns_last_run": datetime.utcnow(),
+            "conns_duration": duration,
+            "conns_checked": checked,
+            "conns_collected": collected,
+            "conns_slices": slices,
+        }
+    )
+    log.debug(
+        "gc_conns() time %s, checked %s, collected %s" % (duration, checked, collected)
+    )
+
+
+def gc_users(slice_size=GC_SLICE_SIZE, server_state=None):
+    """
+    Collects users inactive for a day, yields to other greenlets after
+    every `slice_size` users
+    """
+    server_state = server_state or get_state()
+    start_time = time.time()
+    threshold = datetime.utcnow() - timedelta(days=1)
+    collected = 0
+    for checked, user in enumerate(list(six.itervalues(server_state.users)), 1):
+        if checked % slice_size == 0:
+            gevent.sleep(0)
+        if user.last_active < threshold:
+            with server_state.locks.hold([user_key(user.username)]):
+                # user could reconnect while we waited for the lock
+                if (
+                    user.last_active < threshold
+                    and server_state.users.get(user.username) is user
+                ):
+                    del server_state.users[user.username]
+                    collected += 1
+    duration = time.time() - start_time
+    metrics.GC_USERS.observe(duration)
+    server_state.gc_stats.update(
+        {
+            "users_last_run": datetime.utcnow(),
+            "users_duration": duration,
+            "users_collected": collected,
+        }
+    )
+    log.debug("gc_users() time %s" % duration)
+
+
+def gc_users_forever(server_state=None):
     try:
-        gc_users()
+        gc_users(server_state=server_state)
     finally:
-        gevent.spawn_later(60, gc_users_forever)
+        gevent.spawn_later(60, gc_users_forever, server_state)
 
 
-def gc_conns_forever():
+def gc_conns_forever(server_state=None):
     try:
-        gc_conns()
+        gc_conns(server_state=server_state)
     finally:
-        gevent.spawn_later(1, gc_conns_forever)
+        gevent.spawn_later(1, gc_conns_forever, server_state)
@@ -0,0 +1,102 @@
+import logging
+import time
+
+import gevent
+
+from channelstream import metrics
+
+log = logging.getLogger(__name__)
+
+
+class HeartbeatScheduler(object):
+    """
+    Central heartbeat timer wheel - connections are spread over buckets and
+    every tick sends heartbeats to the connections of a single bucket, so each
+    connection gets a heartbeat once per `interval` seconds
+    """
+
+    def __init__(self, interval=5, tick_interval=1, batch_size=500):
+        """
+
+        :param interval: seconds between heartbeats of single connection
+        :param tick_interval: seconds between processing of buckets
+        :param batch_size: how many sends happen before yielding to other
+                           greenlets
+        """
+        self.interval = interval
+        self.tick_interval = tick_interval
+        self.batch_size = batch_size
+        self.buckets = [set() for _ in range(max(1, int(interval / tick_interval)))]
+        self.position = 0
+        # connection -> index of bucket holding it
+        self.slots = {}
+        self.ticks = 0
+        self.last_tick_duration = 0.0
+        self.last_tick_sent = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, connection):
+        """
+        Starts sending heartbeats to connection, the first one is sent
+        after a full rotation of the wheel
+        :param connection:
+        :return:
+        """
+        if connection in self.slots:
+            return
+        index = (self.position - 1) % len(self.buckets)
+        self.buckets[index].add(connection)
+        self.slots[connection] = index
+
+    def remove(self, connection):
+        """
+        Stops tracking the connection
+        :param connection:
+        :return:
+        """
+        index = self.slots.pop(connection, None)
+        if index is not None:
+            self.buckets[index].discard(connection)
+
+    def tick(self):
+        """
+        Sends heartbeats to all connections in current bucket
+        :return: number of heartbeats sent
+        """
+        start_time = time.time()
+        bucket = self.buckets[self.position]
+        self.position = (self.position + 1) % len(self.buckets)
+        sent = 0
+        for connection in list(bucket):
+            if connection not in self.slots:
+                # removed while we yielded
+                continue
+            if not connection.heartbeat():
+                self.remove(connection)
+                continue
+            sent += 1
+            if sent % self.batch_size == 0:
+                gevent.sleep(0)
+        self.ticks += 1
+        self.last_tick_sent = sent
+        self.last_tick_duration = time.time() - start_time
+        metrics.HEARTBEAT_TICK.observe(self.last_tick_duration)
+        metrics.HEARTBEATS_SENT.inc(sent)
+        log.debug("heartbeat tick: sent %s in %s" % (sent, self.last_tick_duration))
+        return sent
+
+    def tick_forever(self):
+        try:
+            self.tick()
+        finally:
+            gevent.spawn_later(self.tick_interval, self.tick_forever)
+
+    def get_info(self):
+        return {
+            "tracked_connections": len(self.slots),
+            "ticks": self.ticks,
+            "last_tick_duration": self.last_tick_duration,
+            "last_tick_sent": self.last_tick_sent,
+        }
@@ -0,0 +1,377 @@
+"""
+Persists channel history and catchup frames so they survive restarts.
+
+Channels append records describing stored messages, edits and deletions.
+Records are only collected in memory on the publishing path, a background
+greenlet writes them in batches - every batch is one write and fsync per
+file, or one SQLite transaction, done in a thread pool so the event loop
+keeps serving clients. Operations that fail to write are kept and retried
+with the next batch. Records of a channel are read back when the channel
+gets created for the first time after a restart.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import uuid
+from collections import OrderedDict
+
+import gevent
+import six
+from dateutil import parser as date_parser
+from gevent.event import Event
+from gevent.lock import Semaphore
+
+from channelstream.cluster import restore_message
+from channelstream.patched_json import ComplexEncoder
+
+log = logging.getLogger(__name__)
+
+# store used by this process, only set when persistence is configured
+STORE = None
+
+# seconds between writes of collected records
+FLUSH_INTERVAL = 0.05
+# number of collected records that triggers a write right away
+BATCH_SIZE = 1000
+
+_encoder = ComplexEncoder(separators=(",", ":"))
+
+
+def configure_history_store(store):
+    global STORE
+    STORE = store
+
+
+def make_store(url, flush_interval=FLUSH_INTERVAL):
+    """
+    Creates store from `file:<directory>` or `sqlite:<database path>`
+    :param url:
+    :param flush_interval:
+    :return:
+    """
+    backend, _, path = url.partition(":")
+    if backend == "file" and path:
+        return FileHistoryStore(path, flush_interval=flush_interval)
+    if backend == "sqlite" and path:
+        return SQLiteHistoryStore(path, flush_interval=flush_interval)
+    raise ValueError(
+        "Unknown history store {}, use file:<directory> or sqlite:<path>".format(url)
+    )
+
+
+def persist(channel_name, record):
+    if STORE is not None:
+        STORE.append(channel_name, record)
+
+
+def rewrite(channel_name, records):
+    if STORE is not None:
+        STORE.rewrite(channel_name, records)
+
+
+def load(channel_name):
+    if STORE is None:
+        return []
+    return STORE.load(channel_name)
+
+
+def encode_record(record):
+    return _encoder.encode(record).encode("utf8")
+
+
+def encode_records(channel_name, records):
+    """
+    Encodes records of channel, records that can not be encoded are dropped
+    one by one instead of failing the whole batch
+    :param channel_name:
+    :param records:
+    :return:
+    """
+    for record in records:
+        try:
+            yield encode_record(record)
+        except Exception:
+            log.exception("dropping history record of %s" % channel_name)
+
+
+def decode_record(data):
+    """
+    Converts record read from storage back to python types
+    :param data:
+    :return:
+    """
+    record = json.loads(data.decode("utf8"))
+    if record["op"] == "add":
+        restore_message(record["payload"])
+        if record.get("time"):
+            record["time"] = date_parser.parse(record["time"])
+    elif record["op"] == "edit":
+        record["uuid"] = uuid.UUID(record["uuid"])
+        restore_message(record["changes"])
+    elif record["op"] == "delete":
+        record["uuid"] = uuid.UUID(record["uuid"])
+    return record
+
+
+class HistoryStore(object):
+    """
+    Base class of storage backends, subclasses implement `write_batch()`
+    and `read_records()` that run in a thread pool
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE):
+        """
+
+        :param flush_interval: seconds between writes
+        :param batch_size: number of waiting records that triggers a write
+        """
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # (operation, channel name, record or list of records)
+        self.pending = []
+        self.wakeup = Event()
+        self.lock = Semaphore()
+        self.greenlet = None
+        # set in processes that only read records other process writes
+        self.read_only = False
+        self.writes = 0
+        self.written = 0
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.flush_forever)
+
+    def close(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+        self.flush()
+
+    def append(self, channel_name, record):
+        if self.read_only:
+            return
+        self.pending.append(("append", channel_name, record))
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    def rewrite(self, channel_name, records):
+        """
+        Replaces all records of channel, used to compact its log
+        :param channel_name:
+        :param records:
+        :return:
+        """
+        if self.read_only:
+            return
+        self.pending.append(("rewrite", channel_name, records))
+
+    def flush_forever(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        try:
+            failed = gevent.get_hub().threadpool.apply(self.write_batch, (batch,))
+        except Exception:
+            log.exception("failed to persist %s history records" % len(batch))
+            failed = batch
+        # operations that were not written are retried with next flush,
+        # ahead of the ones collected meanwhile
+        self.pending[:0] = failed
+        if len(failed) < len(batch):
+            self.writes += 1
+            self.written += len(batch) - len(failed)
+
+    def load(self, channel_name):
+        """
+        Returns records of channel in the order they were written
+        :param channel_name:
+        :return:
+        """
+        with self.lock:
+            # records still waiting in memory have to be read back too
+            self._flush()
+            try:
+                rows = gevent.get_hub().threadpool.apply(
+                    self.read_records, (channel_name,)
+                )
+            except Exception:
+                log.exception("failed to load history of %s" % channel_name)
+                return []
+        records = []
+        for data in rows:
+            try:
+                records.append(decode_record(data))
+            except ValueError:
+                # last record of a log can be cut short by a crash
+                log.warning("skipping damaged history record of %s" % channel_name)
+        return records
+
+    def write_batch(self, batch):
+        """
+        Writes batch of operations
+        :param batch:
+        :return: operations that were not written and have to be retried
+        """
+        raise NotImplementedError
+
+    def read_records(self, channel_name):
+        raise NotImplementedError
+
+    def get_info(self):
+        return {
+            "pending": len(self.pending),
+            "writes": self.writes,
+            "written": self.written,
+        }
+
+
+class FileHistoryStore(HistoryStore):
+    """
+    Every channel has an append-only file of JSON lines in `path` directory,
+    files are named by hash of channel name - names can be longer than file
+    names are allowed to be - and start with a header line holding the name
+    """
+
+    def __init__(self, path, **kwargs):
+        super(FileHistoryStore, self).__init__(**kwargs)
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def channel_path(self, channel_name):
+        filename = hashlib.sha1(channel_name.encode("utf8")).hexdigest()
+        return os.path.join(self.path, filename + ".log")
+
+    def header(self, channel_name):
+        return b"#" + encode_record({"channel": channel_name}) + b"\n"
+
+    def write_batch(self, batch):
+        operations = OrderedDict()
+        for operation, channel_name, data in batch:
+            operations.setdefault(channel_name, []).append((operation, data))
+        failed = []
+        for channel_name, channel_operations in six.iteritems(operations):
+            # one channel that can not be written does not hold back records
+            # of the others
+            try:
+                self.write_channel(channel_name, channel_operations)
+            except Exception:
+                log.exception("failed to persist history of %s" % channel_name)
+                failed.extend(
+                    (operation, channel_name, data)
+                    for operation, data in channel_operations
+                )
+        return failed
+
+    def write_channel(self, channel_name, operations):
+        path = self.channel_path(channel_name)
+        handle = None
+        try:
+            for operation, data in operations:
+                if operation == "rewrite":
+                    # appends made before the rewrite are part of it
+                    if handle is not None:
+                        handle.close()
+                        handle = None
+                    tmp_path = path + ".tmp"
+                    with open(tmp_path, "wb") as tmp_handle:
+                        tmp_handle.write(self.header(channel_name))
+                        for line in encode_records(channel_name, data):
+                            tmp_handle.write(line + b"\n")
+                        tmp_handle.flush()
+                        os.fsync(tmp_handle.fileno())
+                    os.rename(tmp_path, path)
+                    continue
+                for line in encode_records(channel_name, [data]):
+                    if handle is None:
+                        new_file = not os.path.exists(path)
+                        handle = open(path, "ab")
+                        if new_file:
+                            handle.write(self.header(channel_name))
+                    handle.write(line + b"\n")
+            if handle is not None:
+                handle.flush()
+                os.fsync(handle.fileno())
+        finally:
+            if handle is not None:
+                handle.close()
+
+    def read_records(self, channel_name):
+        path = self.channel_path(channel_name)
+        if not os.path.exists(path):
+            return []
+        with open(path, "rb") as handle:
+            return [
+                line
+                for line in handle.read().split(b"\n")
+                if line and not line.startswith(b"#")
+            ]
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    Records of all channels are kept in one SQLite database
+    """
+
+    def __init__(self, path, **kwargs):
+        super(SQLiteHistoryStore, self).__init__(**kwargs)
+        self.path = path
+        # connection is used from thread pool, the store lock serializes it
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS history_records ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "channel TEXT NOT NULL, "
+            "data BLOB NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS history_records_channel "
+            "ON history_records (channel, id)"
+        )
+        self.db.commit()
+
+    def write_batch(self, batch):
+        with self.db:
+            rows = []
+            for operation, channel_name, data in batch:
+                if operation == "rewrite":
+                    self.insert(rows)
+                    rows = []
+                    self.db.execute(
+                        "DELETE FROM history_records WHERE channel = ?", (channel_name,)
+                    )
+                    records = data
+                else:
+                    records = [data]
+                rows.extend(
+                    (channel_name, line)
+                    for line in encode_records(channel_name, records)
+                )
+            self.insert(rows)
+        # the batch is one transaction, it is either written or retried whole
+        return []
+
+    def insert(self, rows):
+        if rows:
+            self.db.executemany(
+                "INSERT INTO history_records (channel, data) VALUES (?, ?)", rows
+            )
+
+    def read_records(self, channel_name):
+        cursor = self.db.execute(
+            "SELECT data FROM history_records WHERE channel = ? ORDER BY id",
+            (channel_name,),
+        )
+        return [bytes(row[0]) for row in cursor]
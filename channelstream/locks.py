@@ -0,0 +1,87 @@
+import time
+
+from gevent.lock import RLock
+
+from channelstream import metrics
+
+
+def channel_key(channel_name):
+    return ("channel", channel_name)
+
+
+def user_key(username):
+    return ("user", username)
+
+
+def connection_keys(connection):
+    """
+    Lock keys of everything garbage collection of connection touches
+    :param connection:
+    :return:
+    """
+    keys = [user_key(connection.username)]
+    keys.extend(channel_key(name) for name in connection.channel_names)
+    return keys
+
+
+class ShardGuard(object):
+    """
+    Context manager holding a group of shard locks, locks are always
+    acquired in ascending shard order so guards can not deadlock
+    each other
+    """
+
+    __slots__ = ("locks",)
+
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            # only waiting for a contended lock is measured
+            if not lock.acquire(False):
+                start = time.time()
+                lock.acquire()
+                metrics.LOCK_WAIT.observe(time.time() - start)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for lock in reversed(self.locks):
+            lock.release()
+
+
+class ShardedLocks(object):
+    """
+    Channel and user state is split into shards by hash of the
+    channel/user key, every shard has its own lock so operations on
+    unrelated channels and users do not wait for each other
+    """
+
+    def __init__(self, shards=64):
+        """
+
+        :param shards: number of locks
+        """
+        self.locks = [RLock() for _ in range(max(1, shards))]
+
+    def __len__(self):
+        return len(self.locks)
+
+    def shard(self, key):
+        return hash(key) % len(self.locks)
+
+    def hold(self, keys):
+        """
+        Returns context manager holding locks of shards owning `keys`
+        :param keys:
+        :return:
+        """
+        shards = sorted(set(self.shard(key) for key in keys))
+        return ShardGuard([self.locks[shard] for shard in shards])
+
+    def hold_all(self):
+        """
+        Returns context manager holding every shard
+        :return:
+        """
+        return ShardGuard(self.locks)
@@ -0,0 +1,340 @@
+"""
+Counters and latency histograms exposed at `/metrics` in Prometheus text
+format.
+
+Metrics are recorded by greenlets of a single process, a greenlet is never
+interrupted in the middle of a plain increment, so recording needs no lock -
+an observation is one bisect over bucket bounds and two additions. Values
+that are cheap to read from server state (number of connections, users and
+channels) are not recorded at all, they are sampled when `/metrics`
+is requested. Depths of outbound buffers are updated as frames are put
+and taken, a scrape never walks the connections.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+
+import six
+
+# seconds, from 100 microseconds to a minute
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# metric name -> metric, in the order they get rendered
+REGISTRY = OrderedDict()
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    kind = "counter"
+
+    __slots__ = ("name", "help", "value")
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets with fixed upper bounds, counts are kept
+    per bucket and only made cumulative when rendered
+    """
+
+    kind = "histogram"
+
+    __slots__ = ("name", "help", "bounds", "counts", "sum")
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = [float(bound) for bound in buckets]
+        # last one counts observations above the highest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            total += count
+            yield '{}_bucket{{le="{}"}}'.format(self.name, format_value(bound)), total
+        yield self.name + "_sum", self.sum
+        yield self.name + "_count", total
+
+
+def counter(name, help):
+    REGISTRY[name] = metric = Counter(name, help)
+    return metric
+
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS):
+    REGISTRY[name] = metric = Histogram(name, help, buckets)
+    return metric
+
+
+class BufferDepths(object):
+    """
+    Number of frames waiting in all outbound buffers of this process and in
+    the fullest one, buffers grow and shrink one frame at a time so the
+    fullest depth can follow them without a scan
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.max = 0
+        # depth -> number of buffers holding that many frames
+        self.buffers = {}
+
+    def grew(self, depth):
+        """
+        Buffer got one frame more
+        :param depth: number of frames it holds now
+        :return:
+        """
+        self.total += 1
+        if depth > 1:
+            self.left(depth - 1)
+        self.buffers[depth] = self.buffers.get(depth, 0) + 1
+        if depth > self.max:
+            self.max = depth
+
+    def shrank(self, depth):
+        """
+        Buffer got one frame less
+        :param depth: number of frames it holds now
+        :return:
+        """
+        self.total -= 1
+        self.left(depth + 1)
+        if depth:
+            self.buffers[depth] = self.buffers.get(depth, 0) + 1
+
+    def left(self, depth):
+        count = self.buffers.pop(depth, 0) - 1
+        if count > 0:
+            self.buffers[depth] = count
+        elif depth == self.max:
+            # the buffer that left is one frame shorter now, nothing
+            # else can hold more
+            self.max = depth - 1
+
+
+# gauges follow live buffers, so reset() leaves them alone
+OUTBOUND_DEPTHS = BufferDepths()
+
+
+def reset():
+    """
+    Zeroes all registered metrics
+    :return:
+    """
+    for metric in six.itervalues(REGISTRY):
+        if metric.kind == "counter":
+            metric.value = 0
+        else:
+            metric.counts = [0] * len(metric.counts)
+            metric.sum = 0.0
+
+
+PUBLISH_FANOUT = histogram(
+    "channelstream_publish_fanout_seconds",
+    "Time to store and enqueue a batch of messages for all recipients "
+    "of one channel or user",
+)
+PUBLISH_RECIPIENTS = histogram(
+    "channelstream_publish_recipients",
+    "Number of messages enqueued by one fan-out",
+    buckets=(1, 10, 100, 1000, 10000, 100000),
+)
+WEBSOCKET_SEND = histogram(
+    "channelstream_websocket_send_seconds",
+    "Time of a single send to subscriber websocket",
+)
+WEBSOCKET_SEND_FAILURES = counter(
+    "channelstream_websocket_send_failures_total",
+    "Sends that failed and closed the connection",
+)
+LONG_POLL_WAIT = histogram(
+    "channelstream_long_poll_wait_seconds",
+    "Time long polling request waited for frames",
+)
+LONG_POLL_FRAMES = histogram(
+    "channelstream_long_poll_frames",
+    "Number of frames in one long polling response",
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000),
+)
+GC_CONNECTIONS = histogram(
+    "channelstream_gc_connections_seconds",
+    "Duration of connection garbage collection passes",
+)
+GC_USERS = histogram(
+    "channelstream_gc_users_seconds", "Duration of user garbage collection passes"
+)
+HEARTBEAT_TICK = histogram(
+    "channelstream_heartbeat_tick_seconds", "Duration of heartbeat scheduler ticks"
+)
+HEARTBEATS_SENT = counter(
+    "channelstream_heartbeats_sent_total", "Number of heartbeats sent"
+)
+LOCK_WAIT = histogram(
+    "channelstream_lock_wait_seconds",
+    "Time spent waiting for a contended channel/user lock, "
+    "uncontended acquisitions are not observed",
+)
+QUOTA_REJECTIONS = counter(
+    "channelstream_quota_rejections_total", "Requests rejected by tenant quotas"
+)
+
+
+def state_samples(server_states):
+    """
+    Values sampled from server state when metrics are requested, they are
+    summed over all tenants
+    :param server_states: states of all tenants
+    :return: list of (name, kind, help, value)
+    """
+    totals = {
+        "connections": 0,
+        "users": 0,
+        "channels": 0,
+        "heartbeats": 0,
+        "total_messages": 0,
+        "total_unique_messages": 0,
+        "overflows": 0,
+        "dropped_frames": 0,
+    }
+    for server_state in server_states:
+        totals["connections"] += len(server_state.connections)
+        totals["users"] += len(server_state.users)
+        totals["channels"] += len(server_state.channels)
+        totals["heartbeats"] += len(server_state.heartbeats)
+        totals["total_messages"] += server_state.stats["total_messages"]
+        totals["total_unique_messages"] += server_state.stats["total_unique_messages"]
+        totals["overflows"] += server_state.outbound_stats["overflows"]
+        totals["dropped_frames"] += server_state.outbound_stats["dropped_frames"]
+    return [
+        (
+            "channelstream_tenants",
+            "gauge",
+            "Tenants served by this process",
+            len(server_states),
+        ),
+        (
+            "channelstream_connections",
+            "gauge",
+            "Connections known to this process",
+            totals["connections"],
+        ),
+        (
+            "channelstream_users",
+            "gauge",
+            "Users known to this process",
+            totals["users"],
+        ),
+        (
+            "channelstream_channels",
+            "gauge",
+            "Channels known to this process",
+            totals["channels"],
+        ),
+        (
+            "channelstream_outbound_queued_frames",
+            "gauge",
+            "Frames waiting in outbound buffers of all connections",
+            OUTBOUND_DEPTHS.total,
+        ),
+        (
+            "channelstream_outbound_max_queued_frames",
+            "gauge",
+            "Frames waiting in the fullest outbound buffer",
+            OUTBOUND_DEPTHS.max,
+        ),
+        (
+            "channelstream_heartbeat_tracked_connections",
+            "gauge",
+            "Connections receiving heartbeats",
+            totals["heartbeats"],
+        ),
+        (
+            "channelstream_messages_total",
+            "counter",
+            "Messages delivered to connections",
+            totals["total_messages"],
+        ),
+        (
+            "channelstream_unique_messages_total",
+            "counter",
+            "Messages published",
+            totals["total_unique_messages"],
+        ),
+        (
+            "channelstream_outbound_overflows_total",
+            "counter",
+            "Overflows of outbound buffers",
+            totals["overflows"],
+        ),
+        (
+            "channelstream_outbound_dropped_frames_total",
+            "counter",
+            "Frames discarded by overflow policies",
+            totals["dropped_frames"],
+        ),
+    ]
+
+
+def render(extra_samples=()):
+    """
+    Renders registered metrics and `extra_samples` in Prometheus text format
+    :param extra_samples: list of (name, kind, help, value)
+    :return: text
+    """
+    lines = []
+    for name, kind, help, value in extra_samples:
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.append("{} {}".format(name, format_value(value)))
+    for metric in list(six.itervalues(REGISTRY)):
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        for sample_name, value in metric.samples():
+            lines.append("{} {}".format(sample_name, format_value(value)))
+    return "\n".join(lines) + "\n"
@@ -1,12 +1,22 @@
 import logging
+import time
+from collections import OrderedDict
 
+import gevent
+import six
+
+from channelstream import bus, cluster, metrics
 from channelstream.channel import Channel
 from channelstream.connection import Connection
-from channelstream.server_state import get_state
+from channelstream.locks import channel_key, user_key
+from channelstream.server_state import DEFAULT_TENANT, get_state, STATES
 from channelstream.user import User
 
 log = logging.getLogger(__name__)
 
+# seconds to wait for connections created by other worker processes
+REPLICATION_WAIT = 1.0
+
 
 def connect(
     username=None,
@@ -16,6 +26,7 @@ def connect(
     conn_id=None,
     channels=None,
     channel_configs=None,
+    tenant_id=DEFAULT_TENANT,
 ):
     """
 
@@ -26,12 +37,14 @@ def connect(
     :param conn_id:
     :param channels:
     :param channel_configs:
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
-    with server_state.lock:
+    server_state = get_state(tenant_id)
+    lock_keys = [user_key(username)] + [channel_key(c) for c in channels]
+    with server_state.locks.hold(lock_keys):
         if username not in server_state.users:
-            user = User(username)
+            user = User(username, tenant_id=tenant_id)
             user.state_from_dict(fresh_user_state)
             server_state.users[username] = user
         else:
@@ -40,7 +53,7 @@ def connect(
             user.state_public_keys = state_public_keys
 
         user.state_from_dict(update_user_state)
-        connection = Connection(username, conn_id)
+        connection = Connection(username, conn_id, tenant_id=tenant_id)
         if connection.id not in server_state.connections:
             server_state.connections[connection.id] = connection
         user.add_connection(connection)
@@ -48,7 +61,9 @@ def connect(
             # user gets assigned to a channel
             if channel_name not in server_state.channels:
                 channel = Channel(
-                    channel_name, channel_config=channel_configs.get(channel_name)
+                    channel_name,
+                    channel_config=channel_configs.get(channel_name),
+                    tenant_id=tenant_id,
                 )
                 server_state.channels[channel_name] = channel
             server_state.channels[channel_name].add_connection(connection)
@@ -56,6 +71,42 @@ def connect(
         return connection, user
 
 
+def get_connection(conn_id, tenant_id=None):
+    """
+    Returns connection of tenant, clients only know id of their connection
+    so it is looked up in all tenants when tenant is not given
+    :param conn_id:
+    :param tenant_id:
+    :return:
+    """
+    if tenant_id is not None:
+        server_state = STATES.get(tenant_id)
+        return server_state.connections.get(conn_id) if server_state else None
+    for server_state in list(six.itervalues(STATES)):
+        connection = server_state.connections.get(conn_id)
+        if connection is not None:
+            return connection
+    return None
+
+
+def find_connection(conn_id, tenant_id=None):
+    """
+    Returns connection, with multiple workers a client can reach this process
+    before connection made by another worker gets replicated, so
+    we wait for it a little
+    :param conn_id:
+    :param tenant_id:
+    :return:
+    """
+    connection = get_connection(conn_id, tenant_id)
+    waited = 0.0
+    while connection is None and bus.BUS is not None and waited < REPLICATION_WAIT:
+        gevent.sleep(0.01)
+        waited += 0.01
+        connection = get_connection(conn_id, tenant_id)
+    return connection
+
+
 def subscribe(connection=None, channels=None, channel_configs=None):
     """
 
@@ -64,15 +115,18 @@ def subscribe(connection=None, channels=None, channel_configs=None):
     :param channel_configs:
     :return:
     """
-    server_state = get_state()
+    server_state = get_state(connection.tenant_id)
     user = server_state.users.get(connection.username)
     subscribed_to = []
-    with server_state.lock:
+    lock_keys = [user_key(connection.username)] + [channel_key(c) for c in channels]
+    with server_state.locks.hold(lock_keys):
         if user:
             for channel_name in channels:
                 if channel_name not in server_state.channels:
                     channel = Channel(
-                        channel_name, channel_config=channel_configs.get(channel_name)
+                        channel_name,
+                        channel_config=channel_configs.get(channel_name),
+                        tenant_id=connection.tenant_id,
                     )
                     server_state.channels[channel_name] = channel
                 is_found = server_state.channels[channel_name].add_connection(
@@ -90,10 +144,12 @@ def unsubscribe(connection=None, unsubscribe_channels=None):
     :param unsubscribe_channels:
     :return:
     """
-    server_state = get_state()
+    server_state = get_state(connection.tenant_id)
     user = server_state.users.get(connection.username)
     unsubscribed_from = []
-    with server_state.lock:
+    lock_keys = [user_key(connection.username)]
+    lock_keys.extend(channel_key(c) for c in unsubscribe_channels)
+    with server_state.locks.hold(lock_keys):
         if user:
             for channel_name in unsubscribe_channels:
                 if channel_name in server_state.channels:
@@ -122,32 +178,36 @@ def change_user_state(user_inst=None, user_state=None):
     return changed
 
 
-def disconnect(conn_id):
+def disconnect(conn_id, tenant_id=None):
     """
 
     :param conn_id:
+    :param tenant_id: tenant of connection, all are searched when not given
     :return:
     """
-    server_state = get_state()
-    conn = server_state.connections.get(conn_id)
+    conn = get_connection(conn_id, tenant_id)
     if conn is not None:
         conn.mark_for_gc()
         return True
     return False
 
 
-def set_channel_config(channel_configs):
+def set_channel_config(channel_configs, tenant_id=DEFAULT_TENANT):
     """
 
     :param channel_configs:
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
-    with server_state.lock:
+    server_state = get_state(tenant_id)
+    lock_keys = [channel_key(c) for c in channel_configs]
+    with server_state.locks.hold(lock_keys):
         for channel_name, config in channel_configs.items():
             if not server_state.channels.get(channel_name):
                 channel = Channel(
-                    channel_name, channel_config=channel_configs.get(channel_name)
+                    channel_name,
+                    channel_config=channel_configs.get(channel_name),
+                    tenant_id=tenant_id,
                 )
                 server_state.channels[channel_name] = channel
             else:
@@ -155,68 +215,113 @@ def set_channel_config(channel_configs):
                 channel.reconfigure_from_dict(channel_configs.get(channel_name))
 
 
-def pass_message(msg, stats):
+def pass_message(msg, stats, tenant_id=DEFAULT_TENANT):
     """
 
     :param msg:
     :param stats:
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
-    msg["catchup"] = False
-    msg["edited"] = None
-    msg["type"] = "message"
+    pass_messages([msg], stats, tenant_id=tenant_id)
+
+
+def pass_messages(messages, stats, relay=True, tenant_id=DEFAULT_TENANT):
+    """
+    Delivers a batch of messages, messages are grouped by channel
+    (or by recipient for private messages) so every connection receives
+    one frame per batch, order of messages in the group is preserved
+
+    :param messages:
+    :param stats:
+    :param relay: should messages be sent to other cluster nodes
+    :param tenant_id:
+    :return:
+    """
+    server_state = get_state(tenant_id)
+    channel_batches = OrderedDict()
+    user_batches = OrderedDict()
+    for msg in messages:
+        msg["catchup"] = False
+        msg["edited"] = None
+        msg["type"] = "message"
+        if msg.get("channel"):
+            channel_batches.setdefault(msg["channel"], []).append(msg)
+        elif msg["pm_users"]:
+            for username in msg["pm_users"]:
+                user_batches.setdefault(username, []).append(msg)
 
     total_sent = 0
-    stats["total_unique_messages"] += 1
-    if msg.get("channel"):
-        channel_inst = server_state.channels.get(msg["channel"])
+    stats["total_unique_messages"] += len(messages)
+    for channel_name, batch in six.iteritems(channel_batches):
+        channel_inst = server_state.channels.get(channel_name)
         if channel_inst:
-            total_sent += channel_inst.add_message(
-                msg, pm_users=msg["pm_users"], exclude_users=msg["exclude_users"]
-            )
-    elif msg["pm_users"]:
-        # if pm then iterate over all users and notify about new message!
-        for username in msg["pm_users"]:
-            user_inst = server_state.users.get(username)
-            if user_inst:
-                total_sent += user_inst.add_message(msg)
+            start = time.time()
+            sent = channel_inst.add_messages(batch)
+            metrics.PUBLISH_FANOUT.observe(time.time() - start)
+            metrics.PUBLISH_RECIPIENTS.observe(sent)
+            total_sent += sent
+        if relay:
+            cluster.relay("channel", channel_name, "messages", batch, tenant_id)
+    # if pm then iterate over all users and notify about new message!
+    for username, batch in six.iteritems(user_batches):
+        user_inst = server_state.users.get(username)
+        if user_inst:
+            start = time.time()
+            sent = user_inst.add_messages(batch)
+            metrics.PUBLISH_FANOUT.observe(time.time() - start)
+            metrics.PUBLISH_RECIPIENTS.observe(sent)
+            total_sent += sent
+        if relay:
+            cluster.relay("user", username, "messages", batch, tenant_id)
     stats["total_messages"] += total_sent
 
 
-def edit_message(msg):
+def edit_message(msg, relay=True, tenant_id=DEFAULT_TENANT):
     """
 
     :param msg:
+    :param relay: should change be sent to other cluster nodes
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
+    server_state = get_state(tenant_id)
     if msg.get("channel"):
         channel_inst = server_state.channels.get(msg["channel"])
         if channel_inst:
             channel_inst.alter_message(msg)
+        if relay:
+            cluster.relay("channel", msg["channel"], "edit", [msg], tenant_id)
     elif msg["pm_users"]:
         # if pm then iterate over all users and notify about new message!
         for username in msg["pm_users"]:
             user_inst = server_state.users.get(username)
             if user_inst:
                 user_inst.alter_message(msg)
+            if relay:
+                cluster.relay("user", username, "edit", [msg], tenant_id)
 
 
-def delete_message(msg):
+def delete_message(msg, relay=True, tenant_id=DEFAULT_TENANT):
     """
 
     :param msg:
+    :param relay: should change be sent to other cluster nodes
+    :param tenant_id:
     :return:
     """
-    server_state = get_state()
+    server_state = get_state(tenant_id)
     if msg.get("channel"):
         channel_inst = server_state.channels.get(msg["channel"])
         if channel_inst:
             channel_inst.delete_message(msg)
+        if relay:
+            cluster.relay("channel", msg["channel"], "delete", [msg], tenant_id)
     elif msg["pm_users"]:
         # if pm then iterate over all users and notify about new message!
         for username in msg["pm_users"]:
             user_inst = server_state.users.get(username)
             if user_inst:
                 user_inst.delete_message(msg)
+            if relay:
+                cluster.relay("user", username, "delete", [msg], tenant_id)
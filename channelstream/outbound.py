@@ -0,0 +1,306 @@
+import logging
+import time
+from collections import deque
+
+import gevent
+from gevent.queue import Queue, Empty
+
+from channelstream import metrics
+from channelstream.frames import join_frames
+
+log = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE, DISCONNECT)
+
+# defaults used by buffers of new connections
+BUFFER_SIZE = 1000
+OVERFLOW_POLICY = DROP_OLDEST
+# how many waiting frames websocket writer merges into one send
+WRITE_BATCH_SIZE = 100
+
+
+def configure_outbound(size=1000, policy=DROP_OLDEST):
+    """
+    Sets size and overflow policy of connection buffers
+    :param size: maximum number of frames waiting for a single connection
+    :param policy: one of OVERFLOW_POLICIES
+    :return:
+    """
+    global BUFFER_SIZE, OVERFLOW_POLICY
+    if policy not in OVERFLOW_POLICIES:
+        raise ValueError(
+            "Unknown overflow policy {}, use one of: {}".format(
+                policy, ", ".join(OVERFLOW_POLICIES)
+            )
+        )
+    BUFFER_SIZE = max(1, int(size))
+    OVERFLOW_POLICY = policy
+
+
+class OutboundBuffer(Queue):
+    """
+    Bounded queue of encoded frames waiting to be sent to one connection,
+    when it is full the overflow policy decides what happens to new frames:
+
+    * drop_oldest - oldest waiting frame is discarded
+    * drop_newest - new frame is discarded
+    * coalesce - waiting frames are merged into single frame
+    * disconnect - waiting frames are discarded and connection gets closed
+    """
+
+    def __init__(self, size=None, policy=None, on_overflow=None):
+        """
+
+        :param size:
+        :param policy:
+        :param on_overflow: callable receiving the buffer and number of
+                            discarded frames when it overflows
+        """
+        Queue.__init__(self)
+        self.size = size or BUFFER_SIZE
+        self.policy = policy or OVERFLOW_POLICY
+        self.on_overflow = on_overflow
+        self.overflows = 0
+        self.dropped = 0
+        # set when disconnect policy discarded the buffer
+        self.closed = False
+
+    def put(self, frame, block=True, timeout=None):
+        if self.closed:
+            return
+        if self.qsize() >= self.size:
+            dropped = self.overflow(frame)
+            self.overflows += 1
+            self.dropped += dropped
+            if self.on_overflow is not None:
+                self.on_overflow(self, dropped)
+            return
+        Queue.put(self, frame, block, timeout)
+
+    def _put(self, frame):
+        Queue._put(self, frame)
+        metrics.OUTBOUND_DEPTHS.grew(self.qsize())
+
+    def _get(self):
+        frame = Queue._get(self)
+        metrics.OUTBOUND_DEPTHS.shrank(self.qsize())
+        return frame
+
+    def drain(self):
+        """
+        Removes and returns all waiting frames
+        :return:
+        """
+        frames = []
+        try:
+            while True:
+                frames.append(self.get_nowait())
+        except Empty:
+            pass
+        return frames
+
+    def overflow(self, frame):
+        """
+        Applies overflow policy
+        :param frame:
+        :return: number of discarded frames
+        """
+        if self.policy == DROP_OLDEST:
+            self.get_nowait()
+            Queue.put(self, frame)
+            return 1
+        elif self.policy == DROP_NEWEST:
+            return 1
+        elif self.policy == COALESCE:
+            Queue.put(self, join_frames(self.drain() + [frame]))
+            return 0
+        self.closed = True
+        return len(self.drain()) + 1
+
+
+class LongPollBuffer(OutboundBuffer):
+    """
+    Buffer of long polling connection that is kept between polls, so frames
+    published while client reconnects wait for the next poll. Frames handed
+    to a poll are numbered and kept until the client acknowledges them
+    with a follow-up poll, response lost on the way is sent again.
+    """
+
+    def __init__(self, size=None, policy=None, on_overflow=None, seq=0):
+        """
+
+        :param size:
+        :param policy:
+        :param on_overflow:
+        :param seq: last sequence number client received, numbering
+                    continues from it when another worker served the
+                    connection before
+        """
+        super(LongPollBuffer, self).__init__(size, policy, on_overflow)
+        # number of the last frame handed to a poll
+        self.seq = seq
+        self.initial_seq = seq
+        # (seq, frames) of responses client did not acknowledge yet, they
+        # are bounded by buffer size and overflow policy like waiting frames
+        self.unacknowledged = deque()
+        self.unacknowledged_count = 0
+
+    def acknowledge(self, seq=None):
+        """
+        Forgets frames client received
+        :param seq: last sequence number client received, all frames
+                    are considered received when it's None
+        :return:
+        """
+        if seq is None:
+            self.unacknowledged.clear()
+            self.unacknowledged_count = 0
+            return
+        while self.unacknowledged and self.unacknowledged[0][0] <= seq:
+            self.unacknowledged_count -= len(self.unacknowledged.popleft()[1])
+
+    def unacknowledged_frames(self):
+        return [frame for seq, frames in self.unacknowledged for frame in frames]
+
+    def hand_over(self):
+        """
+        Empties the buffer when another worker starts serving the connection
+        :return: (unacknowledged, frames) - numbered frames client did not
+                 acknowledge and frames not handed to a poll yet
+        """
+        unacknowledged = [(seq, list(frames)) for seq, frames in self.unacknowledged]
+        self.acknowledge()
+        return unacknowledged, self.drain()
+
+    def take_over(self, unacknowledged, frames):
+        """
+        Queues frames from buffer of the worker that served the connection
+        before, ahead of frames queued here already. Numbers of handed over
+        frames are the ones that worker used, client received frames up to
+        `initial_seq` of this buffer.
+        :param unacknowledged: (seq, frames) pairs from `hand_over()`
+        :param frames:
+        :return:
+        """
+        pending = []
+        for seq, numbered in unacknowledged:
+            first_seq = seq - len(numbered) + 1
+            pending.extend(numbered[max(0, self.initial_seq - first_seq + 1) :])
+        pending.extend(frames)
+        if not pending:
+            return
+        queued = self.drain()
+        for frame in pending + queued:
+            self.put(frame)
+
+    def delivered(self, frames):
+        """
+        Numbers frames handed to a poll
+        :param frames:
+        :return: sequence number of the last frame
+        """
+        if frames:
+            self.seq += len(frames)
+            self.unacknowledged.append((self.seq, list(frames)))
+            self.unacknowledged_count += len(frames)
+            if self.unacknowledged_count > self.size:
+                dropped = self.unacknowledged_overflow()
+                self.overflows += 1
+                self.dropped += dropped
+                if self.on_overflow is not None:
+                    self.on_overflow(self, dropped)
+        return self.seq
+
+    def unacknowledged_overflow(self):
+        """
+        Applies overflow policy to frames client did not acknowledge
+        :return: number of discarded frames
+        """
+        excess = self.unacknowledged_count - self.size
+        if self.policy == DROP_OLDEST:
+            dropped = excess
+            while excess:
+                seq, frames = self.unacknowledged[0]
+                if len(frames) <= excess:
+                    self.unacknowledged.popleft()
+                    excess -= len(frames)
+                else:
+                    del frames[:excess]
+                    excess = 0
+        elif self.policy == DROP_NEWEST:
+            # newest frames are still sent, they just won't be sent again
+            dropped = excess
+            seq, frames = self.unacknowledged[-1]
+            del frames[len(frames) - excess :]
+            if not frames:
+                self.unacknowledged.pop()
+        elif self.policy == COALESCE:
+            dropped = 0
+            merged = join_frames(self.unacknowledged_frames())
+            self.unacknowledged.clear()
+            self.unacknowledged.append((self.seq, [merged]))
+        else:
+            dropped = self.unacknowledged_count + len(self.drain())
+            self.closed = True
+            self.unacknowledged.clear()
+        self.unacknowledged_count = sum(len(f) for seq, f in self.unacknowledged)
+        return dropped
+
+
+class WebsocketWriter(object):
+    """
+    Sends frames to websocket of one connection from its own greenlet, so
+    publishers only put frames into the buffer and never wait for a slow
+    socket - frames that queued up during previous send go out together
+    """
+
+    def __init__(self, connection, batch_size=None):
+        self.connection = connection
+        self.batch_size = batch_size or WRITE_BATCH_SIZE
+        self.buffer = OutboundBuffer(on_overflow=connection.buffer_overflowed)
+        self.sends = 0
+        self.greenlet = gevent.spawn(self.write_forever)
+
+    def put(self, frame):
+        self.buffer.put(frame)
+
+    def stop(self):
+        self.greenlet.kill(block=False)
+
+    def next_frame(self):
+        frames = [self.buffer.get()]
+        try:
+            while len(frames) < self.batch_size:
+                frames.append(self.buffer.get_nowait())
+        except Empty:
+            pass
+        if len(frames) == 1:
+            return frames[0]
+        return join_frames(frames)
+
+    def write_forever(self):
+        connection = self.connection
+        while True:
+            frame = self.next_frame()
+            socket = connection.socket
+            if socket is None or socket.terminated:
+                connection.mark_for_gc()
+                return
+            start = time.time()
+            try:
+                socket.send(frame)
+            except Exception as exc:
+                log.info(exc)
+                metrics.WEBSOCKET_SEND_FAILURES.inc()
+                connection.mark_for_gc()
+                return
+            metrics.WEBSOCKET_SEND.observe(time.time() - start)
+            self.sends += 1
+            connection.mark_activity()
+            if connection.user is not None:
+                connection.user.mark_activity()
@@ -0,0 +1,53 @@
+"""
+Cursor pagination of channel and user listings.
+
+Pages are ordered by name, the cursor is the last name of previous page
+encoded so clients treat it as opaque. Listings change between requests -
+names created behind the cursor show up on later pages, removed ones are
+skipped, nothing is listed twice.
+"""
+import base64
+import heapq
+
+
+def encode_cursor(name):
+    return base64.urlsafe_b64encode(name.encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns name encoded in cursor, raises ValueError for invalid cursors
+    :param cursor:
+    :return:
+    """
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf8")
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def paginate(items, key, cursor=None, limit=None):
+    """
+    Returns page of items ordered by key and cursor of the next page,
+    items are returned in original order when neither cursor nor limit
+    is set
+    :param items: iterable of items
+    :param key: function returning unique name of item
+    :param cursor: `next_cursor` of previous page
+    :param limit: page size, everything after cursor is returned when
+                  not set
+    :return: (page, next_cursor) - next_cursor is None for last page
+    """
+    if cursor is None and limit is None:
+        return list(items), None
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        items = (item for item in items if key(item) > after)
+    if limit is None:
+        return sorted(items, key=key), None
+    # only the page is kept sorted, not the whole listing
+    page = heapq.nsmallest(limit + 1, items, key=key)
+    if len(page) > limit:
+        page = page[:limit]
+        return page, encode_cursor(key(page[-1]))
+    return page, None
@@ -1,11 +1,18 @@
 from __future__ import absolute_import
 
+import collections
 import datetime
 import decimal
 import functools
 import json
+import logging
+import math
 import uuid
 
+import six
+
+log = logging.getLogger(__name__)
+
 
 class ComplexEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -42,3 +49,220 @@ load = json.load
 loads = json.loads
 dump = json.load
 dumps = functools.partial(json.dumps, indent=4, cls=ComplexEncoder)
+
+
+_complex_encoder = ComplexEncoder()
+
+
+class StreamedObject(object):
+    """
+    JSON object `iter_chunks()` encodes from lazily produced (key, value) pairs
+    """
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+
+class StreamedArray(object):
+    """
+    JSON array `iter_chunks()` encodes from lazily produced items
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+
+def iter_chunks(obj, chunk_size=100):
+    """
+    Encodes mapping as JSON object in chunks of bytes, its `StreamedObject`
+    and `StreamedArray` values are consumed only while they are encoded,
+    `chunk_size` of their items at a time
+    :param obj:
+    :param chunk_size:
+    :return:
+    """
+    encode = ComplexEncoder(separators=(",", ":")).encode
+    parts = []
+
+    def encode_items(items, encode_item):
+        for count, item in enumerate(items, 1):
+            if count > 1:
+                parts.append(",")
+            parts.append(encode_item(item))
+            if count % chunk_size == 0:
+                yield
+
+    def encode_pair(pair):
+        return encode(pair[0]) + ":" + encode(pair[1])
+
+    parts.append("{")
+    for count, (key, value) in enumerate(obj.items()):
+        if count:
+            parts.append(",")
+        parts.append(encode(key) + ":")
+        if isinstance(value, StreamedObject):
+            parts.append("{")
+            items = encode_items(value.pairs, encode_pair)
+            closing = "}"
+        elif isinstance(value, StreamedArray):
+            parts.append("[")
+            items = encode_items(value.items, encode)
+            closing = "]"
+        else:
+            parts.append(encode(value))
+            continue
+        for _ in items:
+            yield "".join(parts).encode("utf8")
+            del parts[:]
+        parts.append(closing)
+    parts.append("}")
+    yield "".join(parts).encode("utf8")
+
+
+def _fallback_default(obj):
+    """
+    Serializes types that fast backends do not understand natively
+    """
+    return _complex_encoder.default(obj)
+
+
+def _json_wire_encoder(compact):
+    if compact:
+        kwargs = {"separators": (",", ":")}
+    else:
+        kwargs = {"indent": 4}
+    # UTF-8 is written as is like the other backends do, strings that are
+    # not valid unicode (lone surrogates) can only be sent escaped
+    encoder = ComplexEncoder(ensure_ascii=False, **kwargs)
+    ascii_encoder = ComplexEncoder(**kwargs)
+
+    def encode(obj):
+        try:
+            return encoder.encode(obj).encode("utf8")
+        except UnicodeEncodeError:
+            return ascii_encoder.encode(obj).encode("utf8")
+
+    return encode
+
+
+def _has_non_finite(obj):
+    """
+    Checks if NaN or infinity is nested in containers of obj
+    """
+    if isinstance(obj, float):
+        return math.isnan(obj) or math.isinf(obj)
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, (list, tuple, set, frozenset)):
+        return False
+    return any(_has_non_finite(item) for item in obj)
+
+
+def _orjson_wire_encoder(compact):
+    import orjson
+
+    # dates and times are left to the default function, orjson keeps
+    # microseconds of times and does not convert keys like stdlib does,
+    # keys that are not strings make it fail and fall back
+    option = orjson.OPT_PASSTHROUGH_DATETIME
+    if not compact:
+        option |= orjson.OPT_INDENT_2
+    fallback = _json_wire_encoder(compact)
+
+    def encode(obj):
+        try:
+            encoded = orjson.dumps(obj, default=_fallback_default, option=option)
+        except (TypeError, OverflowError):
+            # integers beyond 64 bits, keys that are not strings, lone
+            # surrogates
+            return fallback(obj)
+        # orjson writes NaN and infinity as null
+        if b"null" in encoded and _has_non_finite(obj):
+            return fallback(obj)
+        return encoded
+
+    return encode
+
+
+def _json_key(key):
+    """
+    Converts dictionary key the way stdlib encoder does
+    """
+    if isinstance(key, six.string_types):
+        return key
+    if key is None or isinstance(key, (bool, float) + six.integer_types):
+        return json.dumps(key)
+    raise TypeError("keys must be str, int, float, bool or None, not {}".format(key))
+
+
+def _rapidjson_default(obj):
+    # rapidjson passes dictionaries with keys that are not strings here
+    if isinstance(obj, dict):
+        return {_json_key(key): value for key, value in obj.items()}
+    return _fallback_default(obj)
+
+
+def _rapidjson_wire_encoder(compact):
+    import rapidjson
+
+    # datetimes are left to the default function, rapidjson does not
+    # write UTC as `Z` like the other backends
+    kwargs = {
+        "default": _rapidjson_default,
+        "uuid_mode": rapidjson.UM_CANONICAL,
+        "ensure_ascii": False,
+    }
+    if not compact:
+        kwargs["indent"] = 4
+    fallback = _json_wire_encoder(compact)
+
+    def encode(obj):
+        try:
+            return rapidjson.dumps(obj, **kwargs).encode("utf8")
+        except (TypeError, OverflowError, UnicodeEncodeError):
+            return fallback(obj)
+
+    return encode
+
+
+WIRE_BACKENDS = collections.OrderedDict(
+    [
+        ("orjson", _orjson_wire_encoder),
+        ("rapidjson", _rapidjson_wire_encoder),
+        ("json", _json_wire_encoder),
+    ]
+)
+
+wire_backend = None
+wire_dumps = None
+
+
+def configure_wire_encoding(backend="auto", compact=True):
+    """
+    Selects the encoder used for payloads sent to websocket and long polling
+    clients, `auto` picks the fastest installed backend
+    :param backend:
+    :param compact:
+    :return: name of backend in use
+    """
+    global wire_backend, wire_dumps
+    if backend == "auto":
+        candidates = list(WIRE_BACKENDS.keys())
+    elif backend in WIRE_BACKENDS:
+        candidates = [backend]
+    else:
+        raise ValueError("Unknown JSON backend: {}".format(backend))
+    for name in candidates:
+        try:
+            encoder = WIRE_BACKENDS[name](compact)
+        except ImportError:
+            if backend != "auto":
+                raise
+            continue
+        wire_backend, wire_dumps = name, encoder
+        break
+    log.info("Using {} backend for wire JSON encoding".format(wire_backend))
+    return wire_backend
+
+
+configure_wire_encoding()
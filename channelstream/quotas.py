@@ -0,0 +1,124 @@
+"""
+Limits of a single tenant.
+
+Quotas are checked by API views before state changes, so changes applied
+by other workers and cluster nodes are never rejected. Checks are not done
+under channel/user locks - concurrent requests can overshoot a limit by
+a few connections or channels, never by more than the number of
+requests in flight.
+
+With multiple worker processes connections and channels are counted in
+state replicated from all of them - changes other workers made a moment
+ago may be missing. Message rate is limited by every worker on its own,
+so a tenant can publish `workers * max_messages_per_second` in total.
+"""
+import time
+
+from channelstream import metrics
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, tenant_id, quota, limit):
+        super(QuotaExceeded, self).__init__(
+            "Tenant {} exceeded {} quota of {}".format(tenant_id, quota, limit)
+        )
+        self.tenant_id = tenant_id
+        self.quota = quota
+        self.limit = limit
+
+
+class Quotas(object):
+    """
+    Connection, channel and message rate limits, zero means unlimited
+    """
+
+    def __init__(
+        self,
+        tenant_id="0",
+        max_connections=0,
+        max_channels=0,
+        max_messages_per_second=0,
+    ):
+        """
+
+        :param tenant_id:
+        :param max_connections: connections tenant can hold at once
+        :param max_channels: channels tenant can create
+        :param max_messages_per_second: sustained rate of published
+                                        messages, a second worth of them
+                                        can be sent in a burst
+        """
+        self.tenant_id = tenant_id
+        self.max_connections = int(max_connections)
+        self.max_channels = int(max_channels)
+        self.max_messages_per_second = float(max_messages_per_second)
+        # token bucket of message rate limit
+        self.allowance = self.max_messages_per_second
+        self.allowance_updated = time.time()
+        self.rejected = {"connections": 0, "channels": 0, "messages": 0}
+
+    def reject(self, quota, limit):
+        self.rejected[quota] += 1
+        metrics.QUOTA_REJECTIONS.inc()
+        raise QuotaExceeded(self.tenant_id, quota, limit)
+
+    def check_connection(self, server_state, conn_id):
+        """
+        Raises QuotaExceeded when new connection would exceed the limit,
+        reconnecting with id of existing connection is always allowed
+        :param server_state:
+        :param conn_id:
+        :return:
+        """
+        if (
+            self.max_connections
+            and conn_id not in server_state.connections
+            and len(server_state.connections) >= self.max_connections
+        ):
+            self.reject("connections", self.max_connections)
+
+    def check_channels(self, server_state, channel_names):
+        """
+        Raises QuotaExceeded when channels that do not exist yet would
+        exceed the limit
+        :param server_state:
+        :param channel_names:
+        :return:
+        """
+        if not self.max_channels:
+            return
+        new_channels = len(
+            [name for name in set(channel_names) if name not in server_state.channels]
+        )
+        if new_channels and (
+            len(server_state.channels) + new_channels > self.max_channels
+        ):
+            self.reject("channels", self.max_channels)
+
+    def consume_messages(self, count):
+        """
+        Takes `count` messages from the rate limit, raises QuotaExceeded
+        and takes nothing when there is not enough of them left
+        :param count:
+        :return:
+        """
+        if not self.max_messages_per_second:
+            return
+        now = time.time()
+        self.allowance = min(
+            self.max_messages_per_second,
+            self.allowance
+            + (now - self.allowance_updated) * self.max_messages_per_second,
+        )
+        self.allowance_updated = now
+        if count > self.allowance:
+            self.reject("messages", self.max_messages_per_second)
+        self.allowance -= count
+
+    def get_info(self):
+        return {
+            "max_connections": self.max_connections,
+            "max_channels": self.max_channels,
+            "max_messages_per_second": self.max_messages_per_second,
+            "rejected": dict(self.rejected),
+        }
@@ -0,0 +1,197 @@
+"""
+Applies state changes published by other worker processes and messages
+relayed by other cluster nodes.
+
+Every worker keeps a replica of users, channels and connections, while
+sockets and long-polling queues exist only in the worker serving them.
+A message delivered to replicas therefore reaches every subscriber exactly
+once - through the worker its connection is attached to.
+
+Events carry id of the tenant they belong to, tenants are created on
+replicas the first time one of their events arrives.
+"""
+import logging
+
+from channelstream import bus, cluster, operations
+from channelstream.gc import collect_connection_locked
+from channelstream.outbound import LongPollBuffer
+from channelstream.server_state import DEFAULT_TENANT, get_or_create_state
+
+log = logging.getLogger(__name__)
+
+
+def tenant_state(kwargs):
+    return get_or_create_state(kwargs.get("tenant_id", DEFAULT_TENANT))
+
+
+def apply_connect(kwargs):
+    tenant_state(kwargs)
+    operations.connect(**kwargs)
+
+
+def apply_subscribe(kwargs):
+    connection = tenant_state(kwargs).connections.get(kwargs["conn_id"])
+    if connection:
+        operations.subscribe(
+            connection=connection,
+            channels=kwargs["channels"],
+            channel_configs=kwargs["channel_configs"],
+        )
+
+
+def apply_unsubscribe(kwargs):
+    connection = tenant_state(kwargs).connections.get(kwargs["conn_id"])
+    if connection:
+        operations.unsubscribe(
+            connection=connection, unsubscribe_channels=kwargs["channels"]
+        )
+
+
+def apply_user_state(kwargs):
+    user_inst = tenant_state(kwargs).users.get(kwargs["user"])
+    if user_inst:
+        if kwargs["state_public_keys"] is not None:
+            user_inst.state_public_keys = kwargs["state_public_keys"]
+        operations.change_user_state(
+            user_inst=user_inst, user_state=kwargs["user_state"]
+        )
+
+
+def apply_messages(kwargs):
+    server_state = tenant_state(kwargs)
+    # worker that received the messages relays them to other nodes
+    operations.pass_messages(
+        kwargs["messages"],
+        server_state.stats,
+        relay=False,
+        tenant_id=server_state.tenant_id,
+    )
+
+
+def apply_edit_messages(kwargs):
+    server_state = tenant_state(kwargs)
+    for msg in kwargs["messages"]:
+        operations.edit_message(msg, relay=False, tenant_id=server_state.tenant_id)
+
+
+def apply_delete_messages(kwargs):
+    server_state = tenant_state(kwargs)
+    for msg in kwargs["messages"]:
+        operations.delete_message(msg, relay=False, tenant_id=server_state.tenant_id)
+
+
+def apply_channel_config(kwargs):
+    server_state = tenant_state(kwargs)
+    operations.set_channel_config(
+        kwargs["channel_configs"], tenant_id=server_state.tenant_id
+    )
+
+
+def apply_disconnect(kwargs):
+    operations.disconnect(kwargs["conn_id"], kwargs.get("tenant_id"))
+
+
+def apply_attach(kwargs):
+    connection = operations.get_connection(kwargs["conn_id"], kwargs.get("tenant_id"))
+    if connection:
+        connection.attached_elsewhere()
+
+
+def apply_handover(kwargs):
+    connection = operations.get_connection(kwargs["conn_id"], kwargs.get("tenant_id"))
+    # only the worker serving the connection now takes the frames
+    if (
+        connection
+        and not connection.remote
+        and isinstance(connection.queue, LongPollBuffer)
+    ):
+        connection.queue.take_over(kwargs["unacknowledged"], kwargs["frames"])
+
+
+def apply_relayed_messages(kind, name, event, messages):
+    """
+    Delivers messages relayed by another cluster node to local connections
+    :param kind: "channel" or "user", with tenant id for tenants other than
+                 the default one
+    :param name:
+    :param event: "messages", "edit" or "delete"
+    :param messages:
+    :return:
+    """
+    kind, tenant_id = cluster.split_routing_kind(kind)
+    server_state = get_or_create_state(tenant_id)
+    if kind == "channel":
+        if event == "messages":
+            operations.pass_messages(
+                messages, server_state.stats, relay=False, tenant_id=tenant_id
+            )
+        elif event == "edit":
+            for msg in messages:
+                operations.edit_message(msg, relay=False, tenant_id=tenant_id)
+        elif event == "delete":
+            for msg in messages:
+                operations.delete_message(msg, relay=False, tenant_id=tenant_id)
+    elif kind == "user":
+        # only this user is a local recipient of private message
+        user_inst = server_state.users.get(name)
+        if user_inst is None:
+            return
+        if event == "messages":
+            server_state.stats["total_messages"] += user_inst.add_messages(messages)
+        elif event == "edit":
+            for msg in messages:
+                user_inst.alter_message(msg)
+        elif event == "delete":
+            for msg in messages:
+                user_inst.delete_message(msg)
+
+
+def receive_relayed_messages(kind, name, event, messages):
+    """
+    Handles messages from other cluster nodes, with multiple workers
+    they are passed to the other workers of this node too
+    """
+    apply_relayed_messages(kind, name, event, messages)
+    bus.publish("relayed", kind=kind, name=name, event=event, messages=messages)
+
+
+def apply_relayed(kwargs):
+    apply_relayed_messages(**kwargs)
+
+
+def apply_collect(kwargs):
+    connection = operations.get_connection(kwargs["conn_id"], kwargs.get("tenant_id"))
+    # connections served by this process are only collected locally
+    if connection and not connection.socket and not connection.queue:
+        collect_connection_locked(connection)
+
+
+HANDLERS = {
+    "connect": apply_connect,
+    "subscribe": apply_subscribe,
+    "unsubscribe": apply_unsubscribe,
+    "user_state": apply_user_state,
+    "messages": apply_messages,
+    "edit_messages": apply_edit_messages,
+    "delete_messages": apply_delete_messages,
+    "channel_config": apply_channel_config,
+    "disconnect": apply_disconnect,
+    "attach": apply_attach,
+    "handover": apply_handover,
+    "collect": apply_collect,
+    "relayed": apply_relayed,
+}
+
+
+def apply_event(event, kwargs):
+    """
+    Applies event received from the bus to local state
+    :param event:
+    :param kwargs:
+    :return:
+    """
+    handler = HANDLERS.get(event)
+    if handler is None:
+        log.warning("unknown bus event %s" % event)
+        return
+    handler(kwargs)
@@ -0,0 +1,181 @@
+class RingBuffer(object):
+    """
+    Fixed capacity buffer - appending to a full buffer overwrites the oldest
+    entry. Every appended entry gets a sequence number that grows for the
+    lifetime of the buffer, so entries can be addressed by it.
+    """
+
+    def __init__(self, capacity, key=None, start_seq=0):
+        """
+
+        :param capacity: maximum number of retained entries
+        :param key: optional callable returning lookup key for an entry
+                    (or None), the buffer keeps key -> sequence number index
+                    of retained entries for it
+        :param start_seq: sequence number of the first entry
+        """
+        self.capacity = max(0, capacity)
+        self.key = key
+        self.index = {}
+        self.slots = [None] * self.capacity
+        # sequence number of oldest retained entry
+        self.first_seq = start_seq
+        # sequence number that will be assigned to next entry
+        self.next_seq = start_seq
+        # sequence numbers of entries removed before being overwritten
+        self.deleted = set()
+
+    def __len__(self):
+        return self.next_seq - self.first_seq - len(self.deleted)
+
+    def __iter__(self):
+        for seq, item in self.entries():
+            yield item
+
+    def __getitem__(self, index):
+        """
+        Positional access to live entries, oldest first
+        """
+        size = len(self)
+        if index < 0:
+            index += size
+        if index < 0 or index >= size:
+            raise IndexError("RingBuffer index out of range")
+        if not self.deleted:
+            return self.slots[(self.first_seq + index) % self.capacity]
+        for position, item in enumerate(self):
+            if position == index:
+                return item
+
+    def __repr__(self):
+        return "<RingBuffer: %s/%s>" % (len(self), self.capacity)
+
+    def append(self, item):
+        """
+        Appends item to the buffer
+        :param item:
+        :return: sequence number of item and the evicted item (or None)
+        """
+        seq = self.next_seq
+        self.next_seq += 1
+        if not self.capacity:
+            self.first_seq = self.next_seq
+            return seq, item
+        evicted = None
+        if seq - self.first_seq >= self.capacity:
+            evicted_seq = self.first_seq
+            self.first_seq += 1
+            if evicted_seq in self.deleted:
+                self.deleted.discard(evicted_seq)
+            else:
+                evicted = self.slots[evicted_seq % self.capacity]
+                self._unindex(evicted_seq, evicted)
+        self.slots[seq % self.capacity] = item
+        if self.key is not None:
+            item_key = self.key(item)
+            if item_key is not None:
+                self.index[item_key] = seq
+        return seq, evicted
+
+    def _unindex(self, seq, item):
+        if self.key is not None:
+            item_key = self.key(item)
+            if item_key is not None and self.index.get(item_key) == seq:
+                del self.index[item_key]
+
+    def lookup(self, item_key):
+        """
+        Finds retained entry by its key
+        :param item_key:
+        :return: sequence number and entry or (None, None)
+        """
+        seq = self.index.get(item_key)
+        if seq is None:
+            return None, None
+        return seq, self.slots[seq % self.capacity]
+
+    def get(self, seq, default=None):
+        """
+        Returns entry with specific sequence number if it is still retained
+        """
+        if self.first_seq <= seq < self.next_seq and seq not in self.deleted:
+            return self.slots[seq % self.capacity]
+        return default
+
+    def discard(self, seq):
+        """
+        Removes entry with specific sequence number
+        :param seq:
+        :return: True if entry was present
+        """
+        if self.first_seq <= seq < self.next_seq and seq not in self.deleted:
+            # item stays in its slot until overwritten so bisecting still
+            # sees its key
+            self.deleted.add(seq)
+            self._unindex(seq, self.slots[seq % self.capacity])
+            return True
+        return False
+
+    def entries(self, start_seq=None):
+        """
+        Yields (sequence number, item) pairs oldest first
+        :param start_seq: skip entries older than this sequence number
+        """
+        seq = self.first_seq
+        if start_seq is not None and start_seq > seq:
+            seq = start_seq
+        while seq < self.next_seq:
+            if seq not in self.deleted:
+                yield seq, self.slots[seq % self.capacity]
+            seq += 1
+
+    def retained(self):
+        """
+        Yields (sequence number, item, deleted) of every slot that is still
+        in the buffer, including entries removed with `discard()`
+        """
+        for seq in range(self.first_seq, self.next_seq):
+            yield seq, self.slots[seq % self.capacity], seq in self.deleted
+
+    def bisect(self, value, key, right=False):
+        """
+        Finds sequence number of first entry with `key(entry)` greater or
+        equal to `value` (greater than if `right` is set), entries have to be
+        ordered by the key
+        """
+        lo = self.first_seq
+        hi = self.next_seq
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_value = key(self.slots[mid % self.capacity])
+            if mid_value < value or (right and mid_value == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def resize(self, capacity):
+        """
+        Changes capacity of the buffer keeping newest entries, sequence
+        numbers of retained entries do not change
+        :param capacity:
+        :return: list of evicted items
+        """
+        capacity = max(0, capacity)
+        if capacity == self.capacity:
+            return []
+        first_seq = max(self.first_seq, self.next_seq - capacity)
+        evicted = []
+        for seq, item in self.entries():
+            if seq >= first_seq:
+                break
+            self._unindex(seq, item)
+            evicted.append(item)
+        slots = [None] * capacity
+        for seq in range(first_seq, self.next_seq):
+            slots[seq % capacity] = self.slots[seq % self.capacity]
+        self.capacity = capacity
+        self.slots = slots
+        self.first_seq = first_seq
+        self.deleted = set(seq for seq in self.deleted if seq >= first_seq)
+        return evicted
@@ -2,26 +2,81 @@ from datetime import datetime
 
 from gevent.lock import RLock
 
+from channelstream.expiry import ExpiryIndex
+from channelstream.heartbeat import HeartbeatScheduler
+from channelstream.locks import ShardedLocks
+from channelstream.quotas import Quotas
+
 STATS = {"started_on": datetime.utcnow()}
 lock = RLock()
 
+# tenant of requests that do not select one, also owns everything
+# created before tenants were configured
+DEFAULT_TENANT = "0"
+
 
 class State(object):
-    def __init__(self):
+    def __init__(self, tenant_id=DEFAULT_TENANT, quotas=None):
+        self.tenant_id = tenant_id
         self.channels = {}
         self.connections = {}
         self.users = {}
         self.stats = {"total_messages": 0, "total_unique_messages": 0}
-        self.lock = RLock()
+        # locks sharded by channel/user key
+        self.locks = ShardedLocks()
+        self.heartbeats = HeartbeatScheduler()
+        self.connection_expiry = ExpiryIndex()
+        self.gc_stats = {}
+        self.outbound_stats = {"overflows": 0, "dropped_frames": 0, "disconnected": 0}
+        # kept up to date by users as connections attach and detach,
+        # active users are the ones with at least one connection
+        self.presence_stats = {"active_users": 0, "connections": 0}
+        self.quotas = quotas or Quotas(tenant_id)
+
+
+STATES = {DEFAULT_TENANT: State()}
+
+# creates state of tenants seen for the first time, see `configure_state_factory()`
+STATE_FACTORY = State
 
 
-STATES = {"0": State()}
+def configure_state_factory(factory):
+    global STATE_FACTORY
+    STATE_FACTORY = factory or State
 
 
-def get_state(tenant_id="0"):
+def get_state(tenant_id=DEFAULT_TENANT):
     """
     Grabs right state for specific tenant
     :param tenant_id:
     :return:
     """
     return STATES[tenant_id]
+
+
+def get_or_create_state(tenant_id):
+    """
+    Returns state of tenant, creating it when the tenant is new
+    :param tenant_id:
+    :return:
+    """
+    state = STATES.get(tenant_id)
+    if state is None:
+        state = STATES[tenant_id] = STATE_FACTORY(tenant_id)
+    return state
+
+
+def tenant_key(tenant_id, name):
+    """
+    Channel name qualified by tenant for storage shared by all tenants,
+    names of default tenant are kept as they are - NUL prefix of other
+    tenants is escaped in them, so two tenants never get the same key
+    :param tenant_id:
+    :param name:
+    :return:
+    """
+    if tenant_id == DEFAULT_TENANT:
+        if name.startswith(u"\x00"):
+            return u"\x00" + name
+        return name
+    return u"\x00{}\x00{}".format(tenant_id, name)
@@ -0,0 +1,245 @@
+"""
+Snapshots of server state - channel configuration, user state and stats.
+
+Snapshot is written periodically and on shutdown and read back when the
+server starts, so applications do not have to replay `/channel_config` and
+`/user_state` calls after every restart. Connections are not part of it,
+clients reconnect on their own. Snapshot holds state of every tenant.
+"""
+import gc
+import logging
+import marshal
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import gevent
+import six
+
+from channelstream.channel import Channel
+from channelstream.server_state import (
+    DEFAULT_TENANT,
+    get_or_create_state,
+    get_state,
+    STATES,
+)
+from channelstream.user import User
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"CSSNAP"
+VERSION = 2
+# snapshots of version 1 hold single state of the default tenant
+SUPPORTED_VERSIONS = (1, VERSION)
+# magic, snapshot version, marshal format version
+HEADER = struct.Struct("!6sHH")
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_timestamp(value):
+    return (value - EPOCH).total_seconds()
+
+
+def from_timestamp(value):
+    return EPOCH + timedelta(seconds=value)
+
+
+def take_snapshots():
+    """
+    Copies state of all tenants
+    :return:
+    """
+    return {
+        "version": VERSION,
+        "tenants": {
+            state.tenant_id: take_snapshot(state)
+            for state in list(six.itervalues(STATES))
+        },
+    }
+
+
+def take_snapshot(server_state=None):
+    """
+    Copies state of one tenant that should survive restart into plain tuples
+    :param server_state:
+    :return:
+    """
+    server_state = server_state or get_state()
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _take_snapshot(server_state)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _take_snapshot(server_state):
+    channels = [
+        (
+            channel.name,
+            channel.long_name,
+            {key: getattr(channel, key) for key in Channel.config_keys},
+        )
+        for channel in list(six.itervalues(server_state.channels))
+    ]
+    # state dicts are copied, they keep changing while snapshot gets written
+    users = [
+        (
+            user.username,
+            dict(user.state),
+            list(user.state_public_keys),
+            to_timestamp(user.last_active),
+        )
+        for user in list(six.itervalues(server_state.users))
+    ]
+    return {
+        "version": VERSION,
+        "channels": channels,
+        "users": users,
+        "stats": {
+            key: value
+            for key, value in six.iteritems(server_state.stats)
+            if key != "started_on"
+        },
+    }
+
+
+def encode_snapshot(snapshot):
+    """
+    Snapshot holds only builtin types, marshal encodes them several times
+    faster than pickle - its format depends on python version, so it is
+    part of the header
+    """
+    data = marshal.dumps(snapshot)
+    return HEADER.pack(MAGIC, VERSION, marshal.version) + zlib.compress(data, 1)
+
+
+def decode_snapshot(data):
+    if len(data) < HEADER.size:
+        raise ValueError("Snapshot is too short")
+    magic, version, marshal_version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a channelstream snapshot")
+    if version not in SUPPORTED_VERSIONS or marshal_version != marshal.version:
+        raise ValueError("Unsupported snapshot version {}".format(version))
+    snapshot = marshal.loads(zlib.decompress(data[HEADER.size :]))
+    if version == 1:
+        snapshot = {"version": VERSION, "tenants": {DEFAULT_TENANT: snapshot}}
+    return snapshot
+
+
+def write_file(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as handle:
+        handle.write(data)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.rename(tmp_path, path)
+
+
+def write_snapshot(path):
+    """
+    Writes snapshot of server state to `path`, encoding and writing
+    happens in a thread pool
+    :param path:
+    :return: size of the snapshot in bytes
+    """
+    snapshot = take_snapshots()
+    threadpool = gevent.get_hub().threadpool
+    data = threadpool.apply(encode_snapshot, (snapshot,))
+    threadpool.apply(write_file, (path, data))
+    return len(data)
+
+
+def read_snapshot(path):
+    """
+    Reads snapshot written by `write_snapshot`
+    :param path:
+    :return: snapshot or None if there is no snapshot yet
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as handle:
+        return decode_snapshot(handle.read())
+
+
+def restore_snapshot(snapshot, server_state=None):
+    """
+    Recreates channels and users from snapshot, objects that already
+    exist are left untouched
+    :param snapshot:
+    :param server_state:
+    :return:
+    """
+    server_state = server_state or get_state()
+    tenant_id = server_state.tenant_id
+    for name, long_name, config in snapshot["channels"]:
+        if name not in server_state.channels:
+            server_state.channels[name] = Channel(
+                name, long_name=long_name, channel_config=config, tenant_id=tenant_id
+            )
+    for username, state, state_public_keys, last_active in snapshot["users"]:
+        if username not in server_state.users:
+            user = User(username, tenant_id=tenant_id)
+            user.state = state
+            user.state_public_keys = state_public_keys
+            # users are still garbage collected after a day of inactivity
+            user.last_active = from_timestamp(last_active)
+            server_state.users[username] = user
+    server_state.stats.update(snapshot["stats"])
+
+
+def restore_from_file(path):
+    """
+    Restores server state at startup
+    :param path:
+    :return:
+    """
+    start = time.time()
+    # millions of new objects trigger cycle collection over and over,
+    # nothing restored is garbage so it is paused until restore is done
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        try:
+            snapshot = read_snapshot(path)
+        except Exception:
+            log.exception("failed to read snapshot {}".format(path))
+            return
+        if snapshot is None:
+            return
+        for tenant_id, tenant_snapshot in six.iteritems(snapshot["tenants"]):
+            restore_snapshot(tenant_snapshot, get_or_create_state(tenant_id))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    log.info(
+        "restored {} tenants from {} in {:.2f}s".format(
+            len(snapshot["tenants"]), path, time.time() - start
+        )
+    )
+
+
+def snapshot_forever(path, interval):
+    """
+    Writes snapshots every `interval` seconds
+    :param path:
+    :param interval:
+    :return:
+    """
+    while True:
+        gevent.sleep(interval)
+        start = time.time()
+        try:
+            size = write_snapshot(path)
+        except Exception:
+            log.exception("failed to write snapshot {}".format(path))
+            continue
+        log.info(
+            "snapshot {} written in {:.2f}s, {} bytes".format(
+                path, time.time() - start, size
+            )
+        )
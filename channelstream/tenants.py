@@ -0,0 +1,124 @@
+"""
+Tenants served by one process.
+
+Every tenant has its own `State` - channels, users, connections, locks,
+heartbeat wheel and garbage collection - and its own quotas. API requests
+select the tenant with `X-Channelstream-Tenant` header or by signing the
+secret with the tenant's own secret, requests that do neither use the
+default tenant. Clients only know their connection id, so their requests
+find the tenant by it.
+
+Garbage collection and heartbeats are scheduled separately for every
+tenant, a tenant holding millions of connections delays only its own
+passes.
+"""
+import logging
+import re
+
+import six
+
+from channelstream import server_state
+from channelstream.gc import gc_conns_forever, gc_users_forever
+from channelstream.quotas import Quotas
+from channelstream.server_state import DEFAULT_TENANT, State
+
+log = logging.getLogger(__name__)
+
+TENANT_ID_RE = re.compile(r"^[A-Za-z0-9_.-]{1,64}\Z")
+QUOTA_KEYS = ("max_connections", "max_channels", "max_messages_per_second")
+
+# quotas of tenants without their own
+DEFAULT_QUOTAS = {key: 0 for key in QUOTA_KEYS}
+# tenant id -> secret and quotas of configured tenants
+TENANTS = {}
+# tenants created after background tasks started get their own tasks too
+RUNNING = False
+
+
+def is_valid_tenant_id(tenant_id):
+    return bool(tenant_id) and TENANT_ID_RE.match(tenant_id) is not None
+
+
+def make_quotas(tenant_id):
+    limits = dict(DEFAULT_QUOTAS)
+    limits.update(
+        (key, value)
+        for key, value in six.iteritems(TENANTS.get(tenant_id, {}))
+        if key in QUOTA_KEYS
+    )
+    return Quotas(tenant_id, **limits)
+
+
+def create_state(tenant_id):
+    state = State(tenant_id, quotas=make_quotas(tenant_id))
+    if RUNNING:
+        start_tenant_tasks(state)
+    log.info("created tenant {}".format(tenant_id))
+    return state
+
+
+def configure_tenants(settings):
+    """
+    Reads quotas and tenants from server configuration, configured tenants
+    are created right away
+    :param settings: `tenant_max_*` keys set quotas of every tenant,
+                     `tenants` maps tenant id to its `secret` and quotas
+    :return:
+    """
+    DEFAULT_QUOTAS.update(
+        (key, settings.get("tenant_" + key) or 0) for key in QUOTA_KEYS
+    )
+    TENANTS.clear()
+    for tenant_id, tenant_settings in six.iteritems(settings.get("tenants") or {}):
+        if not is_valid_tenant_id(tenant_id):
+            raise ValueError("Invalid tenant id: {}".format(tenant_id))
+        TENANTS[tenant_id] = dict(tenant_settings)
+    server_state.configure_state_factory(create_state)
+    for state in list(six.itervalues(server_state.STATES)):
+        state.quotas = make_quotas(state.tenant_id)
+    for tenant_id in TENANTS:
+        server_state.get_or_create_state(tenant_id)
+
+
+def get_tenant_secrets():
+    """
+    :return: tenant id -> secret of tenants that have their own secret
+    """
+    return {
+        tenant_id: tenant_settings["secret"]
+        for tenant_id, tenant_settings in six.iteritems(TENANTS)
+        if tenant_settings.get("secret")
+    }
+
+
+def start_tenant_tasks(state):
+    gc_conns_forever(state)
+    gc_users_forever(state)
+    state.heartbeats.tick_forever()
+
+
+def start_background_tasks():
+    """
+    Starts garbage collection and heartbeats of every tenant
+    :return:
+    """
+    global RUNNING
+    RUNNING = True
+    for state in list(six.itervalues(server_state.STATES)):
+        start_tenant_tasks(state)
+
+
+def reset():
+    """
+    Forgets all tenants but the default one
+    :return:
+    """
+    global RUNNING
+    RUNNING = False
+    TENANTS.clear()
+    DEFAULT_QUOTAS.update((key, 0) for key in QUOTA_KEYS)
+    server_state.configure_state_factory(None)
+    for tenant_id in list(server_state.STATES):
+        if tenant_id != DEFAULT_TENANT:
+            del server_state.STATES[tenant_id]
+    server_state.STATES[DEFAULT_TENANT].quotas = make_quotas(DEFAULT_TENANT)
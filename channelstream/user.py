@@ -1,12 +1,16 @@
-import copy
 import logging
 import uuid
 from datetime import datetime
+from operator import itemgetter
 
 import six
 
-from channelstream.server_state import get_state
-from channelstream.utils import process_catchup
+from channelstream import cluster
+from channelstream.channel import frame_message_uuid, initial_seq
+from channelstream.frames import encode_frame
+from channelstream.envelope import Envelope
+from channelstream.ring_buffer import RingBuffer
+from channelstream.server_state import DEFAULT_TENANT, get_state
 from channelstream.validation import MSG_EDITABLE_KEYS
 
 log = logging.getLogger(__name__)
@@ -15,15 +19,20 @@ log = logging.getLogger(__name__)
 class User(object):
     """ represents a unique user of the system """
 
-    def __init__(self, username):
+    def __init__(self, username, frames_size=50, tenant_id=DEFAULT_TENANT):
         self.uuid = uuid.uuid4()
         self.username = username
+        self.tenant_id = tenant_id
         self.state = {}
         self.state_public_keys = []
         self.connections = []  # holds ids of connections
+        # channel name -> number of user connections subscribed to it
+        self.channel_connections = {}
         # store frames for fetching when connection is established
         # those frames will store private messages
-        self.frames = []
+        self.frames = RingBuffer(
+            frames_size, key=frame_message_uuid, start_seq=initial_seq()
+        )
         self.last_active = None
         self.mark_activity()
 
@@ -33,12 +42,29 @@ class User(object):
     def __repr__(self):
         return "<User:%s, connections:%s>" % (self.username, len(self.connections))
 
-    def add_frame(self, frame):
-        self.frames.append((datetime.utcnow(), frame))
-        self.frames = self.frames[-50:]
+    def add_frame(self, envelope):
+        """
+        Stores private message for catchup, envelope is created with
+        sequence number the frame gets
+        :param envelope:
+        :return:
+        """
+        seq, evicted = self.frames.append((datetime.utcnow(), envelope))
+        return seq
 
-    def get_catchup_frames(self, newer_than):
-        return [process_catchup(f[1]) for f in self.frames if f[0] > newer_than]
+    def get_catchup_frames(self, newer_than, after_seq=None):
+        """
+        Returns private messages client missed
+        :param newer_than: datetime of last activity of client
+        :param after_seq: sequence number of last private message
+                          client received
+        :return:
+        """
+        if after_seq is not None:
+            start_seq = after_seq + 1
+        else:
+            start_seq = self.frames.bisect(newer_than, key=itemgetter(0), right=True)
+        return [f[1].catchup_view() for seq, f in self.frames.entries(start_seq)]
 
     def add_connection(self, connection):
         """
@@ -46,24 +72,69 @@ class User(object):
         """
         if connection not in self.connections:
             self.connections.append(connection)
+            connection.user = self
+            presence_stats = get_state(self.tenant_id).presence_stats
+            presence_stats["connections"] += 1
+            if len(self.connections) == 1:
+                presence_stats["active_users"] += 1
+                cluster.interest_added("user", self.username, self.tenant_id)
+            for channel_name in connection.channel_names:
+                self.channel_joined(channel_name)
         # mark active
         self.mark_activity()
         return connection
 
+    def remove_connection(self, connection):
+        """
+        detaches connection from user
+        """
+        if connection not in self.connections:
+            return False
+        self.connections.remove(connection)
+        connection.user = None
+        presence_stats = get_state(self.tenant_id).presence_stats
+        presence_stats["connections"] -= 1
+        if not self.connections:
+            presence_stats["active_users"] -= 1
+            cluster.interest_removed("user", self.username, self.tenant_id)
+        for channel_name in connection.channel_names:
+            self.channel_parted(channel_name)
+        return True
+
+    def channel_joined(self, channel_name):
+        count = self.channel_connections.get(channel_name, 0)
+        self.channel_connections[channel_name] = count + 1
+
+    def channel_parted(self, channel_name):
+        count = self.channel_connections.get(channel_name, 0) - 1
+        if count > 0:
+            self.channel_connections[channel_name] = count
+        else:
+            self.channel_connections.pop(channel_name, None)
+
     def add_message(self, message):
         """
         Send a message to all connections of this user
         """
+        return self.add_messages([message])
+
+    def add_messages(self, messages):
+        """
+        Send a batch of messages to all connections of this user
+        as a single frame
+        """
+        payloads = []
+        for message in messages:
+            envelope = Envelope.from_message(message, seq=self.frames.next_seq)
+            self.add_frame(envelope)
+            payloads.append(envelope.payload)
         # mark active
-        message = copy.deepcopy(message)
-        message.pop("no_history", None)
-        message.pop("pm_users", None)
-        message.pop("exclude_users", None)
-        self.add_frame(message)
         self.mark_activity()
-        for connection in self.connections:
-            connection.add_message(message)
-        return len(self.connections)
+        if self.connections and payloads:
+            frame = encode_frame(payloads)
+            for connection in self.connections:
+                connection.add_message(frame=frame)
+        return len(self.connections) * len(payloads)
 
     def state_from_dict(self, state_dict):
         changed = []
@@ -85,35 +156,29 @@ class User(object):
         return info
 
     def get_channels(self):
-        server_state = get_state()
+        server_state = get_state(self.tenant_id)
         channels = []
-        for channel in six.itervalues(server_state.channels):
-            if channel.connections.get(self.username):
+        for channel_name in self.channel_connections:
+            channel = server_state.channels.get(channel_name)
+            if channel:
                 channels.append(channel)
         return channels
 
     def alter_message(self, to_edit):
-        # normally tried to get channel and user from history
-        for f, msg in self.frames:
-            if msg["uuid"] == to_edit["uuid"] and msg["type"] == "message":
-                msg.update(
-                    {k: v for k, v in six.iteritems(to_edit) if k in MSG_EDITABLE_KEYS}
-                )
-                break
-        altered = copy.deepcopy(to_edit)
-        altered["type"] = "message:edit"
+        seq, frame = self.frames.lookup(to_edit["uuid"])
+        if frame is not None:
+            frame[1].update(
+                {k: v for k, v in six.iteritems(to_edit) if k in MSG_EDITABLE_KEYS}
+            )
+        altered = dict(to_edit, type="message:edit")
         self.add_message(altered)
 
     def delete_message(self, to_delete):
-        # normally tried to get channel and user from history
-        for i, frame in enumerate(self.frames):
-            msg = frame[1]
-            if msg["uuid"] == to_delete["uuid"] and msg["type"] == "message":
-                self.frames.pop(i)
-                break
-
-        deleted = copy.deepcopy(to_delete)
-        deleted["type"] = "message:delete"
+        seq, frame = self.frames.lookup(to_delete["uuid"])
+        if frame is not None:
+            self.frames.discard(seq)
+
+        deleted = dict(to_delete, type="message:delete")
         self.add_message(deleted)
 
     def __json__(self, request=None):
@@ -1,9 +1,12 @@
-import copy
+import json
 import uuid
 
 import marshmallow
+import six
 from pyramid.renderers import render
 
+from channelstream.server_state import DEFAULT_TENANT
+
 
 def handle_cors(request):
     settings = request.registry.settings
@@ -28,6 +31,8 @@ def handle_cors(request):
         "Cache-Control, Pragma, Origin, "
         "Connection, Referer, Cookie",
     )
+    # long polling clients read sequence number of received frames
+    request.response.headers.add("Access-Control-Expose-Headers", "X-Channelstream-Seq")
     request.response.headers.add("Access-Control-Max-Age", "86400")
 
 
@@ -42,6 +47,15 @@ def swagger_ui_script_template(request, spec_route_name, **kwargs):
     return render("templates/explorer.jinja2", value=(), request=request)
 
 
+def request_tenant_id(request):
+    """
+    Returns tenant the request was authorized for
+    :param request:
+    :return:
+    """
+    return getattr(getattr(request, "context", None), "tenant_id", DEFAULT_TENANT)
+
+
 def uuid_from_string(str_uuid):
     try:
         return uuid.UUID(str_uuid)
@@ -49,10 +63,49 @@ def uuid_from_string(str_uuid):
         raise marshmallow.ValidationError("Wrong UUID format")
 
 
-def process_catchup(m):
-    copied = copy.deepcopy(m)
-    copied["catchup"] = True
-    copied.pop("pm_users", None)
-    copied.pop("exclude_users", None)
-    copied.pop("no_history", None)
-    return copied
+def parse_ack(value):
+    """
+    Parses sequence number long polling client acknowledges, raises
+    ValueError when it's malformed
+    :param value:
+    :return: sequence number or None when client did not send it
+    """
+    if not value:
+        return None
+    seq = int(value)
+    if seq < 0:
+        raise ValueError("Negative sequence number")
+    return seq
+
+
+def is_seq(value):
+    # JSON true/false are ints in Python, they are not sequence numbers
+    return isinstance(value, six.integer_types) and not isinstance(value, bool)
+
+
+def parse_resume_token(token):
+    """
+    Parses resume token sent by reconnecting client, it is JSON object
+    `{"channels": {"channel_name": seq}, "user": seq}` holding sequence
+    numbers of last received channel and private messages
+    :param token:
+    :return: dictionary or None if token is missing or malformed
+    """
+    if not token:
+        return None
+    try:
+        data = json.loads(token)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    channels = data.get("channels") or {}
+    if not isinstance(channels, dict):
+        return None
+    resume = {
+        "channels": {name: seq for name, seq in six.iteritems(channels) if is_seq(seq)},
+        "user": None,
+    }
+    if is_seq(data.get("user")):
+        resume["user"] = data["user"]
+    return resume
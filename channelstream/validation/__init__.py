@@ -6,7 +6,8 @@ from apispec.ext.marshmallow.openapi import OpenAPIConverter
 from marshmallow import fields, ValidationError
 from marshmallow.base import FieldABC
 
-from channelstream.server_state import get_state
+from channelstream.pagination import decode_cursor
+from channelstream.server_state import DEFAULT_TENANT, get_state
 
 converter = OpenAPIConverter("2.0.0")
 
@@ -24,18 +25,25 @@ def gen_uuid():
     return uuid.uuid4()
 
 
-def validate_connection_id(conn_id):
-    server_state = get_state()
+def validate_connection_id(conn_id, tenant_id=DEFAULT_TENANT):
+    server_state = get_state(tenant_id)
     if conn_id not in server_state.connections:
         raise marshmallow.ValidationError("Unknown connection")
 
 
-def validate_username(username):
-    server_state = get_state()
+def validate_username(username, tenant_id=DEFAULT_TENANT):
+    server_state = get_state(tenant_id)
     if username not in server_state.users:
         raise marshmallow.ValidationError("Unknown user")
 
 
+def validate_cursor(cursor):
+    try:
+        decode_cursor(cursor)
+    except ValueError:
+        raise marshmallow.ValidationError("Invalid cursor")
+
+
 def add_missing_fields(data, original, form_fields):
     for key, val in original.items():
         if key not in form_fields:
@@ -0,0 +1,271 @@
+"""
+Fast path validation of the busiest request bodies.
+
+Schemas are compiled once into plain functions that check the common case
+- JSON types the fields expect - without marshmallow's per-field error
+bookkeeping. Anything the compiled function does not accept is loaded
+by the original schema again, so invalid input gets exactly the errors
+marshmallow always reported. Fields of types not handled here are loaded
+by the field itself.
+"""
+import re
+import uuid
+from datetime import datetime
+
+import six
+from marshmallow import fields, missing, utils, ValidationError
+from marshmallow.decorators import POST_LOAD, PRE_LOAD, VALIDATES, VALIDATES_SCHEMA
+from marshmallow.validate import Validator
+
+from channelstream.validation import BackportedDict, base_types, UserStateField
+from channelstream.validation import schemas
+
+USER_STATE_TYPES = base_types + (float, int, bool)
+
+# naive timestamps like the ones `datetime.isoformat()` returns, anything
+# else is parsed by marshmallow
+ISO_DATETIME_RE = re.compile(
+    r"^([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})"
+    r"(?:\.([0-9]{6}))?\Z"
+)
+
+
+class Invalid(Exception):
+    """
+    Input the compiled function can not load, it is passed to marshmallow
+    """
+
+
+def compile_value(field):
+    """
+    Returns function doing what `field._deserialize()` does for the
+    expected input type
+    :param field:
+    :return:
+    """
+    field_type = type(field)
+    if field_type is fields.String:
+
+        def load_string(value):
+            if isinstance(value, six.text_type):
+                return value
+            raise Invalid()
+
+        return load_string
+    if field_type is fields.UUID:
+
+        def load_uuid(value):
+            if isinstance(value, six.string_types):
+                try:
+                    return uuid.UUID(value)
+                except ValueError:
+                    raise Invalid()
+            # generated by `missing` callable
+            if isinstance(value, uuid.UUID):
+                return value
+            raise Invalid()
+
+        return load_uuid
+    if field_type is fields.Boolean:
+
+        def load_boolean(value):
+            if value is True or value is False:
+                return value
+            raise Invalid()
+
+        return load_boolean
+    if field_type is fields.Integer:
+
+        def load_integer(value):
+            if type(value) in six.integer_types:
+                return value
+            raise Invalid()
+
+        return load_integer
+    if field_type is fields.DateTime and field.dateformat in (None, "iso"):
+        # marshmallow drops microseconds when it parses without dateutil
+        keep_microseconds = utils.dateutil_available
+
+        def load_datetime(value):
+            if isinstance(value, six.text_type):
+                match = ISO_DATETIME_RE.match(value)
+                if match is not None:
+                    parts = match.groups()
+                    microsecond = int(parts[6]) if parts[6] and keep_microseconds else 0
+                    try:
+                        return datetime(*[int(p) for p in parts[:6]] + [microsecond])
+                    except ValueError:
+                        raise Invalid()
+            # timezones and other formats
+            try:
+                return field._deserialize(value, None, None)
+            except ValidationError:
+                raise Invalid()
+
+        return load_datetime
+    if field_type is fields.Dict:
+
+        def load_dict(value):
+            if isinstance(value, dict):
+                return value
+            raise Invalid()
+
+        return load_dict
+    if field_type is fields.List:
+        load_item = compile_field(field.container)
+
+        def load_list(value):
+            if isinstance(value, list):
+                return [load_item(item) for item in value]
+            raise Invalid()
+
+        return load_list
+    if field_type is BackportedDict:
+        if field.key_container is None or field.value_container is None:
+            return None
+        load_key = compile_field(field.key_container)
+        load_value = compile_field(field.value_container)
+
+        def load_mapping(value):
+            if isinstance(value, dict):
+                return {load_key(k): load_value(v) for k, v in six.iteritems(value)}
+            raise Invalid()
+
+        return load_mapping
+    if field_type is UserStateField:
+
+        def load_user_state(value):
+            if isinstance(value, USER_STATE_TYPES):
+                return value
+            raise Invalid()
+
+        return load_user_state
+    if field_type is fields.Nested and not field.many:
+        return compile_schema(field.schema)
+    return None
+
+
+def compile_field(field):
+    """
+    Returns function doing what `field.deserialize()` does
+    :param field:
+    :return:
+    """
+    load_value = compile_value(field)
+    if load_value is None:
+
+        def load_with_field(value):
+            try:
+                return field.deserialize(value)
+            except ValidationError:
+                raise Invalid()
+
+        return load_with_field
+
+    allow_none = field.allow_none is True
+    validators = list(field.validators)
+
+    def load_field(value):
+        if value is None:
+            if allow_none:
+                return None
+            raise Invalid()
+        value = load_value(value)
+        for validator in validators:
+            try:
+                result = validator(value)
+            except ValidationError:
+                raise Invalid()
+            if result is False and not isinstance(validator, Validator):
+                raise Invalid()
+        return value
+
+    return load_field
+
+
+def compile_schema(schema):
+    """
+    Returns function loading single object the way `schema.load()` does
+    :param schema:
+    :return:
+    """
+    processors = schema.__processors__
+    for tag in (PRE_LOAD, VALIDATES, VALIDATES_SCHEMA):
+        if processors[(tag, False)] or processors[(tag, True)]:
+            raise ValueError(
+                "{} can not be compiled, it has {} hooks".format(
+                    schema.__class__.__name__, tag
+                )
+            )
+    if processors[(POST_LOAD, True)]:
+        raise ValueError(
+            "{} can not be compiled, it has pass_many post_load hooks".format(
+                schema.__class__.__name__
+            )
+        )
+    post_load = bool(processors[(POST_LOAD, False)])
+    plan = []
+    for name, field in six.iteritems(schema.fields):
+        if field.dump_only:
+            continue
+        if field.load_from or field.attribute or "." in name:
+            raise ValueError(
+                "{}.{} can not be compiled".format(schema.__class__.__name__, name)
+            )
+        plan.append((name, compile_field(field), field.missing, field.required))
+    dict_class = schema.dict_class
+
+    def load_object(data):
+        if not isinstance(data, dict):
+            raise Invalid()
+        result = dict_class()
+        for name, load_field, default, required in plan:
+            value = data.get(name, missing)
+            if value is missing:
+                value = default() if callable(default) else default
+                if value is missing:
+                    if required:
+                        raise Invalid()
+                    continue
+            result[name] = load_field(value)
+        if post_load:
+            result = schema._invoke_load_processors(
+                POST_LOAD, result, False, original_data=data
+            )
+        return result
+
+    return load_object
+
+
+class CompiledSchema(object):
+    """
+    Loads data like `schema_class(many=many).load(data).data` would
+    """
+
+    def __init__(self, schema_class):
+        self.schema_class = schema_class
+        self.load_object = compile_schema(schema_class())
+
+    def load(self, data, many=False, context=None):
+        """
+
+        :param data:
+        :param many:
+        :param context: schema context, only used when marshmallow
+                        loads the data
+        :return:
+        """
+        try:
+            if many:
+                if not isinstance(data, list):
+                    raise Invalid()
+                return [self.load_object(item) for item in data]
+            return self.load_object(data)
+        except Invalid:
+            schema = self.schema_class(context=context or {}, many=many)
+            return schema.load(data).data
+
+
+CONNECT_BODY = CompiledSchema(schemas.ConnectBodySchema)
+MESSAGE_BODY = CompiledSchema(schemas.MessageBodySchema)
+MESSAGE_EDIT_BODY = CompiledSchema(schemas.MessageEditBodySchema)
@@ -3,11 +3,13 @@ from datetime import datetime
 import marshmallow
 from marshmallow import validate, fields
 
+from channelstream.utils import request_tenant_id
 from channelstream.validation import (
     BackportedDict,
     ChannelstreamSchema,
     gen_uuid,
     validate_connection_id,
+    validate_cursor,
     validate_username,
     UserStateField,
 )
@@ -35,6 +37,11 @@ class ChannelConfigSchema(ChannelstreamSchema):
     store_frames = fields.Boolean(
         missing=True, description="Should store catchup frames"
     )
+    frames_size = fields.Integer(
+        missing=100,
+        validate=[validate.Range(min=0)],
+        description="How many catchup frames should be stored",
+    )
 
 
 class InfoResolutionSchema(ChannelstreamSchema):
@@ -48,8 +55,56 @@ class InfoResolutionSchema(ChannelstreamSchema):
     return_public_state = fields.Boolean(missing=False)
 
 
+class InfoFilterSchema(ChannelstreamSchema):
+    limit = fields.Integer(
+        missing=None,
+        validate=[validate.Range(min=1, max=10000)],
+        description="How many channels should be returned, all of them when not set",
+    )
+    cursor = fields.String(
+        missing=None,
+        validate=validate_cursor,
+        description="next_cursor of previous page",
+    )
+    channel_prefix = fields.String(
+        missing=None,
+        validate=validate.Length(min=1, max=256),
+        description="Only channels with names starting with the prefix",
+    )
+    active_since = fields.DateTime(
+        missing=None, description="Only channels active since the date"
+    )
+    user = fields.String(
+        missing=None,
+        validate=validate.Length(min=1, max=512),
+        description="Only channels the user is subscribed to",
+    )
+    stream = fields.Boolean(
+        missing=False,
+        description="Should the response be streamed in chunks, "
+        "other requests are served between them",
+    )
+
+
+class PagedInfoResolutionSchema(InfoResolutionSchema, InfoFilterSchema):
+    pass
+
+
 class ChannelInfoBodySchema(ChannelstreamSchema):
-    info = fields.Nested(InfoResolutionSchema, required=True)
+    info = fields.Nested(PagedInfoResolutionSchema, required=True)
+
+
+class AdminInfoSchema(InfoFilterSchema):
+    user_cursor = fields.String(
+        missing=None,
+        validate=validate_cursor,
+        description="next_user_cursor of previous page",
+    )
+    summary = fields.Boolean(
+        missing=False,
+        description="Should only counters be returned, without channel "
+        "and user listings",
+    )
 
 
 class ConnectBodySchema(ChannelstreamSchema):
@@ -106,7 +161,7 @@ class ConnectBodySchema(ChannelstreamSchema):
 
 
 class SubscribeBodySchema(ChannelstreamSchema):
-    conn_id = fields.UUID(required=True, validate=[validate_connection_id])
+    conn_id = fields.UUID(required=True)
 
     channels = fields.List(
         fields.String(validate=validate.Length(min=1, max=256)),
@@ -129,15 +184,17 @@ class SubscribeBodySchema(ChannelstreamSchema):
         in_data.setdefault("conn_id", self.context["request"].GET.get("conn_id"))
         return in_data
 
+    @marshmallow.validates("conn_id")
+    def validate_conn_id(self, value):
+        validate_connection_id(value, request_tenant_id(self.context.get("request")))
+
 
 class UnsubscribeBodySchema(SubscribeBodySchema):
     pass
 
 
 class UserStateBodySchema(ChannelstreamSchema):
-    user = fields.String(
-        required=True, validate=[validate.Length(min=1, max=512), validate_username]
-    )
+    user = fields.String(required=True, validate=[validate.Length(min=1, max=512)])
 
     user_state = BackportedDict(
         missing=lambda: {},
@@ -153,6 +210,10 @@ class UserStateBodySchema(ChannelstreamSchema):
         description="What state keys should be visible/emitted to other users",
     )
 
+    @marshmallow.validates("user")
+    def validate_user(self, value):
+        validate_username(value, request_tenant_id(self.context.get("request")))
+
 
 class PayloadDeliveryInfo(ChannelstreamSchema):
     pm_users = fields.List(
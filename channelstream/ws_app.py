@@ -1,8 +1,8 @@
 from six.moves.urllib.parse import parse_qs
 from ws4py.websocket import WebSocket
 
-from channelstream import utils
-from channelstream.server_state import get_state
+from channelstream import operations, utils
+from channelstream.server_state import DEFAULT_TENANT, get_state
 
 
 class ChatApplicationSocket(WebSocket):
@@ -10,22 +10,28 @@ class ChatApplicationSocket(WebSocket):
         super(ChatApplicationSocket, self).__init__(*args, **kwargs)
         self.qs = None
         self.conn_id = None
+        # connection ids are unique across tenants, tenant is found by it
+        self.tenant_id = DEFAULT_TENANT
 
     def opened(self):
-        server_state = get_state()
         self.qs = parse_qs(self.environ["QUERY_STRING"])
         self.conn_id = utils.uuid_from_string(self.qs.get("conn_id")[0])
-        if self.conn_id not in server_state.connections:
+        connection = operations.find_connection(self.conn_id)
+        if connection is None:
             # close connection instantly if user played with id
             self.close()
         else:
+            self.tenant_id = connection.tenant_id
             # attach a socket to connection
-            connection = server_state.connections[self.conn_id]
             connection.socket = self
-            connection.deliver_catchup_messages()
+            connection.attached_locally()
+            resume = self.qs.get("resume")
+            connection.deliver_catchup_messages(
+                utils.parse_resume_token(resume[0] if resume else None)
+            )
 
     def received_message(self, m):
-        server_state = get_state()
+        server_state = get_state(self.tenant_id)
         # this is to allow client heartbeats
         if self.conn_id in server_state.connections:
             connection = server_state.connections[self.conn_id]
@@ -35,7 +41,7 @@ class ChatApplicationSocket(WebSocket):
                 user.mark_activity()
 
     def closed(self, code, reason=""):
-        server_state = get_state()
+        server_state = get_state(self.tenant_id)
         self.environ.pop("ws4py.app")
         found_conn = self.conn_id in server_state.connections
         if hasattr(self, "conn_id") and found_conn:
@@ -8,7 +8,7 @@ from pyramid.renderers import JSON
 from pyramid.security import NO_PERMISSION_REQUIRED
 
 from channelstream import patched_json as json
-from channelstream.wsgi_views.wsgi_security import APIFactory
+from channelstream.wsgi_views.wsgi_security import APIFactory, APISecurity
 
 
 def datetime_adapter(obj, request):
@@ -33,6 +33,9 @@ def make_app(server_config):
             return "admin", username
         return None
 
+    # signer and allow list are built once, not for every API call
+    config.registry.api_security = APISecurity(server_config)
+
     authn_policy = BasicAuthAuthenticationPolicy(check_function, realm="ChannelStream")
     authz_policy = ACLAuthorizationPolicy()
 
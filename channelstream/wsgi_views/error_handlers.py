@@ -12,3 +12,9 @@ def marshmallow_invalid_data(context, request):
 def itsdangerous_signer_error(context, request):
     request.response.status = 401
     return {"request": "Bad Signature"}
+
+
+@exception_view_config(context="channelstream.quotas.QuotaExceeded", renderer="json")
+def quota_exceeded(context, request):
+    request.response.status = 429
+    return {"request": "Quota exceeded", "quota": context.quota, "limit": context.limit}
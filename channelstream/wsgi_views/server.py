@@ -1,27 +1,147 @@
+import heapq
 import logging
+import time
+from collections import OrderedDict
 from datetime import datetime
+from operator import attrgetter
 
 import gevent
+import marshmallow
 import six
 from apispec import APISpec
 from apispec.ext.marshmallow import MarshmallowPlugin
-from gevent.queue import Queue, Empty
-from pyramid.httpexceptions import HTTPUnauthorized
+from gevent.queue import Empty
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound, HTTPUnauthorized
 from pyramid.security import forget, NO_PERMISSION_REQUIRED
 from pyramid.view import view_config, view_defaults
 from pyramid_apispec.helpers import add_pyramid_paths
 
-from channelstream import operations, utils, patched_json as json
-from channelstream.server_state import get_state, STATS
-from channelstream.validation import schemas
+from channelstream import (
+    bus,
+    cluster,
+    history_store,
+    metrics,
+    operations,
+    pagination,
+    patched_json,
+    utils,
+)
+from channelstream.frames import join_frames
+from channelstream.outbound import LongPollBuffer
+from channelstream.server_state import get_state, STATES, STATS
+from channelstream.validation import compiled, schemas
 
 log = logging.getLogger(__name__)
 
 
+def request_state(request):
+    """
+    Returns state of the tenant request was authorized for
+    :param request:
+    :return:
+    """
+    return get_state(utils.request_tenant_id(request))
+
+
+def naive_utc(date):
+    """
+    Converts timezone aware datetime to naive UTC one used by channels/users
+    :param date:
+    :return:
+    """
+    if date is None or date.tzinfo is None:
+        return date
+    return (date - date.utcoffset()).replace(tzinfo=None)
+
+
+def stream_response(request, data):
+    """
+    Returns response sending data encoded in chunks, see
+    `patched_json.iter_chunks()`
+    :param request:
+    :param data:
+    :return:
+    """
+    response = request.response
+    response.content_type = "application/json"
+    response.charset = "utf-8"
+    response.app_iter = yield_chunks(data)
+    return response
+
+
+def yield_chunks(data):
+    for chunk in patched_json.iter_chunks(data):
+        yield chunk
+        # serve other greenlets between chunks of big responses
+        gevent.sleep(0)
+
+
 class SharedUtils(object):
     def __init__(self, request):
         self.request = request
 
+    def select_channels(
+        self,
+        req_channels=None,
+        exclude_channels=None,
+        channel_prefix=None,
+        active_since=None,
+        user=None,
+        cursor=None,
+        limit=None,
+    ):
+        """
+        Returns channels matching the filters and cursor of their next page
+        :param req_channels: channel names, all channels when None
+        :param exclude_channels: channel names to leave out
+        :param channel_prefix: only channels with names starting with it
+        :param active_since: only channels active since the date
+        :param user: only channels the user is subscribed to
+        :param cursor: `next_cursor` of previous page
+        :param limit: page size, see `pagination.paginate()`
+        :return: (channels, next_cursor)
+        """
+        server_state = request_state(self.request)
+        exclude_channels = set(exclude_channels or [])
+        active_since = naive_utc(active_since)
+        if user is not None:
+            user_inst = server_state.users.get(user)
+            names = list(user_inst.channel_connections) if user_inst else []
+            if req_channels is not None:
+                req_channels = set(req_channels)
+                names = [name for name in names if name in req_channels]
+        elif req_channels is not None:
+            names = req_channels
+        else:
+            names = None
+
+        # select everything for empty list
+        if names is None:
+            channel_instances = six.itervalues(server_state.channels)
+        else:
+            channel_instances = (
+                server_state.channels[c] for c in names if c in server_state.channels
+            )
+
+        def matches(channel_inst):
+            if channel_inst.name in exclude_channels:
+                return False
+            if channel_prefix and not channel_inst.name.startswith(channel_prefix):
+                return False
+            if active_since is not None and (
+                channel_inst.last_active is None
+                or channel_inst.last_active < active_since
+            ):
+                return False
+            return True
+
+        return pagination.paginate(
+            (c for c in channel_instances if matches(c)),
+            key=attrgetter("name"),
+            cursor=cursor,
+            limit=limit,
+        )
+
     def get_channel_info(
         self,
         req_channels=None,
@@ -30,6 +150,12 @@ class SharedUtils(object):
         include_users=False,
         exclude_channels=None,
         return_public_state=False,
+        channel_prefix=None,
+        active_since=None,
+        user=None,
+        cursor=None,
+        limit=None,
+        stream=False,
     ):
         """
         Gets channel information for req_channels or all channels
@@ -41,47 +167,61 @@ class SharedUtils(object):
         :param: include_users (bool) will include user list for the channel
         :param: exclude_channels (bool) will exclude specific channels
                 from info list (handy to exclude global broadcast)
+        :param: channel_prefix, active_since, user, cursor, limit
+                filter and paginate channels, see `select_channels()`,
+                `next_cursor` is returned when cursor or limit is set
+        :param: stream (bool) channel and user information is computed
+                while the response is sent, see `stream_response()`
         """
-        server_state = get_state()
-        if not exclude_channels:
-            exclude_channels = []
+        server_state = request_state(self.request)
         start_time = datetime.utcnow()
-
-        json_data = {"channels": {}, "users": []}
+        channel_instances, next_cursor = self.select_channels(
+            req_channels,
+            exclude_channels=exclude_channels,
+            channel_prefix=channel_prefix,
+            active_since=active_since,
+            user=user,
+            cursor=cursor,
+            limit=limit,
+        )
 
         users_to_list = set()
 
-        # select everything for empty list
-        if req_channels is None:
-            channel_instances = six.itervalues(server_state.channels)
-        else:
-            channel_instances = [
-                server_state.channels[c]
-                for c in req_channels
-                if c in server_state.channels
-            ]
-
-        for channel_inst in channel_instances:
-            if channel_inst.name in exclude_channels:
-                continue
-
-            channel_info = channel_inst.get_info(
-                include_history=include_history, include_users=include_users
-            )
-            json_data["channels"][channel_inst.name] = channel_info
-            users_to_list.update(channel_info["users"])
+        def channel_infos():
+            for channel_inst in channel_instances:
+                channel_info = channel_inst.get_info(
+                    include_history=include_history, include_users=include_users
+                )
+                users_to_list.update(channel_info["users"])
+                yield channel_inst.name, channel_info
 
-        for username in users_to_list:
-            user = server_state.users[username]
-            json_data["users"].append(
-                {
+        # runs after channel_infos() collected the users
+        def user_infos():
+            for username in users_to_list:
+                user_inst = server_state.users.get(username)
+                # users can be collected while response is streamed
+                if user_inst is None:
+                    continue
+                yield {
                     "user": username,
-                    "state": user.state
+                    "state": user_inst.state
                     if not return_public_state
-                    else user.public_state,
+                    else user_inst.public_state,
                 }
+
+        if stream:
+            json_data = OrderedDict(
+                [
+                    ("channels", patched_json.StreamedObject(channel_infos())),
+                    ("users", patched_json.StreamedArray(user_infos())),
+                ]
             )
-        log.info("info time: %s" % (datetime.utcnow() - start_time))
+        else:
+            json_data = {"channels": dict(channel_infos())}
+            json_data["users"] = list(user_infos())
+            log.info("info time: %s" % (datetime.utcnow() - start_time))
+        if cursor is not None or limit is not None:
+            json_data["next_cursor"] = next_cursor
         return json_data
 
     def get_common_info(self, channels, info_config):
@@ -103,6 +243,12 @@ class SharedUtils(object):
             include_users=include_users,
             exclude_channels=exclude_channels,
             return_public_state=return_public_state,
+            channel_prefix=info_config.get("channel_prefix"),
+            active_since=info_config.get("active_since"),
+            user=info_config.get("user"),
+            cursor=info_config.get("cursor"),
+            limit=info_config.get("limit"),
+            stream=info_config.get("stream", False),
         )
         return channels_info
 
@@ -139,11 +285,19 @@ def connect(request):
           schema:
             $ref: '#/definitions/ConnectBody'
     """
+    server_state = request_state(request)
     shared_utils = SharedUtils(request)
-    schema = schemas.ConnectBodySchema(context={"request": request})
-    json_body = schema.load(request.json_body).data
+    json_body = compiled.CONNECT_BODY.load(
+        request.json_body, context={"request": request}
+    )
     channels = sorted(json_body["channels"])
-    connection, user = operations.connect(
+    # clients find their tenant by connection id
+    existing = operations.get_connection(json_body["conn_id"])
+    if existing is not None and existing.tenant_id != server_state.tenant_id:
+        raise marshmallow.ValidationError({"conn_id": ["Connection id is taken"]})
+    server_state.quotas.check_connection(server_state, json_body["conn_id"])
+    server_state.quotas.check_channels(server_state, channels)
+    connect_kwargs = dict(
         username=json_body["username"],
         fresh_user_state=json_body["fresh_user_state"],
         state_public_keys=json_body["state_public_keys"],
@@ -151,7 +305,12 @@ def connect(request):
         conn_id=json_body["conn_id"],
         channels=channels,
         channel_configs=json_body["channel_configs"],
+        tenant_id=server_state.tenant_id,
     )
+    connection, user = operations.connect(**connect_kwargs)
+    # other workers need to know the generated connection id
+    connect_kwargs["conn_id"] = connection.id
+    bus.publish("connect", **connect_kwargs)
 
     # get info config for channel information
     channels_info = shared_utils.get_common_info(channels, json_body["info"])
@@ -196,16 +355,24 @@ def subscribe(request):
         200:
           description: "Success"
     """
-    server_state = get_state()
+    server_state = request_state(request)
     shared_utils = SharedUtils(request)
     schema = schemas.SubscribeBodySchema(context={"request": request})
     json_body = schema.load(request.json_body).data
     connection = server_state.connections.get(json_body["conn_id"])
     channels = json_body["channels"]
     channel_configs = json_body.get("channel_configs", {})
+    server_state.quotas.check_channels(server_state, channels)
     subscribed_to = operations.subscribe(
         connection=connection, channels=channels, channel_configs=channel_configs
     )
+    bus.publish(
+        "subscribe",
+        conn_id=connection.id,
+        channels=channels,
+        channel_configs=channel_configs,
+        tenant_id=server_state.tenant_id,
+    )
 
     # get info config for channel information
     current_channels = connection.channels
@@ -247,7 +414,7 @@ def unsubscribe(request):
         200:
           description: "Success"
     """
-    server_state = get_state()
+    server_state = request_state(request)
     shared_utils = SharedUtils(request)
     schema = schemas.UnsubscribeBodySchema(context={"request": request})
     json_body = schema.load(request.json_body).data
@@ -255,6 +422,12 @@ def unsubscribe(request):
     unsubscribed_from = operations.unsubscribe(
         connection=connection, unsubscribe_channels=json_body["channels"]
     )
+    bus.publish(
+        "unsubscribe",
+        conn_id=connection.id,
+        channels=json_body["channels"],
+        tenant_id=server_state.tenant_id,
+    )
 
     # get info config for channel information
     current_channels = connection.channels
@@ -288,47 +461,97 @@ def listen(request):
         200:
           description: "Success"
     """
-    server_state = get_state()
     config = request.registry.settings
     conn_id = utils.uuid_from_string(request.params.get("conn_id"))
-    connection = server_state.connections.get(conn_id)
+    connection = operations.find_connection(conn_id)
     if not connection:
         raise HTTPUnauthorized()
-    # attach a queue to connection
-    connection.queue = Queue()
-    connection.deliver_catchup_messages()
-    request.response.app_iter = yield_response(request, connection, config)
+    try:
+        ack = utils.parse_ack(request.params.get("ack"))
+    except ValueError:
+        raise HTTPBadRequest()
+    # buffer is kept between polls, catchup is only needed when it's new
+    buffer = connection.queue
+    new_buffer = not isinstance(buffer, LongPollBuffer) or buffer.closed
+    if new_buffer:
+        # numbering continues when another worker served previous polls,
+        # it hands over frames client did not acknowledge
+        connection.queue = LongPollBuffer(
+            on_overflow=connection.buffer_overflowed, seq=ack or 0
+        )
+    connection.attached_locally()
+    if new_buffer:
+        connection.deliver_catchup_messages(
+            utils.parse_resume_token(request.params.get("resume"))
+        )
+    connection.queue.acknowledge(ack)
+    start = time.time()
+    frames = poll_frames(connection, config)
+    metrics.LONG_POLL_WAIT.observe(time.time() - start)
+    metrics.LONG_POLL_FRAMES.observe(len(frames))
+    connection.mark_activity()
+    # client sends this back as `ack` with next poll
+    request.response.headers["X-Channelstream-Seq"] = str(connection.queue.seq)
+    request.response.app_iter = yield_response(request, frames)
     return request.response
 
 
-def yield_response(request, connection, config):
-    messages = await_data(connection, config)
-    connection.mark_activity()
+def yield_response(request, frames):
+    # frames are already encoded, so they are only concatenated here
+    resp = join_frames(frames)
     cb = request.params.get("callback")
     if cb:
-        resp = cb + "(" + json.dumps(messages) + ")"
-    else:
-        resp = json.dumps(messages)
-    if six.PY2:
-        yield resp
+        resp = cb.encode("utf8") + b"(" + resp + b")"
+    yield resp
+
+
+def poll_frames(connection, config):
+    """
+    Returns frames for long poll response - frames client did not
+    acknowledge are sent again together with whatever is queued,
+    otherwise it waits for new frames
+    """
+    buffer = connection.queue
+    resent = buffer.unacknowledged_frames()
+    if resent:
+        frames = buffer.drain()
     else:
-        yield resp.encode("utf8")
+        frames = await_data(connection, config)
+    buffer.delivered(frames)
+    return resent + frames
 
 
 def await_data(connection, config):
-    messages = []
+    """
+    Blocks for the first frame, then drains whatever is already queued and
+    waits up to the coalescing window for more - the response is sent once
+    the window passes without new frames, the batch is full or
+    `long_poll_max_wait` seconds passed since the first frame
+    """
+    queue = connection.queue
+    frames = []
     # block for first message - wake up after a while
     try:
-        messages.extend(connection.queue.get(timeout=config["wake_connections_after"]))
+        frames.append(queue.get(timeout=config["wake_connections_after"]))
     except Empty:
-        pass
-    # get more messages if enqueued takes up total 0.25
-    while True:
+        return frames
+    window = config["long_poll_coalesce_window"]
+    max_batch = config["long_poll_max_batch"]
+    deadline = time.time() + config["long_poll_max_wait"]
+    while len(frames) < max_batch:
+        try:
+            frames.append(queue.get_nowait())
+            continue
+        except Empty:
+            pass
+        timeout = min(window, deadline - time.time())
+        if timeout <= 0:
+            break
         try:
-            messages.extend(connection.queue.get(timeout=0.25))
+            frames.append(queue.get(timeout=timeout))
         except Empty:
             break
-    return messages
+    return frames
 
 
 @view_config(route_name="legacy_user_state", request_method="POST", renderer="json")
@@ -361,7 +584,7 @@ def user_state(request):
         200:
           description: "Success"
     """
-    server_state = get_state()
+    server_state = request_state(request)
     schema = schemas.UserStateBodySchema(context={"request": request})
     data = schema.load(request.json_body).data
     user_inst = server_state.users[data["user"]]
@@ -371,6 +594,13 @@ def user_state(request):
     changed = operations.change_user_state(
         user_inst=user_inst, user_state=data["user_state"]
     )
+    bus.publish(
+        "user_state",
+        user=data["user"],
+        user_state=data["user_state"],
+        state_public_keys=data["state_public_keys"],
+        tenant_id=server_state.tenant_id,
+    )
     return {
         "user_state": user_inst.state,
         "changed_state": changed,
@@ -379,12 +609,21 @@ def user_state(request):
 
 
 def shared_messages(request):
-    server_state = get_state()
-    schema = schemas.MessageBodySchema(context={"request": request}, many=True)
-    data = schema.load(request.json_body).data
+    server_state = request_state(request)
+    data = compiled.MESSAGE_BODY.load(
+        request.json_body, many=True, context={"request": request}
+    )
     data = [m for m in data if m.get("channel") or m.get("pm_users")]
-    for msg in data:
-        gevent.spawn(operations.pass_message, msg, server_state.stats)
+    server_state.quotas.consume_messages(len(data))
+    bus.publish("messages", messages=data, tenant_id=server_state.tenant_id)
+    # whole request is delivered by one greenlet so messages
+    # for the same channel end up in a single frame
+    gevent.spawn(
+        operations.pass_messages,
+        data,
+        server_state.stats,
+        tenant_id=server_state.tenant_id,
+    )
     return list(data)
 
 
@@ -486,10 +725,13 @@ def messages_patch(request):
           description: "Success"
     """
 
-    schema = schemas.MessageEditBodySchema(context={"request": request}, many=True)
-    data = schema.load(request.json_body).data
+    tenant_id = utils.request_tenant_id(request)
+    data = compiled.MESSAGE_EDIT_BODY.load(
+        request.json_body, many=True, context={"request": request}
+    )
+    bus.publish("edit_messages", messages=data, tenant_id=tenant_id)
     for msg in data:
-        gevent.spawn(operations.edit_message, msg)
+        gevent.spawn(operations.edit_message, msg, tenant_id=tenant_id)
     return data
 
 
@@ -524,10 +766,12 @@ def messages_delete(request):
           description: "Success"
     """
 
+    tenant_id = utils.request_tenant_id(request)
     schema = schemas.MessagesDeleteBodySchema(context={"request": request}, many=True)
     data = schema.load(request.json_body).data
+    bus.publish("delete_messages", messages=data, tenant_id=tenant_id)
     for msg in data:
-        gevent.spawn(operations.delete_message, msg)
+        gevent.spawn(operations.delete_message, msg, tenant_id=tenant_id)
     return data
 
 
@@ -588,6 +832,7 @@ def disconnect(request):
         json_body = request.json_body
         payload = {"conn_id": json_body.get("conn_id")}
     data = schema.load(payload).data
+    bus.publish("disconnect", conn_id=data["conn_id"])
     return operations.disconnect(conn_id=data["conn_id"])
 
 
@@ -621,6 +866,7 @@ def channel_config(request):
           description: "Success"
     """
 
+    server_state = request_state(request)
     shared_utils = SharedUtils(request)
 
     deserialized = {}
@@ -628,7 +874,13 @@ def channel_config(request):
     json_body = request.json_body
     for k in json_body.keys():
         deserialized[k] = schema.load(json_body[k]).data
-    operations.set_channel_config(channel_configs=deserialized)
+    server_state.quotas.check_channels(server_state, deserialized.keys())
+    operations.set_channel_config(
+        channel_configs=deserialized, tenant_id=server_state.tenant_id
+    )
+    bus.publish(
+        "channel_config", channel_configs=deserialized, tenant_id=server_state.tenant_id
+    )
     channels_info = shared_utils.get_channel_info(
         deserialized.keys(), include_history=False, include_users=False
     )
@@ -664,10 +916,10 @@ def info(request):
         200:
           description: "Success"
     """
-    server_state = get_state()
+    server_state = request_state(request)
     shared_utils = SharedUtils(request)
     if not request.body:
-        req_channels = server_state.channels.keys()
+        req_channels = None
         info_config = {
             "include_history": True,
             "include_users": True,
@@ -684,9 +936,45 @@ def info(request):
             "include_connections", True
         )
     channels_info = shared_utils.get_common_info(req_channels, info_config)
+    if info_config.get("stream"):
+        return stream_response(request, channels_info)
     return channels_info
 
 
+@view_config(route_name="metrics", request_method="GET", permission="access")
+def metrics_view(request):
+    """
+    Returns metrics of this process in Prometheus text format
+    ---
+    get:
+      tags:
+      - "Admin API"
+      summary: "Returns metrics in Prometheus text format"
+      description: ""
+      operationId: "metrics"
+      produces:
+      - "text/plain"
+      responses:
+        200:
+          description: "Success"
+    """
+    samples = metrics.state_samples(list(six.itervalues(STATES)))
+    if history_store.STORE is not None:
+        samples.append(
+            (
+                "channelstream_history_store_pending_records",
+                "gauge",
+                "Records waiting to be written to history store",
+                len(history_store.STORE.pending),
+            )
+        )
+    response = request.response
+    response.content_type = "text/plain"
+    response.charset = "utf-8"
+    response.text = metrics.render(samples)
+    return response
+
+
 @view_defaults(route_name="action", renderer="json", permission="access")
 class ServerViews(object):
     def __init__(self, request):
@@ -725,9 +1013,40 @@ class ServerViews(object):
           produces:
           - "application/json"
           parameters:
-          - in: "body"
-            name: "body"
-            description: "Response info configuration"
+          - in: "query"
+            name: "limit"
+            type: "integer"
+            description: "How many channels and users should be returned"
+          - in: "query"
+            name: "cursor"
+            type: "string"
+            description: "next_cursor of previous page"
+          - in: "query"
+            name: "user_cursor"
+            type: "string"
+            description: "next_user_cursor of previous page"
+          - in: "query"
+            name: "channel_prefix"
+            type: "string"
+            description: "Only channels with names starting with the prefix"
+          - in: "query"
+            name: "active_since"
+            type: "string"
+            format: "date-time"
+            description: "Only channels and users active since the date"
+          - in: "query"
+            name: "user"
+            type: "string"
+            description: "Only the user and channels the user is subscribed to"
+          - in: "query"
+            name: "stream"
+            type: "boolean"
+            description: "Should the response be streamed in chunks"
+          - in: "query"
+            name: "summary"
+            type: "boolean"
+            description: "Should only counters be returned, without channel
+            and user listings"
           responses:
             422:
               description: "Unprocessable Entity"
@@ -747,44 +1066,108 @@ class ServerViews(object):
           parameters:
           - in: "body"
             name: "body"
-            description: "Response info configuration"
+            description: "Response info configuration, same keys as GET
+            query parameters"
           responses:
             422:
               description: "Unprocessable Entity"
             200:
               description: "Success"
         """
-        server_state = get_state()
+        tenant_id = utils.request_tenant_id(self.request)
+        server_state = STATES.get(tenant_id)
+        if server_state is None:
+            raise HTTPNotFound()
+        if self.request.method == "POST" and self.request.body:
+            params = self.request.json_body
+        else:
+            params = dict(self.request.GET)
+        schema = schemas.AdminInfoSchema(context={"request": self.request})
+        params = schema.load(params).data
+        paginated = any(
+            params[key] is not None for key in ("limit", "cursor", "user_cursor")
+        )
         uptime = datetime.utcnow() - STATS["started_on"]
         uptime = str(uptime).split(".")[0]
-        remembered_user_count = len(
-            [user for user in six.iteritems(server_state.users)]
-        )
-        active_users = [
-            user for user in six.itervalues(server_state.users) if user.connections
-        ]
-        unique_user_count = len(active_users)
-        total_connections = sum([len(user.connections) for user in active_users])
-        channels_info = self.utils.get_common_info(
-            None,
-            {
-                "include_history": True,
-                "include_users": True,
-                "exclude_channels": [],
-                "include_connections": True,
+        presence_stats = server_state.presence_stats
+        json_data = {
+            "tenant": tenant_id,
+            "quotas": server_state.quotas.get_info(),
+            "tenants": {
+                state.tenant_id: {
+                    "connections": len(state.connections),
+                    "users": len(state.users),
+                    "channels": len(state.channels),
+                }
+                for state in list(six.itervalues(STATES))
             },
-        )
-        return {
-            "remembered_user_count": remembered_user_count,
-            "unique_user_count": unique_user_count,
-            "total_connections": total_connections,
-            "total_channels": len(server_state.channels.keys()),
+            "remembered_user_count": len(server_state.users),
+            "unique_user_count": presence_stats["active_users"],
+            "total_connections": presence_stats["connections"],
+            "total_channels": len(server_state.channels),
             "total_messages": server_state.stats["total_messages"],
             "total_unique_messages": server_state.stats["total_unique_messages"],
-            "channels": channels_info["channels"],
-            "users": [user.get_info(include_connections=True) for user in active_users],
             "uptime": uptime,
+            "heartbeat": server_state.heartbeats.get_info(),
+            "gc": server_state.gc_stats,
+            "bus": bus.BUS.get_info() if bus.BUS else None,
+            "cluster": cluster.NODE.get_info() if cluster.NODE else None,
+            "history_store": history_store.STORE.get_info()
+            if history_store.STORE
+            else None,
+            "outbound": dict(server_state.outbound_stats),
         }
+        # everything above is read from counters, the rest scans the state
+        if params["summary"]:
+            return json_data
+        # connections with most overflowing outbound buffers
+        worst_connections = heapq.nlargest(
+            10,
+            [c for c in six.itervalues(server_state.connections) if c.overflows],
+            key=lambda c: c.overflows,
+        )
+        json_data["outbound"]["worst_connections"] = [
+            {"id": conn.id, "user": conn.username, "overflows": conn.overflows}
+            for conn in worst_connections
+        ]
+        active_since = naive_utc(params["active_since"])
+        listed_users, next_user_cursor = pagination.paginate(
+            (
+                user
+                for user in six.itervalues(server_state.users)
+                if user.connections
+                and (params["user"] is None or user.username == params["user"])
+                and (active_since is None or user.last_active >= active_since)
+            ),
+            key=attrgetter("username"),
+            cursor=params["user_cursor"],
+            limit=params["limit"],
+        )
+        channels_info = self.utils.get_channel_info(
+            None,
+            include_history=True,
+            include_users=True,
+            include_connections=True,
+            channel_prefix=params["channel_prefix"],
+            active_since=active_since,
+            user=params["user"],
+            cursor=params["cursor"],
+            limit=params["limit"],
+            stream=params["stream"],
+        )
+        users_info = (user.get_info(include_connections=True) for user in listed_users)
+        if paginated:
+            json_data["next_cursor"] = channels_info.get("next_cursor")
+            json_data["next_user_cursor"] = next_user_cursor
+        if params["stream"]:
+            # listings go last, so streamed response starts with the summary
+            json_data = OrderedDict(sorted(json_data.items()))
+            json_data["channels"] = channels_info["channels"]
+            json_data["users"] = patched_json.StreamedArray(users_info)
+            return stream_response(self.request, json_data)
+        json_data["channels"] = channels_info["channels"]
+        json_data["users"] = list(users_info)
+        return json_data
 
     @view_config(
         route_name="openapi_spec", permission=NO_PERMISSION_REQUIRED, renderer="json"
@@ -846,6 +1229,7 @@ class ServerViews(object):
         # add_pyramid_paths(spec, "api_v1_messages", request=self.request)
 
         add_pyramid_paths(spec, "admin_json", request=self.request)
+        add_pyramid_paths(spec, "metrics", request=self.request)
         spec_dict = spec.to_dict()
         spec_dict["securityDefinitions"] = {
             "APIKeyHeader": {
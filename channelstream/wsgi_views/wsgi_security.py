@@ -1,38 +1,220 @@
+import calendar
+import ipaddress
 import logging
+import time
 
-from itsdangerous import TimestampSigner
+import six
+from itsdangerous import BadSignature, SignatureExpired, TimestampSigner
 from pyramid.security import Allow, Everyone, ALL_PERMISSIONS, authenticated_userid
 
+from channelstream.server_state import DEFAULT_TENANT, get_or_create_state
+from channelstream.tenants import is_valid_tenant_id
+
 log = logging.getLogger(__name__)
 
+# seconds a verified token is trusted without checking its signature again
+TOKEN_CACHE_TTL = 5
+TOKEN_CACHE_SIZE = 10000
+# maximum age of signed secret in seconds
+TOKEN_MAX_AGE = 60
+
 
 class RequestBasicChallenge(Exception):
     pass
 
 
-def is_allowed_ip(addr, config):
-    if "0.0.0.0" in config["allow_posting_from"]:
-        return True
-    return addr in config["allow_posting_from"]
+class AllowList(object):
+    """
+    IP addresses and CIDR networks allowed to use the server API, networks
+    are grouped by prefix length so checking an address is one set lookup
+    per distinct prefix length
+    """
+
+    def __init__(self, entries):
+        """
+
+        :param entries: addresses or networks, `0.0.0.0` allows everyone
+        """
+        if isinstance(entries, six.string_types):
+            entries = [e.strip() for e in entries.split(",")]
+        self.allow_all = False
+        # exact addresses as written, checked before anything gets parsed
+        self.addresses = set()
+        # (ip version, prefix length) -> network addresses shifted by host bits
+        self.networks = {}
+        for entry in entries:
+            if not entry:
+                continue
+            if entry == "0.0.0.0":
+                self.allow_all = True
+                continue
+            try:
+                network = ipaddress.ip_network(six.text_type(entry), strict=False)
+            except ValueError:
+                raise ValueError("Invalid address in allow list: {}".format(entry))
+            if network.prefixlen == network.max_prefixlen:
+                self.addresses.add(entry)
+            host_bits = network.max_prefixlen - network.prefixlen
+            key = (network.version, network.prefixlen)
+            self.networks.setdefault(key, set()).add(
+                int(network.network_address) >> host_bits
+            )
+
+    def __contains__(self, addr):
+        if self.allow_all or addr in self.addresses:
+            return True
+        try:
+            ip = ipaddress.ip_address(six.text_type(addr))
+        except ValueError:
+            return False
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        value = int(ip)
+        for (version, prefixlen), networks in six.iteritems(self.networks):
+            if version == ip.version and (
+                value >> (ip.max_prefixlen - prefixlen) in networks
+            ):
+                return True
+        return False
+
+
+class APISecurity(object):
+    """
+    Verifies callers of the server API, signer and allow list are built once
+    and verified secrets are remembered until they expire.
+
+    Secret signed with the shared secret can act as any tenant, secret
+    signed with a tenant's own secret only as that tenant.
+    """
+
+    def __init__(
+        self, settings, cache_ttl=TOKEN_CACHE_TTL, cache_size=TOKEN_CACHE_SIZE
+    ):
+        """
+
+        :param settings: server configuration
+        :param cache_ttl: seconds a verified secret is trusted without
+                          checking its signature, it is never trusted after
+                          `TOKEN_MAX_AGE` passes
+        :param cache_size: maximum number of remembered secrets
+        """
+        self.signer = TimestampSigner(settings["secret"])
+        # tenant id -> signer of tenants with their own secret
+        self.tenant_signers = {
+            tenant_id: TimestampSigner(tenant_settings["secret"])
+            for tenant_id, tenant_settings in six.iteritems(
+                settings.get("tenants") or {}
+            )
+            if tenant_settings.get("secret")
+        }
+        self.allow_list = AllowList(settings.get("allow_posting_from", []))
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        # secret -> time until which it is trusted and tenant owning it,
+        # None for the shared secret
+        self.verified = {}
+
+    def is_allowed_ip(self, addr):
+        return addr in self.allow_list
+
+    def verify(self, secret, max_age=TOKEN_MAX_AGE, tenant_id=None):
+        """
+        Checks signed secret, raises itsdangerous.BadSignature when it's
+        invalid, expired or it belongs to another tenant
+        :param secret:
+        :param max_age:
+        :param tenant_id: tenant selected by the request
+        :return: tenant the request acts as
+        """
+        now = time.time()
+        cached = self.verified.get(secret)
+        if cached is not None and now <= cached[0]:
+            owner = cached[1]
+        else:
+            owner, signed_on = self.unsign(secret, max_age, tenant_id)
+            if len(self.verified) >= self.cache_size:
+                self.purge(now)
+            expires = calendar.timegm(signed_on.utctimetuple()) + max_age
+            self.verified[secret] = (min(now + self.cache_ttl, expires), owner)
+        if owner is None:
+            return tenant_id or DEFAULT_TENANT
+        if tenant_id is not None and tenant_id != owner:
+            raise BadSignature("Secret does not belong to tenant {}".format(tenant_id))
+        return owner
+
+    def unsign(self, secret, max_age, tenant_id=None):
+        """
+        Finds signer of the secret - the shared one first, then the one of
+        requested tenant or all tenant signers when no tenant was requested
+        :param secret:
+        :param max_age:
+        :param tenant_id:
+        :return: tenant owning the secret and time it was signed
+        """
+        signers = [(None, self.signer)]
+        if tenant_id is None:
+            signers.extend(sorted(six.iteritems(self.tenant_signers)))
+        elif tenant_id in self.tenant_signers:
+            signers.append((tenant_id, self.tenant_signers[tenant_id]))
+        for owner, signer in signers[:-1]:
+            try:
+                _, signed_on = signer.unsign(
+                    secret, max_age=max_age, return_timestamp=True
+                )
+                return owner, signed_on
+            except SignatureExpired:
+                raise
+            except BadSignature:
+                continue
+        owner, signer = signers[-1]
+        _, signed_on = signer.unsign(secret, max_age=max_age, return_timestamp=True)
+        return owner, signed_on
+
+    def purge(self, now):
+        for secret, (trusted_until, _) in list(six.iteritems(self.verified)):
+            if trusted_until < now:
+                del self.verified[secret]
+        # flooded with valid secrets, start over
+        if len(self.verified) >= self.cache_size:
+            self.verified.clear()
+
+
+def get_api_security(registry):
+    """
+    Returns APISecurity of the application, it is created on first use
+    when `make_app()` did not set it up
+    :param registry:
+    :return:
+    """
+    security = getattr(registry, "api_security", None)
+    if security is None:
+        security = registry.api_security = APISecurity(registry.settings)
+    return security
 
 
 class APIFactory(object):
     def __init__(self, request):
         self.__acl__ = []
-        config = request.registry.settings
+        self.tenant_id = DEFAULT_TENANT
+        security = get_api_security(request.registry)
         req_url_secret = request.params.get("secret")
         req_secret = request.headers.get("x-channelstream-secret", req_url_secret)
+        req_tenant = request.headers.get("x-channelstream-tenant")
 
         addr = request.environ["REMOTE_ADDR"]
-        if not is_allowed_ip(addr, config):
+        if not security.is_allowed_ip(addr):
             log.warning("IP: {} is not whitelisted".format(addr))
             return
+        if req_tenant is not None and not is_valid_tenant_id(req_tenant):
+            log.warning("Invalid tenant id: {}".format(req_tenant))
+            return
 
         if req_secret:
-            signer = TimestampSigner(config["secret"])
-            signer.unsign(req_secret, max_age=60)
+            tenant_id = security.verify(req_secret, tenant_id=req_tenant)
         else:
             return
+        get_or_create_state(tenant_id)
+        self.tenant_id = tenant_id
         self.__acl__ = [(Allow, Everyone, ALL_PERMISSIONS)]
 
 
@@ -42,4 +224,8 @@ class BasicAuthFactory(object):
         user = authenticated_userid(request)
         if not user:
             raise RequestBasicChallenge()
+        # administrator can look at any tenant
+        self.tenant_id = request.headers.get(
+            "x-channelstream-tenant", request.params.get("tenant", DEFAULT_TENANT)
+        )
         self.__acl__ = [(Allow, Everyone, ALL_PERMISSIONS)]
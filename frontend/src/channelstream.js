@@ -129,6 +129,8 @@ export class ChannelStreamConnection {
         /** Should use websockets or long-polling by default */
         this.noWebsocket = false;
         this.connected = false;
+        /** Sequence numbers of last received messages, sent when reconnecting */
+        this._resume = {channels: {}, user: null};
 
         /**
          * Mutators hold functions that you can set locally to change the data
@@ -376,6 +378,7 @@ export class ChannelStreamConnection {
      */
     openWebsocket() {
         let url = this.websocketUrl + '?conn_id=' + this.connectionId;
+        url = url + '&resume=' + encodeURIComponent(JSON.stringify(this._resume));
         this.websocket = new WebSocket(url);
         this.websocket.onopen = this._handleListenOpen.bind(this);
         this.websocket.onclose = this._handleWebsocketCloseEvent.bind(this);
@@ -390,12 +393,19 @@ export class ChannelStreamConnection {
     openLongPoll() {
         let request = new ChannelStreamRequest();
         request.url = this.longPollUrl + '?conn_id=' + this.connectionId;
+        if (this._longPollSeq) {
+            // acknowledges frames received with previous poll
+            request.url = request.url + '&ack=' + this._longPollSeq;
+        }
+        request.url = request.url + '&resume=' + encodeURIComponent(
+            JSON.stringify(this._resume));
         request.handleError = this._handleListenErrorEvent.bind(this);
         request.handleRequest = function () {
             this.connected = true;
             this.listenOpenedCallback(request);
         }.bind(this);
         request.handleResponse = function (request, data) {
+            this._longPollSeq = request.getResponseHeader('X-Channelstream-Seq');
             this._handleListenMessageEvent(data);
         }.bind(this);
         request.execute();
@@ -538,9 +548,35 @@ export class ChannelStreamConnection {
      */
     _handleListenMessageEvent(data) {
         setTimeout(this.openLongPoll.bind(this), 0);
+        this._trackResume(data);
         this.listenMessageCallback(data);
     }
 
+    /**
+     * Remembers sequence numbers of received messages
+     * @param messages
+     * @private
+     */
+    _trackResume(messages) {
+        if (!Array.isArray(messages)) {
+            return;
+        }
+        for (let i = 0; i < messages.length; i++) {
+            let seq = messages[i].seq;
+            if (typeof seq !== 'number') {
+                continue;
+            }
+            if (messages[i].channel) {
+                let channels = this._resume.channels;
+                channels[messages[i].channel] = Math.max(
+                    channels[messages[i].channel] || 0, seq);
+            }
+            else {
+                this._resume.user = Math.max(this._resume.user || 0, seq);
+            }
+        }
+    }
+
     /**
      * Handles ws payloads
      * @param data
@@ -548,6 +584,7 @@ export class ChannelStreamConnection {
      */
     _handleListenWSMessageEvent(data) {
         let parsedData = JSON.parse(data.data);
+        this._trackResume(parsedData);
         this.listenMessageCallback(parsedData);
     }
 
@@ -618,6 +655,7 @@ export class ChannelStreamConnection {
     _handleConnect(request, data) {
         this.currentBounceIv = 0;
         this.connectionId = data.conn_id;
+        this._longPollSeq = null;
         this.channels = data.channels;
         this.channelsChangedCallback(this.channels);
         this.connectCallback(request, data);
@@ -19,6 +19,7 @@ requires = [
     "itsdangerous==0.24",
     "requests==2.19.1",
     "six",
+    'ipaddress; python_version < "3"',
 ]
 
 
@@ -40,6 +41,8 @@ setup(
     extras_require={
         "dev": ["coverage", "pytest", "pyramid", "tox", "mock"],
         "lint": ["black"],
+        "speedups": ["orjson"],
+        "redis": ["redis"],
     },
     entry_points={"console_scripts": ["channelstream = channelstream.cli:cli_start"]},
 )
@@ -2,11 +2,22 @@ from gevent import monkey
 
 monkey.patch_all()
 
+import os
+import socket
+import subprocess
+import sys
+import time
 import uuid
+import gevent
 import pytest
 import mock
+import requests
+from itsdangerous import TimestampSigner
 from datetime import datetime
 from pyramid import testing
+from channelstream import tenants
+from channelstream.expiry import ExpiryIndex
+from channelstream.heartbeat import HeartbeatScheduler
 from channelstream.server_state import get_state
 
 
@@ -27,10 +38,20 @@ def test_uuids():
 
 @pytest.fixture
 def cleanup_globals():
+    tenants.reset()
     server_state = get_state()
     server_state.channels = {}
     server_state.connections = {}
     server_state.users = {}
+    server_state.heartbeats = HeartbeatScheduler()
+    server_state.connection_expiry = ExpiryIndex()
+    server_state.gc_stats = {}
+    server_state.outbound_stats = {
+        "overflows": 0,
+        "dropped_frames": 0,
+        "disconnected": 0,
+    }
+    server_state.presence_stats = {"active_users": 0, "connections": 0}
     server_state.stats = {
         "total_messages": 0,
         "total_unique_messages": 0,
@@ -52,3 +73,87 @@ def dummy_request():
     app_request = testing.DummyRequest()
     app_request.handle_cors = mock.Mock()
     return app_request
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ServerProcess(object):
+    """
+    Runs channelstream in a subprocess for integration and load tests
+    """
+
+    def __init__(self, *args):
+        self.port = free_port()
+        self.url = "http://127.0.0.1:{}".format(self.port)
+        self.secret = TimestampSigner("secret").sign("channelstream").decode("utf8")
+        self.devnull = open(os.devnull, "w")
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "from channelstream.cli import cli_start; cli_start()",
+                "--port",
+                str(self.port),
+                "--policy_port",
+                "0",
+            ]
+            + list(args),
+            stdout=self.devnull,
+            stderr=self.devnull,
+        )
+
+    def wait_ready(self, timeout=15):
+        start = time.time()
+        while time.time() - start < timeout:
+            try:
+                requests.get(self.url + "/", timeout=1)
+                return
+            except requests.ConnectionError:
+                gevent.sleep(0.1)
+        raise RuntimeError("server did not start")
+
+    def post(self, path, body):
+        return requests.post(
+            self.url + path, json=body, headers={"x-channelstream-secret": self.secret}
+        ).json()
+
+    def admin_info(self):
+        return requests.get(
+            self.url + "/admin/admin.json", auth=("admin", "admin_secret")
+        ).json()
+
+    def open_websocket(self, username, channels):
+        from ws4py.client.geventclient import WebSocketClient
+
+        response = self.post("/connect", {"username": username, "channels": channels})
+        ws = WebSocketClient(
+            "ws://127.0.0.1:{}/ws?conn_id={}".format(self.port, response["conn_id"])
+        )
+        ws.connect()
+        return ws
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.devnull.close()
+
+
+@pytest.fixture
+def run_server():
+    servers = []
+
+    def start(*args):
+        server = ServerProcess(*args)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
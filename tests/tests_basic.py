@@ -2,13 +2,43 @@ from gevent import monkey
 
 monkey.patch_all()
 
+import collections
+import decimal
+import gevent
+import random
+import socket
+import time
+import uuid
 import pytest
 from datetime import datetime, timedelta
+from dateutil import tz
+from operator import itemgetter
 from gevent.queue import Queue
+from channelstream import patched_json as json
 from channelstream.server_state import get_state
+import channelstream.bus
 import channelstream.gc
+from channelstream import operations, utils
+from channelstream.bus import BusHub, WorkerBus, decode_event, encode_event, read_frames
 from channelstream.channel import Channel
+from channelstream.cluster import TCPClusterNode, restore_message
 from channelstream.connection import Connection
+from channelstream.frames import HEARTBEAT_FRAME, encode_frame, join_frames
+from channelstream.envelope import Envelope
+from channelstream.expiry import ExpiryIndex
+from channelstream.heartbeat import HeartbeatScheduler
+from channelstream.locks import ShardedLocks, channel_key, connection_keys, user_key
+from channelstream.outbound import (
+    COALESCE,
+    DISCONNECT,
+    DROP_NEWEST,
+    DROP_OLDEST,
+    LongPollBuffer,
+    OutboundBuffer,
+    configure_outbound,
+)
+from channelstream.replication import apply_event
+from channelstream.ring_buffer import RingBuffer
 from channelstream.user import User
 
 
@@ -24,7 +54,8 @@ class TestChannel(object):
         assert channel.salvageable is False
         assert channel.store_history is False
         assert channel.history_size == 10
-        assert channel.history == []
+        assert list(channel.history) == []
+        assert channel.frames_size == 100
 
     def test_repr(self):
         channel = Channel("test", long_name="long name")
@@ -37,6 +68,7 @@ class TestChannel(object):
             ("store_history", 6),
             ("history_size", 42),
             ("broadcast_presence_with_user_lists", True),
+            ("frames_size", 5),
         ],
     )
     def test_create_set_config(self, prop, value):
@@ -192,32 +224,194 @@ class TestChannel(object):
         )
 
         assert len(channel.history) == 3
-        assert channel.history == [
+        # delivery information is kept out of stored payloads
+        seq = channel.frames.first_seq
+        assert [e.payload for e in channel.history] == [
+            {"channel": "test", "message": "test2", "type": "message", "seq": seq + 1},
+            {"channel": "test", "message": "test3", "type": "message", "seq": seq + 2},
+            {"channel": "test", "message": "test5", "type": "message", "seq": seq + 4},
+        ]
+        assert channel.history[0].no_history is False
+        assert channel.history[0].pm_users == []
+
+    def test_resize_buffers(self):
+        channel = Channel("test", channel_config={"store_history": True})
+        for i in range(20):
+            channel.add_message(
+                {
+                    "message": "test{}".format(i),
+                    "type": "message",
+                    "no_history": False,
+                    "pm_users": [],
+                    "exclude_users": [],
+                }
+            )
+        assert len(channel.history) == 10
+        assert len(channel.frames) == 20
+        channel.reconfigure_from_dict({"history_size": 2, "frames_size": 3})
+        assert [m["message"] for m in channel.history] == ["test18", "test19"]
+        assert [f[1]["message"] for f in channel.frames] == [
+            "test17",
+            "test18",
+            "test19",
+        ]
+
+    def test_catchup_frames(self):
+        channel = Channel("test")
+        for i in range(5):
+            channel.add_message(
+                {
+                    "message": "test{}".format(i),
+                    "type": "message",
+                    "no_history": False,
+                    "pm_users": ["other"] if i == 4 else [],
+                    "exclude_users": [],
+                }
+            )
+        newer_than = channel.frames[2][0]
+        frames = channel.get_catchup_frames(newer_than, "test_user")
+        assert [f["message"] for f in frames] == ["test2", "test3"]
+        assert all(f["catchup"] for f in frames)
+
+    def test_catchup_after_seq(self):
+        channel = Channel("test")
+        for i in range(5):
+            channel.add_message(
+                {
+                    "message": "test{}".format(i),
+                    "type": "message",
+                    "no_history": False,
+                    "pm_users": [],
+                    "exclude_users": [],
+                }
+            )
+        seqs = [f[1]["seq"] for f in channel.frames]
+        assert seqs == list(range(seqs[0], seqs[0] + 5))
+        # time is ignored once sequence number is known
+        frames = channel.get_catchup_frames(datetime.utcnow(), "test_user", seqs[2])
+        assert [f["message"] for f in frames] == ["test3", "test4"]
+        assert channel.get_catchup_frames(None, "test_user", seqs[-1]) == []
+
+    def test_seq_grows_when_channel_is_recreated(self):
+        message = {
+            "message": "test",
+            "type": "message",
+            "no_history": False,
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        channel = Channel("test")
+        channel.add_message(dict(message))
+        channel.add_message(dict(message))
+        time.sleep(0.001)
+        recreated = Channel("test")
+        recreated.add_message(dict(message))
+        assert recreated.frames[0][1]["seq"] > channel.frames[-1][1]["seq"]
+
+    def test_alter_and_delete_by_uuid(self, test_uuids):
+        config = {"store_history": True, "history_size": 2}
+        channel = Channel("test", channel_config=config)
+        for msg_uuid in test_uuids[:3]:
+            channel.add_message(
+                {
+                    "uuid": msg_uuid,
+                    "message": "test",
+                    "type": "message",
+                    "no_history": False,
+                    "pm_users": [],
+                    "exclude_users": [],
+                }
+            )
+        # oldest message was evicted from history but is still in frames
+        assert sorted(channel.history.index.keys()) == sorted(test_uuids[1:3])
+        edit = {
+            "uuid": test_uuids[0],
+            "message": "edited",
+            "no_history": False,
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        channel.alter_message(edit)
+        assert channel.frames[0][1]["message"] == "edited"
+        channel.delete_message(
             {
-                "channel": "test",
-                "message": "test2",
-                "type": "message",
+                "uuid": test_uuids[2],
                 "no_history": False,
                 "pm_users": [],
                 "exclude_users": [],
-            },
+            }
+        )
+        assert [m["uuid"] for m in channel.history] == [test_uuids[1]]
+        assert test_uuids[2] not in channel.frames.index
+
+    def test_channel_shares_frame(self, test_uuids):
+        channel = Channel("test")
+        connection = Connection("test_user", conn_id=test_uuids[1])
+        connection.queue = Queue()
+        connection2 = Connection("test_user2", conn_id=test_uuids[2])
+        connection2.queue = Queue()
+        channel.add_connection(connection)
+        channel.add_connection(connection2)
+        total_sent = channel.add_message(
             {
-                "channel": "test",
-                "message": "test3",
                 "type": "message",
+                "message": "test",
                 "no_history": False,
                 "pm_users": [],
                 "exclude_users": [],
-            },
+            }
+        )
+        assert total_sent == 2
+        frame = connection.queue.get()
+        assert connection2.queue.get() is frame
+        assert json.loads(frame) == [
+            {"type": "message", "message": "test", "seq": channel.frames.first_seq}
+        ]
+
+    def test_add_messages_single_frame(self, test_uuids):
+        channel = Channel("test")
+        connection = Connection("test_user", conn_id=test_uuids[1])
+        connection.queue = Queue()
+        connection2 = Connection("test_user2", conn_id=test_uuids[2])
+        connection2.queue = Queue()
+        channel.add_connection(connection)
+        channel.add_connection(connection2)
+        messages = [
             {
-                "channel": "test",
-                "message": "test5",
                 "type": "message",
+                "message": i,
                 "no_history": False,
                 "pm_users": [],
                 "exclude_users": [],
-            },
+            }
+            for i in range(3)
         ]
+        messages[1]["pm_users"] = ["test_user2"]
+        total_sent = channel.add_messages(messages)
+        assert total_sent == 5
+        frame = connection.queue.get()
+        assert connection.queue.empty()
+        assert [m["message"] for m in json.loads(frame)] == [0, 2]
+        frame2 = connection2.queue.get()
+        assert connection2.queue.empty()
+        assert [m["message"] for m in json.loads(frame2)] == [0, 1, 2]
+        assert len(channel.frames) == 3
+
+    def test_add_messages_shares_frame(self, test_uuids):
+        channel = Channel("test")
+        connection = Connection("test_user", conn_id=test_uuids[1])
+        connection.queue = Queue()
+        connection2 = Connection("test_user2", conn_id=test_uuids[2])
+        connection2.queue = Queue()
+        channel.add_connection(connection)
+        channel.add_connection(connection2)
+        channel.add_messages(
+            [
+                {"type": "message", "message": i, "pm_users": [], "exclude_users": []}
+                for i in range(2)
+            ]
+        )
+        assert connection.queue.get() is connection2.queue.get()
 
     def test_user_state(self, test_uuids):
         user = User("test_user")
@@ -284,13 +478,70 @@ class TestConnection(object):
         connection = Connection("test", test_uuids[1])
         connection.queue = Queue()
         connection.add_message({"message": "test"})
-        assert connection.queue.get() == [{"message": "test"}]
+        assert json.loads(connection.queue.get()) == [{"message": "test"}]
+
+    def test_message_shared_frame(self, test_uuids):
+        connection = Connection("test", test_uuids[1])
+        connection.queue = Queue()
+        frame = encode_frame([{"message": "test"}])
+        connection.add_message(frame=frame)
+        assert connection.queue.get() is frame
+
+    def test_join_frames(self):
+        frames = [
+            encode_frame([{"message": "test"}]),
+            HEARTBEAT_FRAME,
+            encode_frame([{"message": "test2"}, {"message": "test3"}]),
+        ]
+        assert json.loads(join_frames(frames)) == [
+            {"message": "test"},
+            {"message": "test2"},
+            {"message": "test3"},
+        ]
+        assert join_frames([HEARTBEAT_FRAME]) == b"[]"
 
     def test_heartbeat(self, test_uuids):
         connection = Connection("test", test_uuids[1])
         connection.queue = Queue()
         connection.heartbeat()
-        assert connection.queue.get() == []
+        assert json.loads(connection.queue.get()) == []
+
+    @pytest.mark.usefixtures("cleanup_globals")
+    def test_catchup_with_resume_token(self, test_uuids):
+        connection, user = operations.connect(
+            username="test", conn_id=test_uuids[1], channels=["a"], channel_configs={}
+        )
+        channel = get_state().channels["a"]
+        for i in range(3):
+            operations.pass_message(
+                {"channel": "a", "message": i, "pm_users": [], "exclude_users": []},
+                get_state().stats,
+            )
+        operations.pass_message(
+            {"message": "pm", "pm_users": ["test"], "exclude_users": []},
+            get_state().stats,
+        )
+        first_seq = channel.frames[0][1]["seq"]
+        pm_seq = user.frames[0][1]["seq"]
+        # client was active after every message was sent
+        connection.mark_activity()
+        assert connection.get_catchup_messages() == []
+        token = '{"channels": {"a": %s}, "user": %s}' % (first_seq, pm_seq - 1)
+        messages = connection.get_catchup_messages(utils.parse_resume_token(token))
+        assert [m["message"] for m in messages] == [1, 2, "pm"]
+
+    def test_parse_resume_token(self):
+        assert utils.parse_resume_token(None) is None
+        assert utils.parse_resume_token("not json") is None
+        assert utils.parse_resume_token("[1]") is None
+        assert utils.parse_resume_token('{"channels": {"a": 5, "b": "x"}}') == {
+            "channels": {"a": 5},
+            "user": None,
+        }
+
+    def test_parse_resume_token_rejects_booleans(self):
+        token = '{"channels": {"a": true, "b": 3}, "user": false}'
+        assert utils.parse_resume_token(token) == {"channels": {"b": 3}, "user": None}
 
 
 class TestUser(object):
@@ -319,8 +570,343 @@ class TestUser(object):
             }
         )
         assert len(user.connections) == 2
-        assert len(user.connections[0].queue.get()) == 1
-        assert len(user.connections[1].queue.get()) == 1
+        frame = user.connections[0].queue.get()
+        assert len(json.loads(frame)) == 1
+        # same encoded payload is shared between connections
+        assert user.connections[1].queue.get() is frame
+
+    def test_add_messages(self, test_uuids):
+        user = User("test_user")
+        connection = Connection("test_user", conn_id=test_uuids[1])
+        connection.queue = Queue()
+        user.add_connection(connection)
+        assert user.add_messages([{"type": "message", "message": i} for i in range(3)])
+        frame = connection.queue.get()
+        assert connection.queue.empty()
+        assert [m["message"] for m in json.loads(frame)] == [0, 1, 2]
+        assert len(user.frames) == 3
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestPassMessages(object):
+    def test_grouped_by_channel_and_recipient(self, test_uuids):
+        server_state = get_state()
+        connection, user = operations.connect(
+            username="test_user",
+            conn_id=test_uuids[1],
+            channels=["a", "b"],
+            channel_configs={},
+        )
+        connection.queue = Queue()
+        messages = [
+            {"channel": "a", "message": 1, "pm_users": [], "exclude_users": []},
+            {"channel": "b", "message": 2, "pm_users": [], "exclude_users": []},
+            {"channel": "a", "message": 3, "pm_users": [], "exclude_users": []},
+            {"channel": None, "message": 4, "pm_users": ["test_user"]},
+            {"channel": None, "message": 5, "pm_users": ["test_user", "other"]},
+        ]
+        operations.pass_messages(messages, server_state.stats)
+        frames = []
+        while not connection.queue.empty():
+            frames.append([m["message"] for m in json.loads(connection.queue.get())])
+        assert frames == [[1, 3], [2], [4, 5]]
+        assert server_state.stats["total_unique_messages"] == 5
+        assert server_state.stats["total_messages"] == 5
+
+
+class TestEnvelope(object):
+    def test_from_message(self):
+        message = {
+            "type": "message",
+            "message": {"text": "test"},
+            "no_history": True,
+            "pm_users": ["a"],
+            "exclude_users": ["b"],
+        }
+        envelope = Envelope.from_message(message)
+        assert envelope.payload == {"type": "message", "message": {"text": "test"}}
+        # payload values are shared, not copied
+        assert envelope["message"] is message["message"]
+        assert envelope.no_history is True
+        assert envelope.pm_users == ["a"]
+        assert envelope.exclude_users == ["b"]
+
+    def test_update_replaces_payload(self):
+        envelope = Envelope({"type": "message", "message": "test"})
+        old_payload = envelope.payload
+        envelope.update({"message": "edited"})
+        assert old_payload == {"type": "message", "message": "test"}
+        assert envelope["message"] == "edited"
+
+    @pytest.mark.usefixtures("cleanup_globals")
+    def test_stored_payload_is_not_modified(self):
+        channel = Channel("test", channel_config={"store_frames": True})
+        seq = channel.next_frame_seq()
+        envelope = Envelope.from_message({"type": "message"}, seq=seq)
+        payload = envelope.payload
+        assert channel.add_frame(envelope)[0] == seq
+        assert envelope.payload is payload
+        assert payload == {"type": "message", "seq": seq}
+
+        user = User("test_user")
+        seq = user.frames.next_seq
+        envelope = Envelope.from_message({"type": "message"}, seq=seq)
+        payload = envelope.payload
+        assert user.add_frame(envelope) == seq
+        assert envelope.payload is payload
+        assert payload == {"type": "message", "seq": seq}
+
+    def test_catchup_view(self):
+        envelope = Envelope({"type": "message", "catchup": False})
+        assert envelope.catchup_view() == {"type": "message", "catchup": True}
+        assert envelope["catchup"] is False
+
+    def test_visibility(self):
+        envelope = Envelope({}, pm_users=["a", "b"], exclude_users=["b"])
+        assert envelope.is_visible_to("a") is True
+        assert envelope.is_visible_to("b") is False
+        assert envelope.is_visible_to("c") is False
+
+
+class TestOutboundBuffer(object):
+    def fill(self, policy, count=5):
+        overflows = []
+        buffer = OutboundBuffer(
+            size=3, policy=policy, on_overflow=lambda b, d: overflows.append(d)
+        )
+        for i in range(count):
+            buffer.put(encode_frame([i]))
+        return buffer, overflows
+
+    def test_drop_oldest(self):
+        buffer, overflows = self.fill(DROP_OLDEST)
+        assert json.loads(join_frames(buffer.drain())) == [2, 3, 4]
+        assert overflows == [1, 1]
+        assert buffer.overflows == 2
+        assert buffer.dropped == 2
+
+    def test_drop_newest(self):
+        buffer, overflows = self.fill(DROP_NEWEST)
+        assert json.loads(join_frames(buffer.drain())) == [0, 1, 2]
+        assert overflows == [1, 1]
+
+    def test_coalesce(self):
+        buffer, overflows = self.fill(COALESCE)
+        frames = buffer.drain()
+        assert len(frames) == 2
+        assert json.loads(join_frames(frames)) == [0, 1, 2, 3, 4]
+        assert overflows == [0]
+
+    def test_disconnect(self):
+        buffer, overflows = self.fill(DISCONNECT)
+        assert buffer.closed is True
+        assert buffer.qsize() == 0
+        assert overflows == [4]
+
+    def test_long_poll_acknowledge(self):
+        buffer = LongPollBuffer()
+        assert buffer.delivered([b"[1]", b"[2]"]) == 2
+        assert buffer.delivered([b"[3]"]) == 3
+        buffer.acknowledge(2)
+        assert buffer.unacknowledged_frames() == [b"[3]"]
+        buffer.acknowledge()
+        assert buffer.unacknowledged_frames() == []
+
+    @pytest.mark.parametrize(
+        "policy, expected, dropped",
+        [
+            (DROP_OLDEST, [2, 3, 4], 2),
+            (DROP_NEWEST, [0, 1, 2], 2),
+            (COALESCE, [0, 1, 2, 3, 4], 0),
+            (DISCONNECT, [], 5),
+        ],
+    )
+    def test_unacknowledged_frames_are_bounded(self, policy, expected, dropped):
+        overflows = []
+        buffer = LongPollBuffer(
+            size=3,
+            policy=policy,
+            on_overflow=lambda buffer, count: overflows.append(count),
+        )
+        # client keeps polling without acknowledging anything
+        buffer.delivered([encode_frame([0]), encode_frame([1])])
+        buffer.delivered([encode_frame([2]), encode_frame([3]), encode_frame([4])])
+        frames = buffer.unacknowledged_frames()
+        assert json.loads(join_frames(frames)) == expected
+        assert buffer.unacknowledged_count == len(frames) <= 3
+        assert sum(overflows) == buffer.dropped == dropped
+        assert buffer.overflows == 1
+        assert buffer.closed is (policy == DISCONNECT)
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError):
+            configure_outbound(policy="wrong")
+
+    @pytest.mark.usefixtures("cleanup_globals")
+    def test_connection_overflow_stats(self, test_uuids):
+        server_state = get_state()
+        connection = Connection("test_user", conn_id=test_uuids[1])
+        connection.queue = OutboundBuffer(
+            size=2, policy=DROP_OLDEST, on_overflow=connection.buffer_overflowed
+        )
+        for i in range(5):
+            connection.add_message(frame=encode_frame([i]))
+        assert connection.queue.qsize() == 2
+        assert connection.overflows == 3
+        assert server_state.outbound_stats["overflows"] == 3
+        assert server_state.outbound_stats["dropped_frames"] == 3
+
+    @pytest.mark.usefixtures("cleanup_globals")
+    def test_connection_disconnect_policy(self, test_uuids):
+        server_state = get_state()
+        connection = Connection("test_user", conn_id=test_uuids[1])
+        connection.queue = OutboundBuffer(
+            size=2, policy=DISCONNECT, on_overflow=connection.buffer_overflowed
+        )
+        for i in range(3):
+            connection.add_message(frame=encode_frame([i]))
+        assert server_state.outbound_stats["disconnected"] == 1
+        assert connection.last_active < datetime.utcnow() - timedelta(days=1)
+
+
+class RecordingSocket(object):
+    def __init__(self, delay=0, fail=False):
+        self.terminated = False
+        self.delay = delay
+        self.fail = fail
+        self.sent = []
+
+    def send(self, payload):
+        if self.fail:
+            raise IOError("broken pipe")
+        if self.delay:
+            gevent.sleep(self.delay)
+        self.sent.append(payload)
+
+    def close(self):
+        self.terminated = True
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestWebsocketWriter(object):
+    def make_connection(self, conn_id, socket):
+        connection = Connection("test_user", conn_id=conn_id)
+        connection.socket = socket
+        return connection
+
+    def test_add_message_only_enqueues(self, test_uuids):
+        connection = self.make_connection(test_uuids[1], RecordingSocket())
+        connection.add_message(frame=encode_frame([1]))
+        assert connection.socket.sent == []
+        assert connection.writer.buffer.qsize() == 1
+        gevent.sleep(0)
+        assert connection.socket.sent == [encode_frame([1])]
+
+    def test_pending_frames_are_batched_in_order(self, test_uuids):
+        connection = self.make_connection(test_uuids[1], RecordingSocket())
+        for i in range(5):
+            connection.add_message(frame=encode_frame([i]))
+        gevent.sleep(0)
+        assert len(connection.socket.sent) == 1
+        assert json.loads(connection.socket.sent[0]) == [0, 1, 2, 3, 4]
+        assert connection.writer.sends == 1
+
+    def test_slow_socket_does_not_delay_others(self, test_uuids):
+        slow = self.make_connection(test_uuids[1], RecordingSocket(delay=0.2))
+        fast = self.make_connection(test_uuids[2], RecordingSocket())
+        for connection in (slow, fast):
+            connection.add_message(frame=encode_frame(["first"]))
+        gevent.sleep(0.01)
+        assert fast.socket.sent == [encode_frame(["first"])]
+        assert slow.socket.sent == []
+
+    def test_failed_send_marks_for_gc(self, test_uuids):
+        connection = self.make_connection(test_uuids[1], RecordingSocket(fail=True))
+        connection.add_message(frame=encode_frame([1]))
+        gevent.sleep(0)
+        assert connection.writer.greenlet.dead
+        assert connection.last_active < datetime.utcnow() - timedelta(days=1)
+
+    def test_gc_stops_writer(self, test_uuids):
+        connection = self.make_connection(test_uuids[1], RecordingSocket())
+        connection.add_message(frame=encode_frame([1]))
+        channelstream.gc.collect_connection(connection)
+        gevent.sleep(0)
+        assert connection.writer.greenlet.dead
+        assert connection.socket.terminated is True
+
+
+class TestRingBuffer(object):
+    def test_overwrites_oldest(self):
+        buf = RingBuffer(3)
+        evicted = [buf.append(i)[1] for i in range(5)]
+        assert evicted == [None, None, None, 0, 1]
+        assert list(buf) == [2, 3, 4]
+        assert len(buf) == 3
+        assert buf[0] == 2
+        assert buf[-1] == 4
+        with pytest.raises(IndexError):
+            buf[3]
+
+    def test_sequence_numbers(self):
+        buf = RingBuffer(3)
+        seqs = [buf.append("item{}".format(i))[0] for i in range(5)]
+        assert seqs == [0, 1, 2, 3, 4]
+        assert buf.get(1) is None
+        assert buf.get(3) == "item3"
+        assert list(buf.entries(3)) == [(3, "item3"), (4, "item4")]
+
+    def test_discard(self):
+        buf = RingBuffer(3)
+        for i in range(3):
+            buf.append(i)
+        assert buf.discard(1) is True
+        assert buf.discard(1) is False
+        assert list(buf) == [0, 2]
+        assert len(buf) == 2
+        assert buf[1] == 2
+        assert buf.append(3) == (3, 0)
+        # deleted entry is evicted silently
+        assert buf.append(4) == (4, None)
+        assert list(buf) == [2, 3, 4]
+
+    def test_bisect(self):
+        buf = RingBuffer(4)
+        for i in range(6):
+            buf.append((i * 10, i))
+        assert buf.bisect(0, key=itemgetter(0)) == 2
+        assert buf.bisect(30, key=itemgetter(0)) == 3
+        assert buf.bisect(30, key=itemgetter(0), right=True) == 4
+        assert buf.bisect(100, key=itemgetter(0)) == 6
+
+    def test_resize(self):
+        buf = RingBuffer(4)
+        for i in range(4):
+            buf.append(i)
+        buf.discard(3)
+        assert buf.resize(2) == [0, 1]
+        assert list(buf.entries()) == [(2, 2)]
+        buf.resize(5)
+        buf.append(4)
+        assert list(buf.entries()) == [(2, 2), (4, 4)]
+
+    def test_key_index(self):
+        buf = RingBuffer(2, key=itemgetter("uuid"))
+        for i in range(3):
+            buf.append({"uuid": i})
+        assert buf.lookup(0) == (None, None)
+        assert buf.lookup(2) == (2, {"uuid": 2})
+        assert sorted(buf.index.keys()) == [1, 2]
+        buf.discard(1)
+        assert buf.lookup(1) == (None, None)
+        buf.resize(0)
+        assert buf.index == {}
+
+    def test_zero_capacity(self):
+        buf = RingBuffer(0)
+        assert buf.append("a") == (0, "a")
+        assert len(buf) == 0
+        assert list(buf) == []
 
 
 @pytest.mark.usefixtures("cleanup_globals")
@@ -400,6 +986,8 @@ class TestGC(object):
         assert conns == [connection4]
         assert len(user.connections) == 1
         assert len(user2.connections) == 1
+        assert server_state.presence_stats == {"active_users": 2, "connections": 2}
+        assert channel.get_info()["total_connections"] == 1
         connection.mark_for_gc()
         connection4.mark_for_gc()
         channelstream.gc.gc_conns()
@@ -407,6 +995,56 @@ class TestGC(object):
         assert "test_user2" not in server_state.channels["test2"].connections
         assert len(server_state.channels["test"].connections.items()) == 0
         assert len(server_state.channels["test2"].connections.items()) == 0
+        assert server_state.presence_stats == {"active_users": 0, "connections": 0}
+        assert channel.get_info()["total_connections"] == 0
+        assert channel.get_info()["total_users"] == 0
+
+    def test_gc_only_checks_due_connections(self, test_uuids):
+        server_state = get_state()
+        for conn_id in test_uuids[:3]:
+            connection = Connection("test_user", conn_id)
+            server_state.connections[connection.id] = connection
+        channelstream.gc.gc_conns()
+        assert server_state.gc_stats["conns_checked"] == 0
+        assert server_state.gc_stats["conns_collected"] == 0
+        assert len(server_state.connections) == 3
+
+    def test_gc_in_slices(self, test_uuids):
+        server_state = get_state()
+        channel = Channel("test")
+        server_state.channels[channel.name] = channel
+        user = User("test_user")
+        server_state.users[user.username] = user
+        for conn_id in test_uuids[:5]:
+            connection = Connection("test_user", conn_id)
+            server_state.connections[connection.id] = connection
+            user.add_connection(connection)
+            channel.add_connection(connection)
+            connection.mark_for_gc()
+        channelstream.gc.gc_conns(slice_size=2)
+        assert server_state.gc_stats["conns_collected"] == 5
+        assert server_state.gc_stats["conns_slices"] == 3
+        assert server_state.connections == {}
+        assert user.connections == []
+        assert channel.connections == {}
+        assert len(server_state.connection_expiry) == 0
+
+    def test_expiry_index_retracks_active_connections(self, test_uuids):
+        index = ExpiryIndex()
+        connection = Connection("test_user", test_uuids[1])
+        connection.last_active = datetime.utcnow() - timedelta(seconds=30)
+        index.track(connection)
+        connection.mark_activity()
+        threshold = datetime.utcnow() - timedelta(seconds=15)
+        expired, checked = index.pop_expired(threshold, 10)
+        assert expired == []
+        assert checked == 1
+        assert len(index) == 1
+        connection.mark_for_gc()
+        index.track(connection)
+        expired, checked = index.pop_expired(threshold, 10)
+        assert expired == [connection]
+        assert len(index) == 0
 
     def test_users_active(self):
         server_state = get_state()
@@ -419,3 +1057,466 @@ class TestGC(object):
         user.last_active -= timedelta(days=2)
         channelstream.gc.gc_users()
         assert len(server_state.users.items()) == 1
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestHeartbeatScheduler(object):
+    def test_every_connection_once_per_rotation(self):
+        scheduler = HeartbeatScheduler(interval=5, tick_interval=1)
+        connections = []
+        for i in range(12):
+            connection = Connection("test", uuid.uuid4())
+            connection.queue = Queue()
+            scheduler.add(connection)
+            connections.append(connection)
+        assert len(scheduler) == 12
+        total_sent = sum(scheduler.tick() for _ in range(5))
+        assert total_sent == 12
+        for connection in connections:
+            assert connection.queue.qsize() == 1
+            assert json.loads(connection.queue.get()) == []
+
+    def test_drops_detached_connections(self):
+        scheduler = HeartbeatScheduler(interval=1, tick_interval=1)
+        connection = Connection("test", uuid.uuid4())
+        scheduler.add(connection)
+        assert scheduler.tick() == 0
+        assert len(scheduler) == 0
+
+    def test_mark_for_gc_stops_tracking(self):
+        server_state = get_state()
+        connection = Connection("test", uuid.uuid4())
+        connection.queue = Queue()
+        server_state.heartbeats.add(connection)
+        assert len(server_state.heartbeats) == 1
+        connection.mark_for_gc()
+        assert len(server_state.heartbeats) == 0
+        assert server_state.heartbeats.get_info()["tracked_connections"] == 0
+
+    def test_tick_info(self):
+        scheduler = HeartbeatScheduler(interval=1, tick_interval=1)
+        connection = Connection("test", uuid.uuid4())
+        connection.queue = Queue()
+        scheduler.add(connection)
+        scheduler.tick()
+        info = scheduler.get_info()
+        assert info["ticks"] == 1
+        assert info["last_tick_sent"] == 1
+        assert info["last_tick_duration"] >= 0
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestMembershipIndex(object):
+    def assert_consistent(self):
+        server_state = get_state()
+        for conn in server_state.connections.values():
+            expected = sorted(
+                c.name
+                for c in server_state.channels.values()
+                if conn in c.connections.get(conn.username, [])
+            )
+            assert conn.channels == expected
+        for user in server_state.users.values():
+            expected = sorted(
+                c.name
+                for c in server_state.channels.values()
+                if any(
+                    conn in user.connections
+                    for conn in c.connections.get(user.username, [])
+                )
+            )
+            assert sorted(c.name for c in user.get_channels()) == expected
+
+    def test_subscribe_unsubscribe(self, test_uuids):
+        connection, user = operations.connect(
+            username="test_user",
+            conn_id=test_uuids[1],
+            channels=["a", "b"],
+            channel_configs={},
+        )
+        connection2, user = operations.connect(
+            username="test_user",
+            conn_id=test_uuids[2],
+            channels=["b", "c"],
+            channel_configs={},
+        )
+        assert connection.channels == ["a", "b"]
+        assert user.channel_connections == {"a": 1, "b": 2, "c": 1}
+        operations.subscribe(connection=connection, channels=["d"], channel_configs={})
+        operations.unsubscribe(connection=connection2, unsubscribe_channels=["b"])
+        assert connection.channels == ["a", "b", "d"]
+        assert connection2.channels == ["c"]
+        assert user.channel_connections == {"a": 1, "b": 1, "c": 1, "d": 1}
+        self.assert_consistent()
+
+    def test_gc_removes_index_entries(self, test_uuids):
+        connection, user = operations.connect(
+            username="test_user",
+            conn_id=test_uuids[1],
+            channels=["a", "b"],
+            channel_configs={},
+        )
+        connection.mark_for_gc()
+        channelstream.gc.gc_conns()
+        assert connection.channels == []
+        assert connection.user is None
+        assert user.channel_connections == {}
+        assert user.get_channels() == []
+
+    def test_churn(self):
+        server_state = get_state()
+        rand = random.Random(42)
+        channel_names = ["chan_{}".format(i) for i in range(8)]
+        usernames = ["user_{}".format(i) for i in range(5)]
+        for step in range(300):
+            action = rand.choice(["connect", "subscribe", "unsubscribe", "gc"])
+            conns = list(server_state.connections.values())
+            if action == "connect" or not conns:
+                operations.connect(
+                    username=rand.choice(usernames),
+                    conn_id=uuid.uuid4(),
+                    channels=rand.sample(channel_names, rand.randint(0, 3)),
+                    channel_configs={},
+                )
+            elif action == "subscribe":
+                operations.subscribe(
+                    connection=rand.choice(conns),
+                    channels=rand.sample(channel_names, 2),
+                    channel_configs={},
+                )
+            elif action == "unsubscribe":
+                operations.unsubscribe(
+                    connection=rand.choice(conns),
+                    unsubscribe_channels=rand.sample(channel_names, 2),
+                )
+            else:
+                rand.choice(conns).mark_for_gc()
+                channelstream.gc.gc_conns()
+            self.assert_consistent()
+
+
+def held_elsewhere(lock):
+    """
+    Checks if lock is held by trying to grab it from another greenlet
+    """
+
+    def try_acquire():
+        if lock.acquire(blocking=False):
+            lock.release()
+            return False
+        return True
+
+    return gevent.spawn(try_acquire).get()
+
+
+class TestShardedLocks(object):
+    def test_same_key_same_shard(self):
+        locks = ShardedLocks(shards=8)
+        assert len(locks) == 8
+        assert locks.shard(channel_key("a")) == locks.shard(channel_key("a"))
+        assert 0 <= locks.shard(user_key("a")) < 8
+
+    def test_hold_acquires_each_shard_once(self):
+        locks = ShardedLocks(shards=1)
+        guard = locks.hold([channel_key("a"), channel_key("b"), user_key("c")])
+        assert len(guard.locks) == 1
+        with guard:
+            assert held_elsewhere(locks.locks[0])
+        assert not held_elsewhere(locks.locks[0])
+
+    def test_other_shards_are_not_blocked(self):
+        locks = ShardedLocks(shards=2)
+        keys = [channel_key(i) for i in range(100)]
+        first = keys[0]
+        other = next(k for k in keys if locks.shard(k) != locks.shard(first))
+        same = next(k for k in keys[1:] if locks.shard(k) == locks.shard(first))
+        entered = []
+
+        def enter(key):
+            with locks.hold([key]):
+                entered.append(key)
+
+        with locks.hold([first]):
+            greenlets = [gevent.spawn(enter, other), gevent.spawn(enter, same)]
+            gevent.sleep(0)
+            assert entered == [other]
+        gevent.joinall(greenlets)
+        assert entered == [other, same]
+
+    def test_hold_all(self):
+        locks = ShardedLocks(shards=4)
+        with locks.hold_all():
+            assert all(held_elsewhere(lock) for lock in locks.locks)
+        assert not any(held_elsewhere(lock) for lock in locks.locks)
+
+    def test_connection_keys(self, test_uuids):
+        connection = Connection("test_user", conn_id=test_uuids[1])
+        connection.joined_channel("a")
+        assert connection_keys(connection) == [user_key("test_user"), channel_key("a")]
+
+
+class TestWorkerBus(object):
+    def test_frames_roundtrip(self):
+        left, right = socket.socketpair()
+        payload = {"conn_id": uuid.uuid4(), "when": datetime.utcnow()}
+        left.sendall(encode_event("a", payload) + encode_event("b", {}))
+        left.close()
+        events = [decode_event(f) for f in read_frames(right)]
+        assert events == [("a", payload), ("b", {})]
+
+    def test_hub_relays_to_other_workers(self):
+        pairs = [socket.socketpair() for _ in range(3)]
+        received = [[], [], []]
+        workers = []
+        for i, (master_sock, worker_sock) in enumerate(pairs):
+            worker = WorkerBus(
+                worker_sock, lambda e, kw, i=i: received[i].append((e, kw))
+            )
+            worker.start()
+            workers.append(worker)
+        hub = BusHub([master_sock for master_sock, worker_sock in pairs])
+        hub_greenlet = gevent.spawn(hub.serve_forever)
+        workers[0].publish("messages", {"messages": [1]})
+        workers[2].publish("messages", {"messages": [2]})
+        gevent.sleep(0.1)
+        assert received[0] == [("messages", {"messages": [2]})]
+        assert received[1] == [
+            ("messages", {"messages": [1]}),
+            ("messages", {"messages": [2]}),
+        ]
+        assert received[2] == [("messages", {"messages": [1]})]
+        assert hub.forwarded == 2
+        hub_greenlet.kill()
+
+
+class TestTCPClusterNode(object):
+    def make_node(self, received, peers=()):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(16)
+        node = TCPClusterNode(
+            uuid.uuid4().hex,
+            lambda *args: received.append(args),
+            listener,
+            list(peers),
+            reconnect_interval=0.05,
+        )
+        return node, listener.getsockname()
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            gevent.sleep(0.01)
+
+    def test_relays_only_to_interested_peers(self):
+        received_b, received_c = [], []
+        node_b, address_b = self.make_node(received_b)
+        node_c, address_c = self.make_node(received_c)
+        node_a, address_a = self.make_node([], peers=[address_b, address_c])
+        for node in (node_a, node_b, node_c):
+            node.start()
+        node_b.interest_added("channel", "room")
+        node_c.interest_added("user", "user_c")
+        self.wait_for(lambda: all(peer.interest for peer in node_a.peers))
+        timestamp = datetime.utcnow()
+        msg = {"uuid": str(uuid.uuid4()), "timestamp": timestamp, "text": "x"}
+        node_a.publish("channel", "room", "messages", [msg])
+        node_a.publish("channel", "nobody", "messages", [msg])
+        self.wait_for(lambda: received_b)
+        gevent.sleep(0.05)
+        assert len(received_b) == 1
+        kind, name, event, messages = received_b[0]
+        assert (kind, name, event) == ("channel", "room", "messages")
+        assert messages[0]["timestamp"] == timestamp
+        assert isinstance(messages[0]["uuid"], uuid.UUID)
+        assert received_c == []
+        assert node_a.relayed == 1
+
+        node_b.interest_removed("channel", "room")
+        self.wait_for(lambda: not node_a.peers[0].interest)
+        node_a.publish("channel", "room", "messages", [msg])
+        gevent.sleep(0.1)
+        assert len(received_b) == 1
+
+    def test_restore_message(self):
+        msg = restore_message(
+            {
+                "uuid": str(uuid.uuid4()),
+                "timestamp": "2018-01-01T10:00:00",
+                "edited": None,
+            }
+        )
+        assert msg["timestamp"] == datetime(2018, 1, 1, 10)
+        assert msg["edited"] is None
+        assert isinstance(msg["uuid"], uuid.UUID)
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestReplication(object):
+    def test_remote_connection_is_not_collected_locally(self, test_uuids):
+        server_state = get_state()
+        apply_event(
+            "connect",
+            dict(
+                username="test_user",
+                conn_id=test_uuids[1],
+                channels=["a"],
+                channel_configs={},
+            ),
+        )
+        connection = server_state.connections[test_uuids[1]]
+        assert connection.channels == ["a"]
+        apply_event("attach", {"conn_id": test_uuids[1]})
+        assert connection.remote is True
+        connection.last_active -= timedelta(days=1)
+        channelstream.gc.gc_conns()
+        assert test_uuids[1] in server_state.connections
+        apply_event("collect", {"conn_id": test_uuids[1]})
+        assert test_uuids[1] not in server_state.connections
+        assert "test_user" not in server_state.channels["a"].connections
+
+    def test_local_connection_ignores_remote_collect(self, test_uuids):
+        server_state = get_state()
+        connection, user = operations.connect(
+            username="test_user", conn_id=test_uuids[1], channels=[], channel_configs={}
+        )
+        connection.queue = Queue()
+        connection.attached_locally()
+        apply_event("collect", {"conn_id": test_uuids[1]})
+        assert test_uuids[1] in server_state.connections
+
+    def test_messages_reach_local_connections(self, test_uuids):
+        connection, user = operations.connect(
+            username="test_user",
+            conn_id=test_uuids[1],
+            channels=["a"],
+            channel_configs={},
+        )
+        connection.queue = Queue()
+        msg = {"channel": "a", "message": "test", "pm_users": [], "exclude_users": []}
+        apply_event("messages", {"messages": [msg]})
+        assert json.loads(connection.queue.get())[0]["message"] == "test"
+
+    def test_long_poll_buffer_handed_over(self, test_uuids, monkeypatch):
+        published = []
+        monkeypatch.setattr(
+            channelstream.bus,
+            "publish",
+            lambda event, **kwargs: published.append((event, kwargs)),
+        )
+        connection, user = operations.connect(
+            username="test_user", conn_id=test_uuids[1], channels=[], channel_configs={}
+        )
+        # first worker served two polls, client received only the first one
+        connection.queue = LongPollBuffer()
+        connection.queue.delivered([encode_frame([1])])
+        connection.queue.delivered([encode_frame([2]), encode_frame([3])])
+        connection.queue.put(encode_frame([4]))
+        apply_event("attach", {"conn_id": test_uuids[1]})
+        assert connection.queue is None
+        event, kwargs = published[-1]
+        assert event == "handover"
+
+        # second worker got poll acknowledging the first response
+        connection.remote = False
+        connection.queue = LongPollBuffer(seq=1)
+        connection.queue.put(encode_frame([5]))
+        apply_event(event, kwargs)
+        frames = connection.queue.drain()
+        assert json.loads(join_frames(frames)) == [2, 3, 4, 5]
+        assert connection.queue.delivered(frames) == 5
+
+
+class JSONSerializable(object):
+    def __json__(self):
+        return {"serialized": True}
+
+
+class TestWireEncoding(object):
+    def teardown_method(self, method):
+        json.configure_wire_encoding()
+
+    @pytest.mark.parametrize("backend", list(json.WIRE_BACKENDS.keys()))
+    @pytest.mark.parametrize("compact", [True, False])
+    def test_backends_match_stdlib(self, backend, compact):
+        try:
+            json.configure_wire_encoding(backend, compact=compact)
+        except ImportError:
+            pytest.skip("{} is not installed".format(backend))
+        payload = [
+            {
+                "uuid": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+                "timestamp": datetime(2018, 1, 1, 12, 30, 15, 1234),
+                "message": {
+                    "text": "za\u017c\u00f3\u0142\u0107",
+                    "price": decimal.Decimal("1.5"),
+                },
+                "tags": {"a"},
+                "obj": JSONSerializable(),
+                "edited": None,
+                "keys": {1: "int", 2.5: "float", None: "none", False: "bool"},
+                "utc": datetime(2018, 1, 1, 12, 30, tzinfo=tz.tzutc()),
+                "offset": datetime(2018, 1, 1, 12, 30, tzinfo=tz.tzoffset(None, 3600)),
+                "time": datetime(2018, 1, 1, 10, 1, 2, 123456).time(),
+            }
+        ]
+        # values fast backends cannot write like stdlib, they fall back to it
+        payloads = [payload, [2 ** 70], {"nan": float("nan")}, [[float("inf")]]]
+        payloads.append(["\ud800"])
+        stdlib = json._json_wire_encoder(compact)
+        for payload in payloads:
+            encoded = json.wire_dumps(payload)
+            expected = stdlib(payload)
+            if not compact and backend == "orjson":
+                # orjson only indents by two spaces
+                encoded = json._json_wire_encoder(True)(
+                    json.loads(encoded.decode("utf8"))
+                )
+                expected = json._json_wire_encoder(True)(payload)
+            assert encoded == expected
+
+    @pytest.mark.parametrize("backend", list(json.WIRE_BACKENDS.keys()))
+    def test_backends_reject_keys_like_stdlib(self, backend):
+        try:
+            json.configure_wire_encoding(backend)
+        except ImportError:
+            pytest.skip("{} is not installed".format(backend))
+        with pytest.raises(TypeError):
+            json.wire_dumps({uuid.UUID("12345678-1234-5678-1234-567812345678"): 1})
+
+    def test_compact_separators(self):
+        json.configure_wire_encoding("json", compact=True)
+        assert json.wire_dumps([{"a": 1, "b": [1, 2]}]) == b'[{"a":1,"b":[1,2]}]'
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            json.configure_wire_encoding("foo")
+
+    def test_auto_selects_backend(self):
+        assert json.configure_wire_encoding("auto") in json.WIRE_BACKENDS
+
+    def test_streamed_chunks(self):
+        produced = []
+
+        def items():
+            for i in range(5):
+                produced.append(i)
+                yield "item{}".format(i), {"i": i}
+
+        data = collections.OrderedDict(
+            [
+                ("total", 5),
+                ("items", json.StreamedObject(items())),
+                ("names", json.StreamedArray(iter(["a", "b"]))),
+                ("empty", json.StreamedArray([])),
+            ]
+        )
+        chunks = json.iter_chunks(data, chunk_size=2)
+        first = next(chunks)
+        assert first == b'{"total":5,"items":{"item0":{"i":0},"item1":{"i":1}'
+        # items of next chunks are not produced yet
+        assert produced == [0, 1]
+        result = json.loads((first + b"".join(chunks)).decode("utf8"))
+        assert result["items"] == {"item{}".format(i): {"i": i} for i in range(5)}
+        assert result["names"] == ["a", "b"]
+        assert result["empty"] == []
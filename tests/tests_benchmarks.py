@@ -0,0 +1,686 @@
+from gevent import monkey
+
+monkey.patch_all()
+
+import copy
+import os
+import random
+import time
+import uuid
+from datetime import datetime
+
+import gevent
+import pytest
+from gevent.queue import Empty, Queue
+from itsdangerous import TimestampSigner
+from pyramid import testing
+
+from channelstream import metrics, operations, snapshot
+from channelstream import patched_json as json
+from channelstream.channel import Channel
+from channelstream.connection import Connection
+from channelstream.envelope import Envelope
+from channelstream.locks import ShardedLocks
+from channelstream.server_state import get_state
+from channelstream.user import User
+from channelstream.validation import compiled, schemas
+from channelstream.wsgi_views.server import await_data
+from channelstream.wsgi_views.wsgi_security import APIFactory
+
+
+def timed(func, repeat=10):
+    """
+    Returns average wall clock time of single `func` call in seconds
+    """
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def allocated(func):
+    """
+    Returns peak number of bytes allocated while running `func`
+    """
+    tracemalloc = pytest.importorskip("tracemalloc")
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def report(name, **results):
+    print(
+        "\n{}: {}".format(
+            name, ", ".join("{}={}".format(k, v) for k, v in sorted(results.items()))
+        )
+    )
+
+
+class DummySocket(object):
+    terminated = False
+
+    def send(self, payload):
+        pass
+
+
+def make_message(channel="bench", text="lorem ipsum dolor sit amet"):
+    return {
+        "uuid": uuid.uuid4(),
+        "type": "message",
+        "user": "publisher",
+        "channel": channel,
+        "timestamp": datetime.utcnow(),
+        "edited": None,
+        "catchup": False,
+        "message": {"text": text, "attachments": [], "mentions": ["user_1"]},
+        "no_history": False,
+        "pm_users": [],
+        "exclude_users": [],
+    }
+
+
+def populate_channel(subscribers, use_sockets=False):
+    server_state = get_state()
+    channel = Channel("bench")
+    server_state.channels[channel.name] = channel
+    for i in range(subscribers):
+        username = "user_{}".format(i)
+        user = User(username)
+        server_state.users[username] = user
+        connection = Connection(username, conn_id=uuid.uuid4())
+        if use_sockets:
+            connection.socket = DummySocket()
+        else:
+            connection.queue = Queue()
+        user.add_connection(connection)
+        channel.add_connection(connection)
+    return channel
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestFanOutBenchmark(object):
+    @pytest.mark.parametrize("subscribers", [100, 1000])
+    def test_broadcast_cost_per_subscriber(self, subscribers):
+        channel = populate_channel(subscribers, use_sockets=True)
+        message = make_message()
+        connections = [c for conns in channel.connections.values() for c in conns]
+
+        def encode_per_subscriber():
+            # fan-out where every connection encodes its own payload
+            for connection in connections:
+                connection.socket.send(json.dumps([message]))
+
+        def encode_once():
+            channel.add_message(make_message())
+
+        before = timed(encode_per_subscriber)
+        after = timed(encode_once)
+        report(
+            "broadcast to {} subscribers".format(subscribers),
+            per_subscriber_before_us=round(before / subscribers * 1e6, 2),
+            per_subscriber_after_us=round(after / subscribers * 1e6, 2),
+        )
+        assert channel.add_message(make_message()) == subscribers
+
+
+class TestWireEncodingBenchmark(object):
+    def teardown_method(self, method):
+        json.configure_wire_encoding()
+
+    def test_encoders_on_pass_message_payloads(self):
+        payloads = [[make_message(text="message {}".format(i))] for i in range(200)]
+        for msg in payloads:
+            for key in ("no_history", "pm_users", "exclude_users"):
+                del msg[0][key]
+
+        def legacy():
+            for payload in payloads:
+                json.dumps(payload).encode("utf8")
+
+        results = {"legacy_indented_us": round(timed(legacy) / 200 * 1e6, 2)}
+        for backend in json.WIRE_BACKENDS.keys():
+            try:
+                json.configure_wire_encoding(backend)
+            except ImportError:
+                continue
+
+            def wire():
+                for payload in payloads:
+                    json.wire_dumps(payload)
+
+            results["{}_us".format(backend)] = round(timed(wire) / 200 * 1e6, 2)
+        report("encoding pass_message payload", **results)
+        assert "json_us" in results
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestHistoryBufferBenchmark(object):
+    @pytest.mark.parametrize("buffer_size", [100, 2000])
+    def test_publish_throughput(self, buffer_size):
+        config = {
+            "store_history": True,
+            "history_size": buffer_size,
+            "frames_size": buffer_size,
+        }
+        channel = Channel("bench", channel_config=config)
+        messages = [make_message() for _ in range(2000)]
+        stored = {"history": [], "frames": []}
+
+        def list_slicing():
+            # storage that re-slices lists on every publish
+            for msg in messages:
+                stored["history"].append(msg)
+                stored["history"] = stored["history"][-buffer_size:]
+                stored["frames"].append((datetime.utcnow(), msg))
+                stored["frames"] = stored["frames"][-buffer_size:]
+
+        envelopes = [Envelope.from_message(msg) for msg in messages]
+
+        def ring_buffers():
+            for envelope in envelopes:
+                channel.add_to_history(envelope)
+                channel.add_frame(envelope)
+
+        before = timed(list_slicing, repeat=3)
+        after = timed(ring_buffers, repeat=3)
+        report(
+            "storing messages in buffers of {}".format(buffer_size),
+            list_msgs_per_sec=int(len(messages) / before),
+            ring_msgs_per_sec=int(len(messages) / after),
+        )
+        assert len(channel.history) == min(buffer_size, len(messages) * 3)
+
+    def test_catchup_on_busy_channel(self):
+        channel = Channel("bench", channel_config={"frames_size": 5000})
+        for _ in range(5000):
+            channel.add_frame(Envelope.from_message(make_message()))
+        newer_than = channel.frames[-10][0]
+        duration = timed(lambda: channel.get_catchup_frames(newer_than, "user_1"))
+        report("catchup of 10 frames out of 5000", duration_us=int(duration * 1e6))
+        assert len(channel.get_catchup_frames(newer_than, "user_1")) >= 10
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestEnvelopeAllocations(object):
+    def test_publish_and_catchup_allocations(self):
+        channel = populate_channel(100)
+        channel.reconfigure_from_dict({"store_history": True, "history_size": 100})
+        messages = [make_message() for _ in range(100)]
+
+        def deep_copies():
+            # copies made by publish and catchup before envelopes
+            for msg in messages:
+                stored = copy.deepcopy(msg)
+                for key in ("no_history", "pm_users", "exclude_users"):
+                    del stored[key]
+            for msg in messages:
+                copy.deepcopy(msg)["catchup"] = True
+
+        def envelopes():
+            for msg in messages:
+                Envelope.from_message(msg)
+            for envelope in channel.frames:
+                envelope[1].catchup_view()
+
+        for msg in messages:
+            channel.add_message(msg)
+        before = allocated(deep_copies)
+        after = allocated(envelopes)
+        report(
+            "peak bytes allocated for 100 messages publish + catchup",
+            deepcopy=before,
+            envelopes=after,
+        )
+        assert len(channel.get_catchup_frames(datetime(2000, 1, 1), "user_1")) == 100
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestBatchedPublishBenchmark(object):
+    @pytest.mark.parametrize("batch_size", [10, 1000])
+    def test_batch_to_one_channel(self, batch_size):
+        channel = populate_channel(100)
+        stats = get_state().stats
+        connections = [c for conns in channel.connections.values() for c in conns]
+
+        def per_message():
+            for _ in range(batch_size):
+                operations.pass_message(make_message(), stats)
+
+        def batched():
+            operations.pass_messages([make_message() for _ in range(batch_size)], stats)
+
+        def drain():
+            for connection in connections:
+                while not connection.queue.empty():
+                    connection.queue.get()
+
+        before = timed(lambda: (per_message(), drain()), repeat=3)
+        after = timed(lambda: (batched(), drain()), repeat=3)
+        report(
+            "publish batch of {} messages to 100 subscribers".format(batch_size),
+            per_message_ms=round(before * 1e3, 2),
+            batched_ms=round(after * 1e3, 2),
+        )
+        batched()
+        frame = connections[0].queue.get()
+        assert connections[0].queue.empty()
+        assert len(json.loads(frame)) == batch_size
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestLockContentionBenchmark(object):
+    @pytest.fixture(autouse=True)
+    def slow_state_writes(self, monkeypatch):
+        """
+        Subscribing yields to other greenlets like a state write or history
+        load would, operations hold channel locks while it happens
+        """
+        add_connection = Channel.add_connection
+
+        def slow_add_connection(channel, connection):
+            gevent.sleep(0.001)
+            return add_connection(channel, connection)
+
+        monkeypatch.setattr(Channel, "add_connection", slow_add_connection)
+
+    def storm(self, channels, clients):
+        """
+        Connects `clients` users spread over `channels` channels concurrently,
+        every subscription yields while holding the lock
+        """
+        channel_names = ["channel_{}".format(i) for i in range(channels)]
+        configs = {name: {"notify_presence": True} for name in channel_names}
+        for name in channel_names:
+            operations.connect(
+                username="watcher_{}".format(name),
+                conn_id=uuid.uuid4(),
+                channels=[name],
+                channel_configs=configs,
+            )
+
+        def client(i):
+            name = channel_names[i % channels]
+            connection, user = operations.connect(
+                username="user_{}".format(i),
+                conn_id=uuid.uuid4(),
+                channels=[name],
+                channel_configs=configs,
+            )
+            operations.subscribe(
+                connection=connection,
+                channels=[channel_names[(i + 1) % channels]],
+                channel_configs=configs,
+            )
+
+        start = time.time()
+        gevent.joinall([gevent.spawn(client, i) for i in range(clients)])
+        return time.time() - start
+
+    def test_connect_subscribe_storm(self):
+        server_state = get_state()
+        # single shard behaves like the old global state lock
+        server_state.locks = ShardedLocks(shards=1)
+        before = self.storm(channels=16, clients=64)
+        assert len(server_state.users) == 80
+
+        server_state.channels = {}
+        server_state.users = {}
+        server_state.connections = {}
+        server_state.locks = ShardedLocks()
+        after = self.storm(channels=16, clients=64)
+        assert len(server_state.users) == 80
+        report(
+            "64 concurrent connect+subscribe on 16 channels",
+            global_lock_ms=round(before * 1e3, 2),
+            sharded_ms=round(after * 1e3, 2),
+        )
+        assert after < before
+
+
+def receive_messages(ws, expected):
+    received = []
+    while len(received) < expected:
+        frame = ws.receive()
+        if frame is None:
+            break
+        for msg in json.loads(frame.data.decode("utf8")):
+            if msg["type"] == "message":
+                received.append(msg["message"]["n"])
+    return received
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="workers need os.fork")
+class TestWorkersLoad(object):
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_connect_and_broadcast_throughput(self, workers, run_server):
+        pytest.importorskip("ws4py.client.geventclient")
+        clients = 100
+        broadcasts = 50
+        server = run_server("--workers", str(workers))
+        try:
+            server.wait_ready()
+            start = time.time()
+            greenlets = [
+                gevent.spawn(server.open_websocket, "user_{}".format(i), ["bench"])
+                for i in range(clients)
+            ]
+            gevent.joinall(greenlets, raise_error=True)
+            connect_time = time.time() - start
+            sockets = [g.value for g in greenlets]
+            # let connect events reach every worker
+            gevent.sleep(0.5)
+
+            receivers = [
+                gevent.spawn(receive_messages, ws, broadcasts) for ws in sockets
+            ]
+            start = time.time()
+            posters = [
+                gevent.spawn(
+                    server.post,
+                    "/message",
+                    [{"channel": "bench", "user": "system", "message": {"n": n}}],
+                )
+                for n in range(broadcasts)
+            ]
+            gevent.joinall(posters, raise_error=True)
+            gevent.joinall(receivers, timeout=30)
+            broadcast_time = time.time() - start
+            for ws in sockets:
+                ws.close()
+        finally:
+            server.stop()
+        report(
+            "{} worker(s), {} clients, {} broadcasts".format(
+                workers, clients, broadcasts
+            ),
+            connects_per_s=round(clients / connect_time),
+            deliveries_per_s=round(clients * broadcasts / broadcast_time),
+        )
+        # every client gets every broadcast exactly once
+        for receiver in receivers:
+            assert sorted(receiver.value) == list(range(broadcasts))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def legacy_await_data(connection, config):
+    # drain used before coalescing window, waits for 0.25s of silence
+    frames = []
+    try:
+        frames.append(connection.queue.get(timeout=config["wake_connections_after"]))
+    except Empty:
+        pass
+    while True:
+        try:
+            frames.append(connection.queue.get(timeout=0.25))
+        except Empty:
+            break
+    return frames
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestLongPollLatencyBenchmark(object):
+    def measure(self, drain, config, messages=60):
+        """
+        Publishes messages with random gaps and returns delay between
+        enqueueing each message and the long poll response holding it
+        """
+        connection = Connection("user_1", conn_id=uuid.uuid4())
+        connection.queue = Queue()
+        latencies = []
+        random.seed(1)
+
+        def publish():
+            for i in range(messages):
+                connection.queue.put((i, time.time()))
+                gevent.sleep(random.uniform(0, 0.04))
+
+        publisher = gevent.spawn(publish)
+        received = 0
+        while received < messages:
+            frames = drain(connection, config)
+            now = time.time()
+            latencies.extend(now - sent for i, sent in frames)
+            received += len(frames)
+        publisher.join()
+        return latencies
+
+    def test_latency_percentiles(self):
+        config = {
+            "wake_connections_after": 1,
+            "long_poll_coalesce_window": 0.02,
+            "long_poll_max_wait": 0.25,
+            "long_poll_max_batch": 500,
+        }
+        results = {}
+        for name, drain in (("legacy", legacy_await_data), ("window", await_data)):
+            latencies = self.measure(drain, config)
+            assert len(latencies) == 60
+            for pct in (50, 95, 99):
+                key = "{}_p{}_ms".format(name, pct)
+                results[key] = round(percentile(latencies, pct) * 1e3, 1)
+        report("long poll delivery latency", **results)
+        assert (
+            results["window_p99_ms"]
+            <= (config["long_poll_max_wait"] + config["long_poll_coalesce_window"])
+            * 1e3
+            + 50
+        )
+
+
+class RecordingSocket(DummySocket):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.sent = []
+
+    def send(self, payload):
+        if self.delay:
+            gevent.sleep(self.delay)
+        self.sent.append(payload)
+
+    def received(self):
+        return [m for frame in self.sent for m in json.loads(frame)]
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestWebsocketWriterBenchmark(object):
+    def setup_channel(self, subscribers=100, slow=10):
+        channel = populate_channel(subscribers, use_sockets=True)
+        connections = [c for conns in channel.connections.values() for c in conns]
+        for i, connection in enumerate(connections):
+            connection.socket = RecordingSocket(delay=0.001 if i < slow else 0)
+        return connections
+
+    def test_broadcast_with_slow_subscribers(self):
+        stats = get_state().stats
+        messages = [make_message() for _ in range(20)]
+        frames = [json.wire_dumps([m]) for m in messages]
+
+        # synchronous sends used before writers, publisher waits for each socket
+        connections = self.setup_channel()
+        start = time.time()
+        for frame in frames:
+            for connection in connections:
+                connection.socket.send(frame)
+        legacy = time.time() - start
+
+        get_state().channels = {}
+        connections = self.setup_channel()
+        fast = [c for c in connections if not c.socket.delay]
+        start = time.time()
+        for message in messages:
+            operations.pass_message(message, stats)
+        published = time.time() - start
+        while any(len(c.socket.received()) < 20 for c in fast):
+            gevent.sleep(0.001)
+        fast_delivered = time.time() - start
+        gevent.sleep(0.1)
+        report(
+            "20 broadcasts to 100 websockets, 10 of them slow",
+            legacy_ms=round(legacy * 1e3, 2),
+            writer_publish_ms=round(published * 1e3, 2),
+            writer_fast_delivered_ms=round(fast_delivered * 1e3, 2),
+        )
+        for connection in connections:
+            received = [m["uuid"] for m in connection.socket.received()]
+            assert received == [str(m["uuid"]) for m in messages]
+        slow_sends = [len(c.socket.sent) for c in connections if c.socket.delay]
+        assert max(slow_sends) < 20
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestSnapshotBenchmark(object):
+    # set CHANNELSTREAM_SNAPSHOT_USERS=1000000 for the full size run
+    users = int(os.environ.get("CHANNELSTREAM_SNAPSHOT_USERS", 20000))
+
+    def test_snapshot_and_restore(self, tmpdir):
+        server_state = get_state()
+        for i in range(self.users // 100):
+            name = "channel_{}".format(i)
+            server_state.channels[name] = Channel(
+                name, channel_config={"notify_presence": True}
+            )
+        for i in range(self.users):
+            user = User("user_{}".format(i))
+            user.state_from_dict({"status": "online", "avatar": "/a/{}.png".format(i)})
+            user.state_public_keys = ["status", "avatar"]
+            server_state.users[user.username] = user
+        path = str(tmpdir.join("state.snapshot"))
+
+        start = time.time()
+        size = snapshot.write_snapshot(path)
+        written = time.time() - start
+        server_state.users = {}
+        server_state.channels = {}
+        start = time.time()
+        snapshot.restore_from_file(path)
+        restored = time.time() - start
+        report(
+            "snapshot of {} users".format(self.users),
+            snapshot_s=round(written, 2),
+            restore_s=round(restored, 2),
+            size_mb=round(size / 1e6, 2),
+        )
+        assert len(server_state.users) == self.users
+        assert server_state.users["user_1"].state["avatar"] == "/a/1.png"
+
+
+class TestMetricsOverhead(object):
+    def test_recording_cost(self):
+        histogram = metrics.Histogram("bench_seconds", "benchmark")
+        values = [random.random() for _ in range(100000)]
+
+        def observe():
+            for value in values:
+                histogram.observe(value)
+
+        def baseline():
+            for value in values:
+                pass
+
+        observe_cost = timed(observe) - timed(baseline)
+        locks = ShardedLocks()
+        keys = [("channel", "bench")]
+
+        def hold():
+            for _ in range(100000):
+                with locks.hold(keys):
+                    pass
+
+        report(
+            "metrics recording",
+            observe_ns=round(observe_cost / len(values) * 1e9),
+            uncontended_lock_hold_ns=round(timed(hold, repeat=3) / 100000 * 1e9),
+        )
+        assert histogram.count == len(values) * 10
+
+
+def legacy_api_factory(request):
+    # verification done by APIFactory before the signer and secrets got cached
+    config = request.registry.settings
+    req_secret = request.headers.get(
+        "x-channelstream-secret", request.params.get("secret")
+    )
+    addr = request.environ["REMOTE_ADDR"]
+    if "0.0.0.0" not in config["allow_posting_from"]:
+        if addr not in config["allow_posting_from"]:
+            return
+    TimestampSigner(config["secret"]).unsign(req_secret, max_age=60)
+
+
+class TestAPIFactoryBenchmark(object):
+    def test_request_verification(self):
+        allowed = ["192.168.0.{}".format(i) for i in range(50)] + ["127.0.0.1"]
+        config = testing.setUp(
+            settings={"secret": "secret", "allow_posting_from": allowed}
+        )
+        secret = TimestampSigner("secret").sign("channelstream").decode("utf8")
+        request = testing.DummyRequest(
+            environ={"REMOTE_ADDR": "127.0.0.1"},
+            headers={"x-channelstream-secret": secret},
+            registry=config.registry,
+        )
+        repeat = 10000
+
+        def legacy():
+            for _ in range(repeat):
+                legacy_api_factory(request)
+
+        def cached():
+            for _ in range(repeat):
+                APIFactory(request)
+
+        report(
+            "API request verification",
+            legacy_us=round(timed(legacy, repeat=3) / repeat * 1e6, 2),
+            cached_us=round(timed(cached, repeat=3) / repeat * 1e6, 2),
+        )
+        assert APIFactory(request).__acl__
+        testing.tearDown()
+
+
+class TestValidationBenchmark(object):
+    def test_message_batch_validation(self):
+        body = [
+            {
+                "channel": "bench",
+                "user": "system",
+                "message": {"text": "lorem ipsum dolor sit amet"},
+                "pm_users": ["user_{}".format(i % 10)],
+            }
+            for i in range(1000)
+        ]
+        connect_body = {
+            "username": "user",
+            "channels": ["a", "b", "c"],
+            "user_state": {"status": "online", "score": 5},
+            "channel_configs": {"a": {"store_history": True}},
+        }
+
+        def marshmallow_messages():
+            schemas.MessageBodySchema(many=True).load(body)
+
+        def compiled_messages():
+            compiled.MESSAGE_BODY.load(body, many=True)
+
+        def marshmallow_connect():
+            for _ in range(100):
+                schemas.ConnectBodySchema().load(connect_body)
+
+        def compiled_connect():
+            for _ in range(100):
+                compiled.CONNECT_BODY.load(connect_body)
+
+        report(
+            "validation throughput per second",
+            marshmallow_messages=int(len(body) / timed(marshmallow_messages, 3)),
+            compiled_messages=int(len(body) / timed(compiled_messages, 3)),
+            marshmallow_connects=int(100 / timed(marshmallow_connect, 3)),
+            compiled_connects=int(100 / timed(compiled_connect, 3)),
+        )
@@ -0,0 +1,77 @@
+from gevent import monkey
+
+monkey.patch_all()
+
+import json
+import os
+
+import gevent
+import pytest
+
+from conftest import free_port
+
+
+def receive_texts(ws, expected, timeout=10):
+    received = []
+
+    def receive():
+        while len(received) < expected:
+            frame = ws.receive()
+            if frame is None:
+                break
+            for msg in json.loads(frame.data.decode("utf8")):
+                if msg["type"] == "message":
+                    received.append(msg["message"]["text"])
+
+    gevent.spawn(receive).join(timeout)
+    return received
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="integration test runs servers")
+class TestTCPCluster(object):
+    def test_messages_reach_only_interested_nodes(self, run_server):
+        pytest.importorskip("ws4py.client.geventclient")
+        cluster_ports = [free_port() for _ in range(3)]
+        nodes = []
+        for i, port in enumerate(cluster_ports):
+            peers = ",".join(
+                "127.0.0.1:{}".format(p) for p in cluster_ports if p != port
+            )
+            nodes.append(
+                run_server(
+                    "--cluster_listen",
+                    "127.0.0.1:{}".format(port),
+                    "--cluster_peers",
+                    peers,
+                )
+            )
+        for node in nodes:
+            node.wait_ready()
+        publisher, subscriber, bystander = nodes
+        ws = subscriber.open_websocket("user_b", ["room"])
+        pm_ws = bystander.open_websocket("user_c", ["other"])
+        # wait for peers to connect and exchange interest
+        for _ in range(100):
+            peers = publisher.admin_info()["cluster"]["peers"]
+            if all(peer["interest"] for peer in peers):
+                break
+            gevent.sleep(0.1)
+
+        publisher.post(
+            "/message",
+            [
+                {"channel": "room", "user": "system", "message": {"text": "1"}},
+                {"channel": "room", "user": "system", "message": {"text": "2"}},
+                {"user": "system", "pm_users": ["user_c"], "message": {"text": "pm"}},
+            ],
+        )
+        assert receive_texts(ws, 2) == ["1", "2"]
+        assert receive_texts(pm_ws, 1) == ["pm"]
+        ws.close()
+        pm_ws.close()
+
+        cluster_info = [node.admin_info()["cluster"] for node in nodes]
+        assert cluster_info[0]["relayed"] == 2
+        assert cluster_info[1]["received"] == 1
+        # bystander only got the private message, nothing for "room"
+        assert cluster_info[2]["received"] == 1
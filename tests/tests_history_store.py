@@ -0,0 +1,245 @@
+from gevent import monkey
+
+monkey.patch_all()
+
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+import gevent
+import pytest
+
+from channelstream import history_store
+from channelstream.channel import Channel
+from channelstream.server_state import get_or_create_state
+
+CONFIG = {"store_history": True, "history_size": 5, "frames_size": 5}
+
+
+def message(text, msg_uuid=None):
+    return {
+        "uuid": msg_uuid or uuid.uuid4(),
+        "type": "message",
+        "user": "system",
+        "message": {"text": text},
+        "no_history": False,
+        "pm_users": [],
+        "exclude_users": [],
+    }
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def store(request, tmpdir):
+    if request.param == "file":
+        store = history_store.FileHistoryStore(str(tmpdir.join("history")))
+    else:
+        store = history_store.SQLiteHistoryStore(str(tmpdir.join("history.db")))
+    history_store.configure_history_store(store)
+    yield store
+    store.close()
+    history_store.configure_history_store(None)
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestHistoryStore(object):
+    def test_channel_restored(self, store, test_uuids):
+        channel = Channel("room", channel_config=CONFIG)
+        for i in range(3):
+            channel.add_message(message(str(i), test_uuids[i]))
+        channel.alter_message(dict(message("edited"), uuid=test_uuids[1], edited=None))
+        channel.delete_message(dict(message(""), uuid=test_uuids[2]))
+        last_seq = channel.frames[-1][1]["seq"]
+        store.flush()
+
+        restored = Channel("room", channel_config=CONFIG)
+        assert [e["message"]["text"] for e in restored.history] == ["0", "edited"]
+        assert [f[1]["seq"] for f in restored.frames] == [
+            f[1]["seq"] for f in channel.frames
+        ]
+        assert restored.frames.lookup(test_uuids[2]) == (None, None)
+        # sequence numbers continue after restart
+        restored.add_message(message("3"))
+        assert restored.frames[-1][1]["seq"] == last_seq + 1
+
+    def test_writes_are_batched(self, store):
+        channel = Channel("room", channel_config=CONFIG)
+        for i in range(50):
+            channel.add_message(message(str(i)))
+        # nothing is written on publish
+        assert store.writes == 0
+        assert len(store.pending) == 50
+        store.flush()
+        assert store.writes == 1
+        assert store.written == 50
+
+    def test_flushed_in_background(self, store):
+        store.flush_interval = 0.01
+        store.start()
+        channel = Channel("room", channel_config=CONFIG)
+        channel.add_message(message("test"))
+        gevent.sleep(0.1)
+        assert store.pending == []
+        assert store.written == 1
+
+    def test_log_gets_compacted(self, store, test_uuids):
+        channel = Channel("room", channel_config=CONFIG)
+        for i in range(200):
+            channel.add_message(message(str(i)))
+        channel.delete_message(dict(message(""), uuid=channel.frames[-2][1]["uuid"]))
+        store.flush()
+        assert len(store.read_records("room")) < 150
+
+        restored = Channel("room", channel_config=CONFIG)
+        assert [e["message"]["text"] for e in restored.history] == [
+            e["message"]["text"] for e in channel.history
+        ]
+        assert [f[0] for f in restored.frames.entries()] == [
+            f[0] for f in channel.frames.entries()
+        ]
+
+    def test_history_kept_by_channel_created_without_it(self, store, test_uuids):
+        channel = Channel("room", channel_config=CONFIG)
+        for i in range(3):
+            channel.add_message(message(str(i), test_uuids[i]))
+        channel.alter_message(dict(message("edited"), uuid=test_uuids[1], edited=None))
+        store.flush()
+
+        # after restart plain message creates channel with default config
+        channel = Channel("room")
+        assert channel.store_history is False
+        for i in range(400):
+            channel.add_message(message("plain"))
+        store.flush()
+        # log got compacted
+        assert len(store.read_records("room")) < 200
+
+        restored = Channel("room", channel_config=CONFIG)
+        assert [e["message"]["text"] for e in restored.history] == ["0", "edited", "2"]
+
+    def test_channels_do_not_share_records(self, store):
+        Channel("room", channel_config=CONFIG).add_message(message("test"))
+        store.flush()
+        assert len(Channel("other", channel_config=CONFIG).history) == 0
+
+    def test_history_loaded_on_first_access(self, store):
+        Channel("room", channel_config=CONFIG).add_message(message("test"))
+        store.flush()
+        restored = Channel("room", channel_config=CONFIG)
+        assert restored.history_pending is True
+        assert len(restored.frames) == 1
+        assert restored.history_pending is False
+
+    def test_failed_write_is_retried(self, store, monkeypatch):
+        write_batch = store.write_batch
+        calls = []
+
+        def fail_once(batch):
+            calls.append(batch)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError("database is locked")
+            return write_batch(batch)
+
+        monkeypatch.setattr(store, "write_batch", fail_once)
+        channel = Channel("room", channel_config=CONFIG)
+        channel.add_message(message("first"))
+        store.flush()
+        assert store.written == 0
+        assert len(store.pending) == 1
+        channel.add_message(message("second"))
+        store.flush()
+        assert store.pending == []
+        assert store.written == 2
+        restored = Channel("room", channel_config=CONFIG)
+        assert [e["message"]["text"] for e in restored.history] == ["first", "second"]
+
+    def test_record_that_can_not_be_encoded_is_dropped(self, store):
+        store.append("room", {"op": "add", "payload": {"bad": object()}})
+        channel = Channel("room", channel_config=CONFIG)
+        channel.add_message(message("test"))
+        store.flush()
+        assert store.pending == []
+        restored = Channel("room", channel_config=CONFIG)
+        assert [e["message"]["text"] for e in restored.history] == ["test"]
+
+    def test_read_only_store_does_not_write(self, store):
+        store.read_only = True
+        Channel("room", channel_config=CONFIG).add_message(message("test"))
+        assert store.pending == []
+
+
+def test_damaged_record_is_skipped(tmpdir, test_uuids):
+    store = history_store.FileHistoryStore(str(tmpdir))
+    store.append("room", {"op": "delete", "uuid": test_uuids[0]})
+    store.flush()
+    # write cut short by a crash
+    with open(store.channel_path("room"), "ab") as handle:
+        handle.write(b'{"op": "add", "payl')
+    assert store.load("room") == [{"op": "delete", "uuid": test_uuids[0]}]
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+def test_long_channel_names(tmpdir):
+    get_or_create_state("acme")
+    store = history_store.FileHistoryStore(str(tmpdir))
+    history_store.configure_history_store(store)
+    try:
+        name = "x" * 256
+        channel = Channel(name, channel_config=CONFIG, tenant_id="acme")
+        channel.add_message(message("test"))
+        store.flush()
+        assert store.written == 1
+        with open(store.channel_path(channel.store_key), "rb") as handle:
+            header = handle.readline()
+        assert json.loads(header[1:].decode("utf8")) == {"channel": channel.store_key}
+        restored = Channel(name, channel_config=CONFIG, tenant_id="acme")
+        assert [e["message"]["text"] for e in restored.history] == ["test"]
+    finally:
+        history_store.configure_history_store(None)
+
+
+def test_failing_channel_keeps_other_records(tmpdir, test_uuids):
+    store = history_store.FileHistoryStore(str(tmpdir))
+    # file of this channel can not be opened
+    os.mkdir(store.channel_path("broken"))
+    store.append("broken", {"op": "delete", "uuid": test_uuids[0]})
+    store.append("room", {"op": "delete", "uuid": test_uuids[1]})
+    store.flush()
+    assert store.written == 1
+    # records of the failed channel wait for the next flush
+    assert store.pending == [
+        ("append", "broken", {"op": "delete", "uuid": test_uuids[0]})
+    ]
+    assert store.load("room") == [{"op": "delete", "uuid": test_uuids[1]}]
+
+
+def test_make_store(tmpdir):
+    path = str(tmpdir.join("history.db"))
+    assert isinstance(
+        history_store.make_store("sqlite:" + path), history_store.SQLiteHistoryStore
+    )
+    with pytest.raises(ValueError):
+        history_store.make_store("redis://localhost")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="integration test runs servers")
+def test_history_survives_restart(run_server, tmpdir):
+    store = "file:" + str(tmpdir.join("history"))
+    server = run_server("--history_store", store)
+    server.wait_ready()
+    server.post("/channel_config", {"room": {"store_history": True}})
+    server.post(
+        "/message",
+        [{"channel": "room", "user": "system", "message": {"text": "before"}}],
+    )
+    # let the background writer run
+    time.sleep(0.5)
+    server.stop()
+
+    server = run_server("--history_store", store)
+    server.wait_ready()
+    server.post("/channel_config", {"room": {"store_history": True}})
+    info = server.post("/info", {"info": {"channels": ["room"]}})
+    history = info["channels"]["room"]["history"]
+    assert [m["message"]["text"] for m in history] == ["before"]
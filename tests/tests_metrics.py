@@ -0,0 +1,134 @@
+from gevent import monkey
+
+monkey.patch_all()
+
+import gevent
+import pytest
+
+from channelstream import gc, metrics, operations
+from channelstream.locks import ShardedLocks
+from channelstream.outbound import LongPollBuffer
+from channelstream.server_state import get_state
+
+
+@pytest.fixture
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+class TestHistogram(object):
+    def test_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "test", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        assert list(histogram.samples()) == [
+            ('test_seconds_bucket{le="0.1"}', 2),
+            ('test_seconds_bucket{le="1.0"}', 3),
+            ('test_seconds_bucket{le="+Inf"}', 4),
+            ("test_seconds_sum", 2.65),
+            ("test_seconds_count", 4),
+        ]
+
+    def test_render(self, reset_metrics):
+        metrics.HEARTBEATS_SENT.inc(3)
+        text = metrics.render([("test_gauge", "gauge", "Test gauge", 5)])
+        assert "# TYPE test_gauge gauge\ntest_gauge 5\n" in text
+        assert "channelstream_heartbeats_sent_total 3\n" in text
+        assert "# TYPE channelstream_lock_wait_seconds histogram" in text
+
+
+@pytest.mark.usefixtures("cleanup_globals", "reset_metrics")
+class TestBufferDepths(object):
+    def test_total_and_max_follow_buffers(self):
+        depths = metrics.BufferDepths()
+        for depth in (1, 2, 3):
+            depths.grew(depth)
+        depths.grew(1)
+        assert (depths.total, depths.max) == (4, 3)
+        depths.shrank(2)
+        assert (depths.total, depths.max) == (3, 2)
+        depths.shrank(0)
+        assert (depths.total, depths.max) == (2, 2)
+        depths.shrank(1)
+        depths.shrank(0)
+        assert (depths.total, depths.max) == (0, 0)
+
+    def test_buffers_update_depths(self):
+        depths = metrics.OUTBOUND_DEPTHS
+        total = depths.total
+        buffers = [LongPollBuffer(), LongPollBuffer()]
+        for frame in (b"[1]", b"[2]", b"[3]"):
+            buffers[0].put(frame)
+        buffers[1].put(b"[1]")
+        assert depths.total == total + 4
+        assert depths.max >= 3
+        buffers[0].get_nowait()
+        assert depths.total == total + 3
+        for buffer in buffers:
+            buffer.drain()
+        assert depths.total == total
+
+
+class TestRecording(object):
+    def test_contended_lock_wait_is_observed(self):
+        locks = ShardedLocks(shards=1)
+        with locks.hold(["a"]):
+            pass
+        assert metrics.LOCK_WAIT.count == 0
+
+        def hold():
+            with locks.hold(["a"]):
+                gevent.sleep(0.01)
+
+        holder = gevent.spawn(hold)
+        gevent.sleep(0)
+        with locks.hold(["a"]):
+            pass
+        holder.join()
+        assert metrics.LOCK_WAIT.count == 1
+        assert metrics.LOCK_WAIT.sum >= 0.005
+
+    def test_publish_fanout_is_observed(self, test_uuids):
+        operations.connect(
+            username="test_user",
+            conn_id=test_uuids[1],
+            channels=["a"],
+            channel_configs={},
+        )
+        msg = {
+            "channel": "a",
+            "message": "test",
+            "user": "system",
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        operations.pass_message(msg, get_state().stats)
+        assert metrics.PUBLISH_FANOUT.count == 1
+        assert metrics.PUBLISH_RECIPIENTS.sum == 1
+
+    def test_state_samples(self, test_uuids):
+        connection, user = operations.connect(
+            username="test_user",
+            conn_id=test_uuids[1],
+            channels=["a"],
+            channel_configs={},
+        )
+        queued = metrics.OUTBOUND_DEPTHS.total
+        connection.queue = LongPollBuffer()
+        connection.queue.put(b"[]")
+        samples = {s[0]: s[3] for s in metrics.state_samples([get_state()])}
+        assert samples["channelstream_connections"] == 1
+        assert samples["channelstream_outbound_queued_frames"] == queued + 1
+        assert samples["channelstream_outbound_max_queued_frames"] >= 1
+        gc.collect_connection(connection)
+        assert metrics.OUTBOUND_DEPTHS.total == queued
+
+
+def test_metrics_view(dummy_request):
+    from channelstream.wsgi_views.server import metrics_view
+
+    response = metrics_view(dummy_request)
+    assert response.content_type == "text/plain"
+    assert "channelstream_publish_fanout_seconds_count" in response.text
@@ -0,0 +1,102 @@
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from channelstream import operations, snapshot
+from channelstream.server_state import get_state
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestSnapshot(object):
+    def populate(self, test_uuids):
+        operations.connect(
+            username="test_user",
+            conn_id=test_uuids[1],
+            fresh_user_state={"color": "red"},
+            state_public_keys=["color"],
+            channels=["a"],
+            channel_configs={"a": {"store_history": True, "history_size": 3}},
+        )
+        get_state().stats["total_messages"] = 10
+
+    def test_roundtrip(self, test_uuids, tmpdir):
+        self.populate(test_uuids)
+        path = str(tmpdir.join("state.snapshot"))
+        size = snapshot.write_snapshot(path)
+        assert size == os.path.getsize(path)
+
+        server_state = get_state()
+        server_state.channels = {}
+        server_state.users = {}
+        server_state.stats["total_messages"] = 0
+        snapshot.restore_from_file(path)
+        channel = server_state.channels["a"]
+        assert channel.store_history is True
+        assert channel.history_size == 3
+        user = server_state.users["test_user"]
+        assert user.state == {"color": "red"}
+        assert user.state_public_keys == ["color"]
+        assert server_state.stats["total_messages"] == 10
+        # connections are not restored
+        assert channel.connections == {}
+        assert user.connections == []
+
+    def test_existing_objects_are_kept(self, test_uuids):
+        self.populate(test_uuids)
+        data = snapshot.take_snapshot()
+        user = get_state().users["test_user"]
+        user.state_from_dict({"color": "blue"})
+        snapshot.restore_snapshot(data)
+        assert get_state().users["test_user"] is user
+        assert user.state["color"] == "blue"
+
+    def test_state_is_copied(self, test_uuids):
+        self.populate(test_uuids)
+        data = snapshot.take_snapshot()
+        get_state().users["test_user"].state_from_dict({"color": "blue"})
+        assert data["users"][0][1] == {"color": "red"}
+
+    def test_last_activity_restored(self, test_uuids):
+        self.populate(test_uuids)
+        long_ago = datetime.utcnow() - timedelta(days=2)
+        get_state().users["test_user"].last_active = long_ago
+        data = snapshot.take_snapshot()
+        get_state().users = {}
+        snapshot.restore_snapshot(data)
+        assert get_state().users["test_user"].last_active == long_ago
+
+    def test_missing_and_damaged_file(self, tmpdir):
+        path = str(tmpdir.join("state.snapshot"))
+        assert snapshot.read_snapshot(path) is None
+        with open(path, "wb") as handle:
+            handle.write(b"garbage")
+        with pytest.raises(ValueError):
+            snapshot.read_snapshot(path)
+        # server still starts
+        snapshot.restore_from_file(path)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="integration test runs servers")
+def test_state_survives_restart(run_server, tmpdir):
+    path = str(tmpdir.join("state.snapshot"))
+    server = run_server("--snapshot_path", path)
+    server.wait_ready()
+    server.post("/channel_config", {"room": {"notify_presence": True}})
+    server.post(
+        "/connect",
+        {"username": "user_a", "channels": [], "fresh_user_state": {"color": "red"}},
+    )
+    server.stop()
+    assert os.path.exists(path)
+
+    server = run_server("--snapshot_path", path)
+    server.wait_ready()
+    info = server.post("/info", {"info": {"channels": ["room"]}})
+    assert info["channels"]["room"]["settings"]["notify_presence"] is True
+    state = server.post("/user_state", {"user": "user_a", "user_state": {}})
+    assert state["user_state"]["color"] == "red"
@@ -0,0 +1,256 @@
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+from datetime import timedelta
+
+import pytest
+import requests
+from itsdangerous import BadSignature, TimestampSigner
+from pyramid import testing
+
+from channelstream import cluster, gc, operations, quotas, replication, snapshot
+from channelstream import tenants
+from channelstream.outbound import LongPollBuffer
+from channelstream.server_state import (
+    DEFAULT_TENANT,
+    get_or_create_state,
+    get_state,
+    tenant_key,
+)
+from channelstream.wsgi_views.wsgi_security import APIFactory, APISecurity
+
+
+class TenantContext(object):
+    def __init__(self, tenant_id):
+        self.tenant_id = tenant_id
+
+
+def connect(tenant_id, username, conn_id, channels):
+    connection, user = operations.connect(
+        username=username,
+        conn_id=conn_id,
+        channels=channels,
+        channel_configs={},
+        tenant_id=get_or_create_state(tenant_id).tenant_id,
+    )
+    connection.queue = LongPollBuffer()
+    return connection
+
+
+def message(channel, text):
+    return {
+        "channel": channel,
+        "user": "system",
+        "message": {"text": text},
+        "pm_users": [],
+        "exclude_users": [],
+        "no_history": False,
+    }
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestIsolation(object):
+    def test_same_names_in_different_tenants(self, test_uuids):
+        default = connect(DEFAULT_TENANT, "user", test_uuids[0], ["room"])
+        acme = connect("acme", "user", test_uuids[1], ["room"])
+        assert get_state().users["user"] is not get_state("acme").users["user"]
+        operations.pass_messages(
+            [message("room", "hi")], get_state("acme").stats, tenant_id="acme"
+        )
+        assert acme.queue.qsize() == 1
+        assert default.queue.qsize() == 0
+        assert get_state("acme").stats["total_messages"] == 1
+        assert get_state().stats["total_messages"] == 0
+
+    def test_connection_found_in_any_tenant(self, test_uuids):
+        connection = connect("acme", "user", test_uuids[1], ["room"])
+        assert operations.find_connection(test_uuids[1]) is connection
+        assert operations.get_connection(test_uuids[1], DEFAULT_TENANT) is None
+        assert operations.disconnect(test_uuids[1]) is True
+
+    def test_gc_collects_only_own_tenant(self, test_uuids):
+        default = connect(DEFAULT_TENANT, "user", test_uuids[0], ["room"])
+        acme = connect("acme", "user", test_uuids[1], ["room"])
+        for connection in (default, acme):
+            connection.last_active -= timedelta(minutes=5)
+            get_state(connection.tenant_id).connection_expiry.track(connection)
+        gc.gc_conns(server_state=get_state("acme"))
+        assert test_uuids[1] not in get_state("acme").connections
+        assert test_uuids[0] in get_state().connections
+
+    def test_replicated_events_create_tenant(self, test_uuids):
+        replication.apply_event(
+            "connect",
+            {
+                "username": "user",
+                "conn_id": test_uuids[1],
+                "channels": ["room"],
+                "channel_configs": {},
+                "tenant_id": "acme",
+            },
+        )
+        assert test_uuids[1] in get_state("acme").connections
+        assert get_state().connections == {}
+
+    def test_relayed_messages_reach_tenant(self, test_uuids):
+        acme = connect("acme", "user", test_uuids[1], ["room"])
+        kind = cluster.routing_kind("channel", "acme")
+        assert cluster.split_routing_kind(kind) == ("channel", "acme")
+        replication.apply_relayed_messages(
+            kind, "room", "messages", [message("room", "hi")]
+        )
+        assert acme.queue.qsize() == 1
+
+    def test_history_keys_do_not_collide(self):
+        keys = {
+            tenant_key(DEFAULT_TENANT, u"room"),
+            tenant_key(DEFAULT_TENANT, u"\x00acme\x00room"),
+            tenant_key(u"acme", u"room"),
+            tenant_key(u"acme", u"\x00acme\x00room"),
+        }
+        assert len(keys) == 4
+        assert tenant_key(DEFAULT_TENANT, u"room") == u"room"
+
+    def test_snapshot_holds_all_tenants(self, test_uuids, tmpdir):
+        connect(DEFAULT_TENANT, "user_a", test_uuids[0], ["room"])
+        connect("acme", "user_b", test_uuids[1], ["lobby"])
+        path = str(tmpdir.join("state.snapshot"))
+        snapshot.write_snapshot(path)
+        tenants.reset()
+        get_state().users = {}
+        get_state().channels = {}
+        snapshot.restore_from_file(path)
+        assert list(get_state().users) == ["user_a"]
+        assert list(get_state("acme").users) == ["user_b"]
+        assert get_state("acme").channels["lobby"].tenant_id == "acme"
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestQuotas(object):
+    def test_connections(self, test_uuids):
+        server_state = get_state()
+        server_state.quotas = quotas.Quotas(max_connections=1)
+        connect(DEFAULT_TENANT, "user", test_uuids[0], [])
+        # reconnecting with existing connection id is fine
+        server_state.quotas.check_connection(server_state, test_uuids[0])
+        with pytest.raises(quotas.QuotaExceeded):
+            server_state.quotas.check_connection(server_state, test_uuids[1])
+        assert server_state.quotas.rejected["connections"] == 1
+
+    def test_channels(self, test_uuids):
+        server_state = get_state()
+        server_state.quotas = quotas.Quotas(max_channels=2)
+        connect(DEFAULT_TENANT, "user", test_uuids[0], ["a"])
+        server_state.quotas.check_channels(server_state, ["a", "b"])
+        with pytest.raises(quotas.QuotaExceeded):
+            server_state.quotas.check_channels(server_state, ["b", "c"])
+
+    def test_message_rate(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(quotas.time, "time", lambda: now[0])
+        limits = quotas.Quotas(max_messages_per_second=10)
+        limits.consume_messages(10)
+        with pytest.raises(quotas.QuotaExceeded):
+            limits.consume_messages(1)
+        now[0] += 0.5
+        limits.consume_messages(5)
+        with pytest.raises(quotas.QuotaExceeded):
+            limits.consume_messages(1)
+
+    def test_configured_per_tenant(self):
+        tenants.configure_tenants(
+            {
+                "tenant_max_connections": 100,
+                "tenants": {"acme": {"secret": "acme_secret", "max_connections": 5}},
+            }
+        )
+        assert get_state("acme").quotas.max_connections == 5
+        assert get_state().quotas.max_connections == 100
+        assert get_or_create_state("other").quotas.max_connections == 100
+        with pytest.raises(ValueError):
+            tenants.configure_tenants({"tenants": {"bad tenant": {}}})
+
+    def test_connect_view_rejects(self, dummy_request, pyramid_config, test_uuids):
+        from channelstream.wsgi_views.server import connect as connect_view
+
+        get_or_create_state("acme").quotas = quotas.Quotas("acme", max_connections=1)
+        dummy_request.context = TenantContext("acme")
+        dummy_request.json_body = {"username": "user", "channels": ["room"]}
+        connect_view(dummy_request)
+        with pytest.raises(quotas.QuotaExceeded):
+            connect_view(dummy_request)
+        assert len(get_state("acme").connections) == 1
+        assert get_state().connections == {}
+
+
+class TestTenantSecrets(object):
+    settings = {
+        "secret": "secret",
+        "allow_posting_from": ["127.0.0.1"],
+        "tenants": {"acme": {"secret": "acme_secret"}, "globex": {}},
+    }
+
+    def sign(self, secret):
+        return TimestampSigner(secret).sign("channelstream").decode("utf8")
+
+    def test_shared_secret_selects_tenant_by_header(self):
+        security = APISecurity(self.settings)
+        secret = self.sign("secret")
+        assert security.verify(secret) == DEFAULT_TENANT
+        assert security.verify(secret, tenant_id="globex") == "globex"
+
+    def test_tenant_secret_selects_tenant(self):
+        security = APISecurity(self.settings)
+        secret = self.sign("acme_secret")
+        assert security.verify(secret) == "acme"
+        assert security.verify(secret, tenant_id="acme") == "acme"
+        # also when the secret is already cached
+        for _ in range(2):
+            with pytest.raises(BadSignature):
+                security.verify(secret, tenant_id="globex")
+
+    def test_api_factory(self):
+        config = testing.setUp(settings=self.settings)
+        try:
+            request = testing.DummyRequest(
+                environ={"REMOTE_ADDR": "127.0.0.1"}, registry=config.registry
+            )
+            request.headers["x-channelstream-secret"] = self.sign("secret")
+            request.headers["x-channelstream-tenant"] = "initech"
+            factory = APIFactory(request)
+            assert factory.tenant_id == "initech"
+            assert get_state("initech").tenant_id == "initech"
+
+            request.headers["x-channelstream-tenant"] = "../etc"
+            assert APIFactory(request).__acl__ == []
+        finally:
+            testing.tearDown()
+            tenants.reset()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="integration test runs servers")
+def test_tenant_quotas_over_http(run_server):
+    server = run_server("--tenant_max_channels", "1")
+    server.wait_ready()
+
+    def connect_to(tenant_id, channel):
+        return requests.post(
+            server.url + "/connect",
+            json={"username": "user", "channels": [channel]},
+            headers={
+                "x-channelstream-secret": server.secret,
+                "x-channelstream-tenant": tenant_id,
+            },
+        )
+
+    assert connect_to("acme", "a").status_code == 200
+    response = connect_to("acme", "b")
+    assert response.status_code == 429
+    assert response.json()["quota"] == "channels"
+    # other tenants have quotas of their own
+    assert connect_to("globex", "b").status_code == 200
+    info = server.admin_info()
+    assert info["tenants"]["acme"]["channels"] == 1
+    assert info["tenants"]["globex"]["connections"] == 1
@@ -0,0 +1,191 @@
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+import pytest
+from marshmallow import ValidationError
+
+from channelstream.validation import compiled, schemas
+
+MSG_UUID = "12345678-1234-5678-1234-567812345678"
+
+MESSAGES = [
+    [{"channel": "a", "user": "u", "message": {"text": "x"}}],
+    [
+        {
+            "channel": "a",
+            "user": "u",
+            "message": {"text": "x", "nested": {"a": [1, 2]}},
+            "pm_users": ["b", "c"],
+            "exclude_users": ["d"],
+            "no_history": True,
+            "uuid": MSG_UUID,
+            "timestamp": "2018-01-01T10:00:00",
+        },
+        {"channel": "a", "user": "u", "timestamp": "2018-01-01T10:00:00.123456"},
+        {"pm_users": ["b"], "user": "żółw", "unknown": 1},
+        {"channel": None, "user": "u", "timestamp": "2018-01-01T10:00:00+02:00"},
+    ],
+    [],
+]
+MESSAGES_LOADED_BY_MARSHMALLOW = [
+    [{"channel": "a", "user": "u", "no_history": 1}],
+    [{"channel": "a", "user": "u", "uuid": uuid.UUID(MSG_UUID)}],
+]
+INVALID_MESSAGES = [
+    [{"channel": "a", "message": {}}],
+    [{"channel": "a", "user": ""}],
+    [{"channel": "a", "user": 123}],
+    [{"channel": "a", "user": "x" * 513}],
+    [{"channel": "", "user": "u"}],
+    [{"channel": 5, "user": "u"}],
+    [{"pm_users": "abc", "user": "u"}],
+    [{"pm_users": [""], "user": "u"}],
+    [{"pm_users": [None], "user": "u"}],
+    [{"channel": "a", "user": "u", "uuid": "not-uuid"}],
+    [{"channel": "a", "user": "u", "uuid": 5}],
+    [{"channel": "a", "user": "u", "timestamp": "garbage"}],
+    [{"channel": "a", "user": "u", "timestamp": ""}],
+    [{"channel": "a", "user": "u", "timestamp": "2018-02-30T10:00:00"}],
+    [{"channel": "a", "user": "u", "timestamp": "2018-01-01T10:00:00\nx"}],
+    [{"channel": "a", "user": "u", "no_history": "maybe"}],
+    [{"channel": "a", "user": "u", "message": "text"}],
+    [{"channel": "a", "user": "u"}, {"channel": "a", "user": None}],
+    ["message"],
+    {"channel": "a", "user": "u"},
+]
+
+EDITS = [
+    [{"uuid": MSG_UUID, "channel": "a", "message": {"text": "edited"}}],
+    [{"uuid": MSG_UUID, "user": "u", "edited": "2018-01-01T10:00:00"}],
+]
+INVALID_EDITS = [
+    [{"channel": "a", "message": {"text": "edited"}}],
+    [{"uuid": MSG_UUID, "user": None}],
+    [{"uuid": MSG_UUID, "edited": "yesterday"}],
+]
+
+CONNECTS = [
+    {"username": "u"},
+    {
+        "username": "u",
+        "conn_id": MSG_UUID,
+        "channels": ["a", "b"],
+        "state_public_keys": ["color"],
+        "fresh_user_state": {"color": "red", "age": 5, "score": 1.5, "on": True},
+        "user_state": {"away": None},
+        "channel_configs": {
+            "a": {"store_history": True, "history_size": 0, "frames_size": 5},
+            "b": {},
+        },
+        "info": {"include_history": False, "channels": ["a"]},
+    },
+]
+CONNECTS_LOADED_BY_MARSHMALLOW = [
+    {"username": "u", "channel_configs": {"a": {"history_size": "5"}}}
+]
+INVALID_CONNECTS = [
+    {},
+    {"username": ""},
+    {"username": "u", "conn_id": "abc"},
+    {"username": "u", "channels": [""]},
+    {"username": "u", "channels": "a"},
+    {"username": "u", "state_public_keys": [1]},
+    {"username": "u", "user_state": {"a": [1]}},
+    {"username": "u", "user_state": "state"},
+    {"username": "u", "fresh_user_state": {1: "a"}},
+    {"username": "u", "channel_configs": {"a": {"history_size": -1}}},
+    {"username": "u", "channel_configs": {"a": "config"}},
+    {"username": "u", "info": {"include_users": "nope"}},
+    ["u"],
+]
+
+CORPUS = (
+    [(compiled.MESSAGE_BODY, True, data) for data in MESSAGES]
+    + [(compiled.MESSAGE_EDIT_BODY, True, data) for data in EDITS]
+    + [(compiled.CONNECT_BODY, False, data) for data in CONNECTS]
+)
+MARSHMALLOW_CORPUS = [
+    (compiled.MESSAGE_BODY, True, data) for data in MESSAGES_LOADED_BY_MARSHMALLOW
+] + [(compiled.CONNECT_BODY, False, data) for data in CONNECTS_LOADED_BY_MARSHMALLOW]
+INVALID_CORPUS = (
+    [(compiled.MESSAGE_BODY, True, data) for data in INVALID_MESSAGES]
+    + [(compiled.MESSAGE_EDIT_BODY, True, data) for data in INVALID_EDITS]
+    + [(compiled.CONNECT_BODY, False, data) for data in INVALID_CONNECTS]
+)
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def utcnow(cls):
+        return datetime(2018, 5, 5, 12, 0, 0)
+
+
+@pytest.fixture(autouse=True)
+def fixed_defaults(monkeypatch):
+    # generated uuids and timestamps have to be the same in both results
+    monkeypatch.setattr(uuid, "uuid4", lambda: uuid.UUID(MSG_UUID))
+    monkeypatch.setattr(schemas, "datetime", FixedDatetime)
+
+
+def assert_same(fast, expected):
+    assert type(fast) is type(expected)
+    if isinstance(expected, OrderedDict):
+        assert list(fast.keys()) == list(expected.keys())
+    if isinstance(expected, dict):
+        assert sorted(fast.keys(), key=repr) == sorted(expected.keys(), key=repr)
+        for key in expected:
+            assert_same(fast[key], expected[key])
+    elif isinstance(expected, list):
+        assert len(fast) == len(expected)
+        for fast_item, expected_item in zip(fast, expected):
+            assert_same(fast_item, expected_item)
+    else:
+        assert fast == expected
+
+
+def marshmallow_load(compiled_schema, many, data):
+    return compiled_schema.schema_class(many=many).load(data).data
+
+
+def no_fallback(*args, **kwargs):
+    raise AssertionError("data was loaded by marshmallow")
+
+
+@pytest.mark.parametrize("compiled_schema, many, data", CORPUS)
+def test_same_result(compiled_schema, many, data, monkeypatch):
+    expected = marshmallow_load(compiled_schema, many, data)
+    schema_class = compiled_schema.schema_class
+    monkeypatch.setattr(compiled_schema, "schema_class", no_fallback)
+    assert_same(compiled_schema.load(data, many=many), expected)
+    # input is not modified
+    monkeypatch.setattr(compiled_schema, "schema_class", schema_class)
+    assert_same(compiled_schema.load(data, many=many), expected)
+
+
+@pytest.mark.parametrize("compiled_schema, many, data", MARSHMALLOW_CORPUS)
+def test_unusual_input_loaded_by_marshmallow(compiled_schema, many, data):
+    expected = marshmallow_load(compiled_schema, many, data)
+    assert_same(compiled_schema.load(data, many=many), expected)
+
+
+@pytest.mark.parametrize("compiled_schema, many, data", INVALID_CORPUS)
+def test_same_errors(compiled_schema, many, data):
+    with pytest.raises(ValidationError) as expected:
+        marshmallow_load(compiled_schema, many, data)
+    with pytest.raises(ValidationError) as error:
+        compiled_schema.load(data, many=many)
+    assert error.value.messages == expected.value.messages
+
+
+def test_same_exception_for_null_message():
+    # post_load hook of the schema fails on it
+    with pytest.raises(TypeError):
+        marshmallow_load(compiled.MESSAGE_BODY, True, [None])
+    with pytest.raises(TypeError):
+        compiled.MESSAGE_BODY.load([None], many=True)
+
+
+def test_hooks_are_not_compiled():
+    with pytest.raises(ValueError):
+        compiled.CompiledSchema(schemas.SubscribeBodySchema)
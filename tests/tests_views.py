@@ -2,9 +2,13 @@ from gevent import monkey
 
 monkey.patch_all()
 
+import json
+import time
 import pytest
 import gevent
 import marshmallow
+import channelstream.gc
+from channelstream import patched_json
 from channelstream.server_state import get_state
 from channelstream.channel import Channel
 
@@ -331,6 +335,115 @@ class TestInfoView(object):
         assert "private" not in result["users"][0]["state"]
         assert len(result["channels"]["a"]["history"]) == 0
 
+    def connect_users(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import connect
+
+        for i, channels in enumerate([["a", "b1", "b2"], ["b2", "b3", "c"]]):
+            dummy_request.json_body = {
+                "username": "test{}".format(i),
+                "conn_id": str(test_uuids[i]),
+                "channels": channels,
+            }
+            connect(dummy_request)
+        dummy_request.body = "value"
+
+    def test_paginated_json(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import info
+
+        self.connect_users(dummy_request, test_uuids)
+        pages = []
+        cursor = None
+        while True:
+            dummy_request.json_body = {"info": {"limit": 2, "cursor": cursor}}
+            result = info(dummy_request)
+            pages.append(sorted(result["channels"].keys()))
+            cursor = result["next_cursor"]
+            if cursor is None:
+                break
+        assert pages == [["a", "b1"], ["b2", "b3"], ["c"]]
+
+        dummy_request.json_body = {"info": {"channel_prefix": "b", "user": "test0"}}
+        result = info(dummy_request)
+        assert sorted(result["channels"].keys()) == ["b1", "b2"]
+        assert "next_cursor" not in result
+
+        dummy_request.json_body = {"info": {"cursor": "not a cursor"}}
+        with pytest.raises(marshmallow.ValidationError):
+            info(dummy_request)
+
+    def test_streamed_json(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import info
+
+        self.connect_users(dummy_request, test_uuids)
+        dummy_request.json_body = {"info": {"include_connections": True}}
+        expected = info(dummy_request)
+        dummy_request.json_body = {"info": {"stream": True}}
+        response = info(dummy_request)
+        chunks = list(response.app_iter)
+        assert response.content_type == "application/json"
+        result = json.loads(b"".join(chunks).decode("utf8"))
+        assert result["channels"] == json.loads(
+            patched_json.dumps(expected["channels"])
+        )
+        assert sorted(result["users"], key=lambda u: u["user"]) == sorted(
+            expected["users"], key=lambda u: u["user"]
+        )
+
+
+@pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
+class TestAdminJson(object):
+    def test_paginated_users(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import connect, ServerViews
+
+        for i in range(5):
+            dummy_request.json_body = {
+                "username": "test{}".format(i),
+                "conn_id": str(test_uuids[i]),
+                "channels": ["room"],
+            }
+            connect(dummy_request)
+        dummy_request.GET = {"limit": "2"}
+        result = ServerViews(dummy_request).admin_json()
+        assert [u["user"] for u in result["users"]] == ["test0", "test1"]
+        assert list(result["channels"]) == ["room"]
+        assert result["next_cursor"] is None
+        assert result["unique_user_count"] == 5
+        dummy_request.GET = {"limit": "2", "user_cursor": result["next_user_cursor"]}
+        result = ServerViews(dummy_request).admin_json()
+        assert [u["user"] for u in result["users"]] == ["test2", "test3"]
+
+        dummy_request.GET = {"user": "test4", "stream": "true"}
+        response = ServerViews(dummy_request).admin_json()
+        result = json.loads(b"".join(response.app_iter).decode("utf8"))
+        assert [u["user"] for u in result["users"]] == ["test4"]
+        assert result["channels"]["room"]["total_users"] == 5
+        assert result["unique_user_count"] == 5
+
+    def test_summary_counters(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import connect, ServerViews, subscribe
+
+        for i, username in enumerate(["test1", "test1", "test2"]):
+            dummy_request.json_body = {
+                "username": username,
+                "conn_id": str(test_uuids[i]),
+                "channels": ["a"],
+            }
+            connect(dummy_request)
+        dummy_request.json_body = {"conn_id": str(test_uuids[2]), "channels": ["b"]}
+        subscribe(dummy_request)
+        get_state().connections[test_uuids[1]].mark_for_gc()
+        channelstream.gc.gc_conns()
+        dummy_request.GET = {"summary": "true"}
+        result = ServerViews(dummy_request).admin_json()
+        assert "channels" not in result
+        assert result["remembered_user_count"] == 2
+        assert result["unique_user_count"] == 2
+        assert result["total_connections"] == 2
+        assert result["total_channels"] == 2
+        channel = get_state().channels["a"]
+        assert channel.get_info()["total_connections"] == 2
+        assert channel.get_info()["total_users"] == 2
+
 
 @pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
 class TestMessageViews(object):
@@ -530,3 +643,140 @@ class TestChannelConfigView(object):
         assert channel_settings["broadcast_presence_with_user_lists"] is True
         assert channel_settings["notify_state"] is True
         assert channel_settings["store_frames"] is False
+
+
+LONG_POLL_CONFIG = {
+    "wake_connections_after": 0.2,
+    "long_poll_coalesce_window": 0.02,
+    "long_poll_max_wait": 0.1,
+    "long_poll_max_batch": 5,
+}
+
+
+@pytest.mark.usefixtures("cleanup_globals")
+class TestAwaitData(object):
+    def make_connection(self, test_uuids):
+        from gevent.queue import Queue
+        from channelstream.connection import Connection
+
+        connection = Connection("test_user", conn_id=test_uuids[1])
+        connection.queue = Queue()
+        return connection
+
+    def test_queued_frames_returned_without_tail_wait(self, test_uuids):
+        from channelstream.wsgi_views.server import await_data
+
+        connection = self.make_connection(test_uuids)
+        for i in range(3):
+            connection.queue.put(b"[%d]" % i)
+        start = time.time()
+        assert await_data(connection, LONG_POLL_CONFIG) == [b"[0]", b"[1]", b"[2]"]
+        assert time.time() - start < 0.1
+
+    def test_max_batch(self, test_uuids):
+        from channelstream.wsgi_views.server import await_data
+
+        connection = self.make_connection(test_uuids)
+        for i in range(7):
+            connection.queue.put(b"[%d]" % i)
+        assert len(await_data(connection, LONG_POLL_CONFIG)) == 5
+        assert connection.queue.qsize() == 2
+
+    def test_trickle_capped_by_max_wait(self, test_uuids):
+        from channelstream.wsgi_views.server import await_data
+
+        connection = self.make_connection(test_uuids)
+
+        def trickle():
+            while True:
+                connection.queue.put(b"[]")
+                gevent.sleep(0.005)
+
+        config = dict(LONG_POLL_CONFIG, long_poll_max_batch=1000)
+        greenlet = gevent.spawn(trickle)
+        start = time.time()
+        frames = await_data(connection, config)
+        elapsed = time.time() - start
+        greenlet.kill()
+        assert frames
+        assert elapsed < 0.2
+
+    def test_nothing_queued(self, test_uuids):
+        from channelstream.wsgi_views.server import await_data
+
+        connection = self.make_connection(test_uuids)
+        assert await_data(connection, LONG_POLL_CONFIG) == []
+
+
+@pytest.mark.usefixtures("cleanup_globals", "pyramid_config")
+class TestListen(object):
+    def connect(self, dummy_request, test_uuids):
+        from channelstream.wsgi_views.server import connect
+
+        dummy_request.json_body = {
+            "username": "test_user",
+            "conn_id": str(test_uuids[1]),
+            "channels": ["a"],
+            "channel_configs": {},
+        }
+        connect(dummy_request)
+
+    def poll(self, test_uuids, ack=None):
+        from pyramid import testing
+        from channelstream.wsgi_views.server import listen
+
+        request = testing.DummyRequest(params={"conn_id": str(test_uuids[1])})
+        request.registry.settings.update(LONG_POLL_CONFIG)
+        if ack is not None:
+            request.params["ack"] = str(ack)
+        response = listen(request)
+        body = b"".join(response.app_iter)
+        return json.loads(body.decode("utf8")), response.headers["X-Channelstream-Seq"]
+
+    def publish(self, text):
+        from channelstream import operations
+        from channelstream.server_state import get_state
+
+        msg = {
+            "channel": "a",
+            "message": text,
+            "user": "system",
+            "pm_users": [],
+            "exclude_users": [],
+        }
+        operations.pass_message(msg, get_state().stats)
+
+    def test_buffer_kept_between_polls(self, dummy_request, test_uuids):
+        from channelstream.server_state import get_state
+
+        self.connect(dummy_request, test_uuids)
+        self.publish("first")
+        messages, seq = self.poll(test_uuids)
+        assert [m["message"] for m in messages] == ["first"]
+        buffer = get_state().connections[test_uuids[1]].queue
+        # published between polls
+        self.publish("second")
+        messages, seq = self.poll(test_uuids, ack=seq)
+        assert [m["message"] for m in messages] == ["second"]
+        assert get_state().connections[test_uuids[1]].queue is buffer
+
+    def test_unacknowledged_frames_are_resent(self, dummy_request, test_uuids):
+        self.connect(dummy_request, test_uuids)
+        self.publish("first")
+        messages, first_seq = self.poll(test_uuids, ack=0)
+        self.publish("second")
+        # response with "first" was lost, client acknowledges nothing
+        messages, seq = self.poll(test_uuids, ack=0)
+        assert [m["message"] for m in messages] == ["first", "second"]
+        messages, seq = self.poll(test_uuids, ack=first_seq)
+        assert [m["message"] for m in messages] == ["second"]
+        messages, seq = self.poll(test_uuids, ack=seq)
+        assert messages == []
+
+    def test_malformed_ack(self, dummy_request, test_uuids):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        self.connect(dummy_request, test_uuids)
+        for ack in ("abc", "-1"):
+            with pytest.raises(HTTPBadRequest):
+                self.poll(test_uuids, ack=ack)
@@ -0,0 +1,109 @@
+import time
+
+import pytest
+from itsdangerous import BadSignature, SignatureExpired, TimestampSigner
+from pyramid import testing
+
+from channelstream.wsgi_views import wsgi_security
+from channelstream.wsgi_views.wsgi_security import AllowList, APIFactory, APISecurity
+
+
+class TestAllowList(object):
+    def test_addresses_and_networks(self):
+        allow_list = AllowList(["127.0.0.1", "10.0.0.0/8", "192.168.1.0/24"])
+        assert "127.0.0.1" in allow_list
+        assert "10.20.30.40" in allow_list
+        assert "192.168.1.200" in allow_list
+        assert "192.168.2.1" not in allow_list
+        assert "127.0.0.2" not in allow_list
+        assert "not an address" not in allow_list
+
+    def test_ipv6(self):
+        allow_list = AllowList(["::1", "fd00::/8", "127.0.0.1"])
+        assert "0:0:0:0:0:0:0:1" in allow_list
+        assert "fd12:3456::1" in allow_list
+        assert "fe80::1" not in allow_list
+        # ipv4 client reported by dual stack socket
+        assert "::ffff:127.0.0.1" in allow_list
+
+    def test_allow_all(self):
+        assert "8.8.8.8" in AllowList("0.0.0.0")
+        assert "8.8.8.8" in AllowList(["0.0.0.0/0"])
+
+    def test_comma_separated(self):
+        assert "10.0.0.1" in AllowList("127.0.0.1, 10.0.0.0/8")
+
+    def test_invalid_entry(self):
+        with pytest.raises(ValueError):
+            AllowList(["localhost"])
+
+
+class TestAPISecurity(object):
+    settings = {"secret": "secret", "allow_posting_from": ["127.0.0.1"]}
+
+    def test_verified_secret_is_cached(self, monkeypatch):
+        security = APISecurity(self.settings)
+        secret = TimestampSigner("secret").sign("channelstream").decode("utf8")
+        security.verify(secret)
+        assert secret in security.verified
+
+        def fail(*args, **kwargs):
+            raise AssertionError("signature checked again")
+
+        monkeypatch.setattr(security.signer, "unsign", fail)
+        security.verify(secret)
+
+    def test_cached_secret_expires_with_max_age(self, monkeypatch):
+        security = APISecurity(self.settings, cache_ttl=3600)
+        secret = TimestampSigner("secret").sign("channelstream").decode("utf8")
+        security.verify(secret, max_age=60)
+        now = time.time()
+        monkeypatch.setattr(wsgi_security.time, "time", lambda: now + 120)
+        monkeypatch.setattr(security.signer, "get_timestamp", lambda: int(now + 120))
+        with pytest.raises(SignatureExpired):
+            security.verify(secret, max_age=60)
+
+    def test_bad_secret_is_not_cached(self):
+        security = APISecurity(self.settings)
+        secret = TimestampSigner("other").sign("channelstream").decode("utf8")
+        for _ in range(2):
+            with pytest.raises(BadSignature):
+                security.verify(secret)
+        assert security.verified == {}
+
+    def test_cache_is_bounded(self):
+        security = APISecurity(self.settings, cache_size=10)
+        signer = TimestampSigner("secret")
+        for i in range(25):
+            security.verify(signer.sign("channelstream{}".format(i)).decode("utf8"))
+        assert len(security.verified) <= 10
+
+
+class TestAPIFactory(object):
+    def teardown_method(self, method):
+        testing.tearDown()
+
+    def make_request(self, addr, secret=None):
+        config = testing.setUp(
+            settings={"secret": "secret", "allow_posting_from": ["10.0.0.0/8"]}
+        )
+        request = testing.DummyRequest(
+            environ={"REMOTE_ADDR": addr}, registry=config.registry
+        )
+        if secret:
+            request.headers["x-channelstream-secret"] = secret
+        return request
+
+    def test_allowed(self):
+        secret = TimestampSigner("secret").sign("channelstream").decode("utf8")
+        factory = APIFactory(self.make_request("10.1.2.3", secret))
+        assert factory.__acl__
+
+    def test_ip_not_allowed(self):
+        secret = TimestampSigner("secret").sign("channelstream").decode("utf8")
+        factory = APIFactory(self.make_request("11.1.2.3", secret))
+        assert factory.__acl__ == []
+
+    def test_no_secret(self):
+        factory = APIFactory(self.make_request("10.1.2.3"))
+        assert factory.__acl__ == []